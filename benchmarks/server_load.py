@@ -0,0 +1,322 @@
+"""
+Load-generation benchmark for the federated server.
+Simulates N concurrent clients doing download_model/upload_model rounds against server.app,
+either in-process (werkzeug, threaded) or as a gunicorn subprocess, and reports
+latency percentiles, throughput, peak RSS (sampled, and per process) and time-to-aggregate as JSON.
+
+    python benchmarks/server_load.py --clients 100 --rounds 3 --mode subprocess --output bench.json
+"""
+
+import os
+import sys
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SERVER_DIR = os.path.join(ROOT, "server")
+sys.path.append(ROOT)
+
+import json
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import torch
+
+import shared.delta as dl
+import shared.encryption as en
+import shared.preprocessing as pp
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_env(model_folder, min_models):
+    env = dict(os.environ)
+    env["MODEL_FOLDER"] = model_folder
+    env["MIN_MODELS_PER_ROUND"] = str(min_models)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT, SERVER_DIR, env.get("PYTHONPATH", "")])
+    return env
+
+
+def start_in_process(port, env):
+    """
+    Import server.app in this process and serve it from a background thread.
+    """
+    os.environ.update(env)
+    os.chdir(SERVER_DIR)
+    sys.path.insert(0, SERVER_DIR)
+    from werkzeug.serving import make_server
+    import server
+
+    httpd = make_server("127.0.0.1", port, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd.shutdown, os.getpid()
+
+
+def start_subprocess(port, env, workers, threads):
+    """
+    Run server.app under gunicorn, as the Dockerfile does.
+    """
+    process = subprocess.Popen(
+        ["gunicorn", "-b", f"127.0.0.1:{port}", "--workers", str(workers), "--threads", str(threads), "server:app"],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return process.terminate, process.pid
+
+
+def start_asgi(port, env):
+    """
+    Run the asyncio entry point under uvicorn, in a single process.
+    """
+    process = subprocess.Popen(
+        ["uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return process.terminate, process.pid
+
+
+def wait_healthy(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("Server did not become healthy")
+
+
+def process_tree(pid):
+    """
+    pid and the pids of all its live descendants. Linux only.
+    """
+    pids = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as file:
+                pending.extend(int(child) for child in file.read().split())
+        except OSError:
+            continue
+        pids.append(current)
+    return pids
+
+
+def status_kb(pid, field):
+    """
+    A memory field of /proc/<pid>/status (e.g. VmRSS or VmHWM) in KB, or None if the process is gone.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_by_process(pid):
+    """
+    Peak resident memory (VmHWM) in KB of a process and each of its live descendants, keyed by pid.
+    """
+    if pid == os.getpid():
+        return {pid: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    peaks = {current: status_kb(current, "VmHWM") for current in process_tree(pid)}
+    return {current: peak for current, peak in peaks.items() if peak is not None}
+
+
+class RssSampler:
+    """
+    Samples the combined resident memory of a process tree in the background.
+    Each process's own peak can happen at a different time, so summing them only gives an upper bound;
+    the largest sampled sum is the tree's actual peak (to within the sampling interval).
+    """
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.peak_kb
+
+    def _run(self):
+        while True:
+            sizes = [status_kb(current, "VmRSS") for current in process_tree(self.pid)]
+            total = sum(size for size in sizes if size is not None)
+            if total:
+                self.peak_kb = max(self.peak_kb or 0, total)
+            if self._stopped.wait(self.interval):
+                return
+
+
+def build_bundles(num_clients):
+    """
+    Pre-encode one realistic upload per client so client-side encoding isn't timed.
+    """
+    base = pp.generate_base_model().state_dict()
+    bundles = []
+    for _ in range(num_clients):
+        state_dict = {k: v + 1e-3 * torch.randn_like(v) for k, v in base.items()}
+        norm_stats = {"input_mean": [0.0] * pp.INPUT_DIM, "input_std": [1.0] * pp.INPUT_DIM,
+                      "tilt_mean": 7.0, "tilt_std": 3.0, "num_samples": 1000}
+        bundles.append((state_dict, norm_stats))
+    return bundles
+
+
+def encode_upload(state_dict, norm_stats, base_state_dict, base_version, update_format):
+    if update_format == "delta":
+        bundle = {"delta": dl.encode_delta(state_dict, base_state_dict, base_version), "norm_stats": norm_stats}
+    else:
+        bundle = {"state_dict": state_dict, "norm_stats": norm_stats}
+    return en.encode_model_binary(bundle)
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "p50_ms": pick(0.50) * 1000,
+        "p95_ms": pick(0.95) * 1000,
+        "p99_ms": pick(0.99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def run_round(url, bundles, update_format, latencies, sessions):
+    """
+    Every client downloads the global model then uploads its update, all concurrently.
+    """
+    def client(i):
+        session = sessions[i]
+        start = time.perf_counter()
+        response = session.get(f"{url}/download_model", params={"format": "binary"})
+        latencies["download"].append(time.perf_counter() - start)
+        response.raise_for_status()
+
+        global_bundle = en.decode_model(response.content)
+        base_state_dict = global_bundle["state_dict"] if "state_dict" in global_bundle else global_bundle
+        base_version = int(global_bundle.get("version", 0)) if "state_dict" in global_bundle else 0
+
+        state_dict, norm_stats = bundles[i]
+        body = encode_upload(state_dict, norm_stats, base_state_dict, base_version, update_format)
+
+        start = time.perf_counter()
+        response = session.post(f"{url}/upload_model", data=body, headers={"Content-Type": en.BINARY_MIMETYPE})
+        latencies["upload"].append(time.perf_counter() - start)
+        response.raise_for_status()
+        return len(body)
+
+    with ThreadPoolExecutor(max_workers=len(bundles)) as pool:
+        return sum(pool.map(client, range(len(bundles))))
+
+
+def wait_for_round(url, round_number, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if requests.get(f"{url}/round_status").json()["round"] > round_number:
+            return
+        time.sleep(0.01)
+    raise TimeoutError(f"Round {round_number} was not aggregated")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--mode", choices=("inprocess", "subprocess", "asgi"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers in subprocess mode")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker in subprocess mode")
+    parser.add_argument("--update-format", choices=("delta", "full"), default="delta")
+    parser.add_argument("--output", help="write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    model_folder = tempfile.mkdtemp(prefix="fir-bench-")
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    env = server_env(model_folder, args.clients)
+
+    if args.mode == "inprocess":
+        stop, pid = start_in_process(port, env)
+    elif args.mode == "asgi":
+        stop, pid = start_asgi(port, env)
+    else:
+        stop, pid = start_subprocess(port, env, args.workers, args.threads)
+
+    sampler = RssSampler(pid).start()
+    try:
+        wait_healthy(url)
+        bundles = build_bundles(args.clients)
+        sessions = [requests.Session() for _ in range(args.clients)]
+        latencies = {"download": [], "upload": []}
+        aggregate_times = []
+        bytes_uploaded = 0
+
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            round_number = requests.get(f"{url}/round_status").json()["round"]
+            bytes_uploaded += run_round(url, bundles, args.update_format, latencies, sessions)
+            uploaded_at = time.perf_counter()
+            wait_for_round(url, round_number)
+            aggregate_times.append(time.perf_counter() - uploaded_at)
+        elapsed = time.perf_counter() - start
+
+        total_requests = len(latencies["download"]) + len(latencies["upload"])
+        report = {
+            "mode": args.mode,
+            "clients": args.clients,
+            "rounds": args.rounds,
+            "update_format": args.update_format,
+            "elapsed_s": elapsed,
+            "requests_per_s": total_requests / elapsed,
+            "bytes_uploaded": bytes_uploaded,
+            "download": percentiles(latencies["download"]),
+            "upload": percentiles(latencies["upload"]),
+            "time_to_aggregate_ms": [t * 1000 for t in aggregate_times],
+        }
+        sampled_peak = sampler.stop()
+        peaks = peak_rss_by_process(pid)
+        if args.mode == "inprocess":
+            # The server shares this process with the load generator, so its RSS can't be told apart
+            report["peak_rss_kb"] = None
+            report["peak_rss_kb_including_load_generator"] = peaks.get(pid)
+        else:
+            # Sampled combined RSS of the server and its workers, plus each live process's own peak;
+            # workers that were recycled during the run only show up in the sampled figure
+            report["peak_rss_kb"] = sampled_peak
+            report["peak_rss_kb_by_process"] = {str(current): peak for current, peak in peaks.items()}
+            report["peak_rss_kb_upper_bound"] = sum(peaks.values()) or None
+
+        print(json.dumps(report, indent=2))
+        if output:
+            with open(output, "w") as file:
+                json.dump(report, file, indent=2)
+    finally:
+        sampler.stop()
+        stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,305 @@
 import os
-import requests
+import time
+import uuid
 import traceback
 from datetime import datetime
 
 import shared.preprocessing as pp
+import shared.dataset as ds
+import shared.delta as dl
 import shared.encryption as en
+import shared.secure as sc
 import shared.training as tr
+import transport as tp
 
 
-SERVER_URL  = "http://server:5000"
+SERVER_URL  = os.environ.get("SERVER_URL", "http://server:5000")
+TRANSPORT   = os.environ.get("MODEL_TRANSPORT", "binary")  # "binary" or "base64"
+
+UPDATE_FORMAT    = os.environ.get("UPDATE_FORMAT", "delta")   # "delta" or "full"
+DELTA_QUANTIZE   = os.environ.get("DELTA_QUANTIZE", "fp16")   # "fp32", "fp16" or "int8"
+DELTA_TOPK_RATIO = float(os.environ["DELTA_TOPK_RATIO"]) if "DELTA_TOPK_RATIO" in os.environ else None
+
+SECURE_AGGREGATION = os.environ.get("SECURE_AGGREGATION", "0") == "1"  # must match the server
+SECURE_POLL_INTERVAL = 2
+SECURE_TIMEOUT = 600
+CLIENT_ID = os.environ.get("CLIENT_ID") or uuid.uuid4().hex
+
+VALIDATION_SPLIT = float(os.environ.get("VALIDATION_SPLIT", tr.VALIDATION_SPLIT))  # opt-in, 0 trains on all data
+PATIENCE         = int(os.environ.get("EARLY_STOPPING_PATIENCE", tr.PATIENCE))      # opt-in, 0 runs every epoch
+ACCELERATE       = os.environ.get("TRAINING_ACCELERATE", "0") == "1"  # compile the training step with torch.compile
+BF16             = os.environ.get("TRAINING_BF16", "0") == "1"        # bf16 autocast where the CPU/GPU supports it
+
+NORM_STAT_KEYS = ("input_mean", "input_std", "tilt_mean", "tilt_std")
 
 INPUTS_PATH = "data/inputs.csv"
 LABELS_PATH = "data/labels.csv"
 
+DAEMON = os.environ.get("CLIENT_DAEMON", "0") == "1"  # stay resident and train whenever a new session and a new round are both in
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", 5))  # seconds between checks of data/ and the server
+SESSION_SETTLE_SECONDS = float(os.environ.get("SESSION_SETTLE_SECONDS", 10))  # a session is over once its CSVs stop changing for this long
+STAGED_INPUTS_PATH = "data/training/inputs.csv"
+STAGED_LABELS_PATH = "data/training/labels.csv"
+FAILED_FOLDER = "data/failed"
+MAX_SESSION_ATTEMPTS = int(os.environ.get("MAX_SESSION_ATTEMPTS", 3))  # failed rounds before a staged session is set aside
 
-def get_global_model():
+SERVER = tp.ServerSession(SERVER_URL)  # pooled, compressed and retrying connection to the server
+
+
+def fetch_global_model(etag=None):
     """
-    Get global model from server
+    Conditionally download the global model: returns (weights, version, etag),
+    or None if the server's model still matches etag.
     """
-    url = f"{SERVER_URL}/download_model"
-    response = requests.get(url)
+    params = {"format": "binary"} if TRANSPORT == "binary" else None
+    headers = {"If-None-Match": etag} if etag else None
+    response = SERVER.get("/download_model", params=params, headers=headers)
+    if response.status_code == 304:
+        return None
     response.raise_for_status()
-    
-    sd_bytes = response.content
-    sd = en.decode_model(sd_bytes)
 
-    model = pp.generate_base_model()
+    sd = en.decode_model(response.content)
     weights = sd["state_dict"] if "state_dict" in sd else sd
-    model.load_state_dict(weights)
+    version = int(sd.get("version", 0)) if "state_dict" in sd else 0
+    return weights, version, response.headers.get("ETag")
 
-    return model
+
+def get_global_model():
+    """
+    Get global model from server, along with the version it was aggregated at.
+    """
+    weights, version, _ = fetch_global_model()
+    model = pp.generate_base_model()
+    model.load_state_dict(weights)
+    return model, version
 
 
-def send_model(model, norm_stats):
+def send_model(model, norm_stats, base_state_dict=None, base_version=0):
     """
     Send trained model and norm stats to server as a bundle.
+    When a base model is given, only the (quantized/sparsified) delta from it is sent.
+    Uses the binary transport and falls back to base64 if the server does not support it (415).
+    Any other error, including a 400 for an invalid payload, fails the upload.
     """
-    bundle = {"state_dict": model.state_dict(), "norm_stats": norm_stats}
-    encoded = en.encode_model(bundle)
-    url = f"{SERVER_URL}/upload_model"
-    files = {"file": ("model.pt", encoded)}
-    response = requests.post(url, files=files)
+    if UPDATE_FORMAT == "delta" and base_state_dict is not None:
+        delta = dl.encode_delta(
+            model.state_dict(),
+            base_state_dict,
+            base_version,
+            quantize=DELTA_QUANTIZE,
+            topk_ratio=DELTA_TOPK_RATIO,
+        )
+        bundle = {"delta": delta, "norm_stats": norm_stats}
+    else:
+        bundle = {"state_dict": model.state_dict(), "norm_stats": norm_stats}
+
+    response = None
+    if TRANSPORT == "binary":
+        response = SERVER.upload("/upload_model", en.encode_model_binary(bundle))
+
+    if response is None or response.status_code == 415:
+        encoded = en.encode_model(bundle)
+        files = {"file": ("model.pt", encoded)}
+        response = SERVER.post("/upload_model", files=files)
     response.raise_for_status()
     print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Model sent successfully!", flush=True)
 
 
-def main():
+def poll_secure(path, ready, params=None):
     """
-    Main function of Client
+    Poll a secure-aggregation endpoint until ready(reply) holds.
     """
-    try:
-        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Getting global model...", flush=True)
-        model = get_global_model()
+    deadline = time.monotonic() + SECURE_TIMEOUT
+    while time.monotonic() < deadline:
+        response = SERVER.get(path, params=params)
+        response.raise_for_status()
+        reply = response.json()
+        if ready(reply):
+            return reply
+        time.sleep(SECURE_POLL_INTERVAL)
+    raise TimeoutError(f"Timed out waiting on {path}")
+
+
+def send_masked_model(model, norm_stats):
+    """
+    Secure aggregation: join the round's roster, mask the update with pairwise seeds shared
+    with every other roster member, upload it, then stay until the round is unmasked
+    in case seeds with dropped peers have to be revealed.
+    Raises if the server aborts the round, so the session is kept for a later one.
+    """
+    private_key, public_key = sc.generate_keypair()
+    deadline = time.monotonic() + SECURE_TIMEOUT
+    while True:
+        response = SERVER.post("/secure/advertise", json={"client_id": CLIENT_ID, "public_key": hex(public_key)})
+        response.raise_for_status()
+        reply = response.json()
+        if reply["accepted"]:
+            break
+        if time.monotonic() >= deadline:
+            raise TimeoutError("Timed out waiting for a secure round with room on its roster")
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Round roster is full, waiting for the next round...", flush=True)
+        time.sleep(SECURE_POLL_INTERVAL)
+
+    round_number = reply["round"]
+    roster = poll_secure("/secure/roster", lambda reply: reply["closed"] or reply["round"] != round_number)
+    if roster["round"] != round_number:
+        raise RuntimeError(f"Secure round {round_number} was aborted before its roster closed")
+    peers = {peer_id: int(key, 16) for peer_id, key in roster["clients"].items() if peer_id != CLIENT_ID}
+
+    flat, _ = dl.flatten_state_dict(model.state_dict())
+    packed, stats_layout = sc.pack_update(flat, norm_stats, NORM_STAT_KEYS)
+    masked = sc.mask_update(packed, CLIENT_ID, round_number, private_key, peers)
+    bundle = {"masked": {"round": round_number, "client_id": CLIENT_ID, "values": masked, "stats_layout": stats_layout}}
+
+    response = SERVER.upload("/upload_model", en.encode_model_binary(bundle), headers={"X-Client-Id": CLIENT_ID})
+    response.raise_for_status()
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Masked model sent for round {round_number}", flush=True)
+
+    state = poll_secure("/secure/status", lambda reply: reply["state"] != "collecting", {"round": round_number})
+    if state["state"] == "unmasking" and CLIENT_ID not in state["dropouts"]:
+        seeds = {
+            peer_id: sc.pair_seed(private_key, peers[peer_id], round_number, CLIENT_ID, peer_id).hex()
+            for peer_id in state["dropouts"]
+        }
+        response = SERVER.post("/secure/unmask", json={"round": round_number, "client_id": CLIENT_ID, "seeds": seeds})
+        response.raise_for_status()
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Revealed seeds for {len(seeds)} dropped clients", flush=True)
+        state = poll_secure("/secure/status", lambda reply: reply["state"] in ("done", "aborted"), {"round": round_number})
+
+    if state["state"] == "aborted":
+        raise RuntimeError(f"Secure round {round_number} was aborted by the server")
+
 
-        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Training model...", flush=True)
-        model, norm_stats = tr.update_model(
-            model=model,
-            inputs_path=INPUTS_PATH,
-            labels_path=LABELS_PATH
+def run_round(model, base_version, inputs_path=INPUTS_PATH, labels_path=LABELS_PATH):
+    """
+    Train the global model on a recorded session, send it to the server, then delete the session.
+    """
+    base_state_dict = {k: v.detach().clone() for k, v in model.state_dict().items()}
+
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Training model...", flush=True)
+    model, norm_stats, report = tr.update_model(
+        model=model,
+        inputs_path=inputs_path,
+        labels_path=labels_path,
+        validation_split=VALIDATION_SPLIT,
+        patience=PATIENCE,
+        accelerate=ACCELERATE,
+        bf16=BF16
+    )
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Trained at {tr.describe_throughput(report)}", flush=True)
+    if report["val_metrics"] is not None:
+        print(
+            f"[+][{datetime.now().strftime('%H:%M:%S')}] Ran {report['epochs_run']} epochs, kept epoch {report['best_epoch']} "
+            f"(val loss {report['val_metrics']['loss']:.4f}, binary acc {report['val_metrics']['binary_acc']:.4f}, "
+            f"steer MAE {report['val_metrics']['steer_mae']:.4f})",
+            flush=True
         )
 
-        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Sending model to server...", flush=True)
-        send_model(model, norm_stats)
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Sending model to server...", flush=True)
+    if SECURE_AGGREGATION:
+        send_masked_model(model, norm_stats)
+    else:
+        send_model(model, norm_stats, base_state_dict, base_version)
+
+    # del data after
+    os.remove(inputs_path)
+    os.remove(labels_path)
+    if os.path.exists(ds.dataset_path(inputs_path)):
+        os.remove(ds.dataset_path(inputs_path))
+
+
+def session_ready():
+    """
+    Whether data/ holds a finished recording: both CSVs have rows and neither changed for SESSION_SETTLE_SECONDS.
+    """
+    try:
+        stats = [os.stat(INPUTS_PATH), os.stat(LABELS_PATH)]
+    except FileNotFoundError:
+        return False
+    settled = time.time() - max(stat.st_mtime for stat in stats) >= SESSION_SETTLE_SECONDS
+    return settled and all(stat.st_size > 0 for stat in stats)
+
+
+def stage_session():
+    """
+    Move a finished recording out of the recorder's way, so frames recorded while
+    training go to a new session instead of being deleted with this one.
+    """
+    os.makedirs(os.path.dirname(STAGED_INPUTS_PATH), exist_ok=True)
+    os.replace(INPUTS_PATH, STAGED_INPUTS_PATH)
+    os.replace(LABELS_PATH, STAGED_LABELS_PATH)
+
+
+def set_aside_session():
+    """
+    Move a staged session that keeps failing to data/failed/<time>/, so the daemon stops retrying it.
+    """
+    folder = os.path.join(FAILED_FOLDER, datetime.now().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(folder, exist_ok=True)
+    for path in (STAGED_INPUTS_PATH, STAGED_LABELS_PATH):
+        os.replace(path, os.path.join(folder, os.path.basename(path)))
+    if os.path.exists(ds.dataset_path(STAGED_INPUTS_PATH)):
+        os.remove(ds.dataset_path(STAGED_INPUTS_PATH))
+    return folder
+
+
+def daemon():
+    """
+    Stay resident and take part in every round there is new data for: data/ is checked locally
+    every POLL_INTERVAL seconds, and only then is the server asked, with If-None-Match,
+    whether a new global model (i.e. a new round) is out since our last upload.
+    A staged session whose round fails is retried with exponential backoff, and set aside in
+    data/failed/ after MAX_SESSION_ATTEMPTS failures.
+    """
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Watching {os.path.dirname(INPUTS_PATH)}/ for new sessions...", flush=True)
+    etag, weights, version = None, None, None
+    uploaded_version = None
+    attempts, retry_at = 0, 0.0
+
+    while True:
+        try:
+            staged = os.path.exists(STAGED_INPUTS_PATH) and os.path.exists(STAGED_LABELS_PATH)  # left over from a failed round
+            if (staged and time.monotonic() >= retry_at) or (not staged and session_ready()):
+                fetched = fetch_global_model(etag)
+                if fetched is not None:
+                    weights, version, etag = fetched
+
+                if version != uploaded_version:
+                    if not staged:
+                        stage_session()
+                        attempts = 0
+                    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] New session and global model v{version}, joining the round...", flush=True)
+                    model = pp.generate_base_model()
+                    model.load_state_dict(weights)
+                    try:
+                        run_round(model, version, STAGED_INPUTS_PATH, STAGED_LABELS_PATH)
+                    except Exception as e:
+                        attempts += 1
+                        if attempts >= MAX_SESSION_ATTEMPTS:
+                            folder = set_aside_session()
+                            attempts = 0
+                            print(f"[+][{datetime.now().strftime('%H:%M:%S')}] [ERROR]: {e}; session failed {MAX_SESSION_ATTEMPTS} times, moved to {folder}", flush=True)
+                        else:
+                            retry_at = time.monotonic() + POLL_INTERVAL * 2 ** attempts
+                            print(f"[+][{datetime.now().strftime('%H:%M:%S')}] [ERROR]: {e}; attempt {attempts}/{MAX_SESSION_ATTEMPTS}, retrying in {POLL_INTERVAL * 2 ** attempts:.0f}s", flush=True)
+                    else:
+                        uploaded_version = version
+                        attempts = 0
+
+        except Exception as e:
+            print(f"[+][{datetime.now().strftime('%H:%M:%S')}] [ERROR]: {e}", flush=True)
 
-        # del data after
-        os.remove("data/inputs.csv")
-        os.remove("data/labels.csv")
+        time.sleep(POLL_INTERVAL)
+
+
+def main():
+    """
+    Main function of Client
+    """
+    try:
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Getting global model...", flush=True)
+        model, base_version = get_global_model()
+        run_round(model, base_version)
 
     except Exception as e:
         traceback.print_tb(f"[+][{datetime.now().strftime('%H:%M:%S')}] [ERROR]: {e.__traceback__}")
@@ -73,4 +307,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if DAEMON:
+        daemon()
+    else:
+        main()
@@ -0,0 +1,96 @@
+import time
+import random
+import hashlib
+import requests
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+
+import shared.encryption as en
+
+
+CONNECT_TIMEOUT = 5    # seconds to open a connection to the server
+READ_TIMEOUT = 120     # seconds to wait for a response, uploads of large models included
+RETRIES = 5            # extra attempts after a connection error, timeout or retryable status
+BACKOFF = 0.5          # base delay in seconds, doubled each attempt with full jitter
+MAX_BACKOFF = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DOWNLOAD_ENCODINGS = tuple(e for e in en.CONTENT_ENCODINGS if e in ACCEPT_ENCODING.split(","))  # the ones urllib3 can decode
+
+
+class ServerSession:
+    """
+    HTTP transport to the federated server:
+      - one persistent session, so every request reuses pooled keep-alive connections
+      - connect/read timeouts and bounded retries with jittered exponential backoff
+      - downloads accept DOWNLOAD_ENCODINGS (requests decompresses them transparently)
+      - binary uploads are compressed with the best encoding the server advertised in its
+        Accept-Encoding response header, and carry an X-Upload-Id (SHA-256 of the payload)
+        so the server never counts a retried upload twice
+    Every server endpoint is idempotent under these retries: secure-aggregation calls are keyed
+    by round and client id, and uploads by their X-Upload-Id.
+    """
+
+    def __init__(self, base_url, retries=RETRIES, backoff=BACKOFF, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.base_url = base_url.rstrip("/")
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.upload_encodings = None  # the server's Accept-Encoding; nothing is compressed until it has been seen
+
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=4))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=4))
+        self.session.headers["Accept-Encoding"] = ", ".join(DOWNLOAD_ENCODINGS) or "identity"
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request, retrying connection errors, timeouts and RETRY_STATUSES.
+        Returns the last response; callers decide what other statuses mean.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                self._wait(attempt, f"{method} {path} failed ({type(e).__name__})")
+                continue
+
+            self._learn_encodings(response)
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return response
+            self._wait(attempt, f"{method} {path} returned {response.status_code}", response.headers.get("Retry-After"))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def upload(self, path, body: bytes, headers=None):
+        """
+        POST a binary model body: keyed by the SHA-256 of its payload and compressed if the server accepts it.
+        """
+        headers = {
+            "Content-Type": en.BINARY_MIMETYPE,
+            "X-Upload-Id": hashlib.sha256(memoryview(body)[en.BINARY_HEADER.size:]).hexdigest(),
+            **(headers or {}),
+        }
+        encoding = en.negotiate(self.upload_encodings)
+        if encoding is not None:
+            body = en.compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+        return self.post(path, data=body, headers=headers)
+
+    def _learn_encodings(self, response):
+        if "Accept-Encoding" in response.headers:
+            self.upload_encodings = response.headers["Accept-Encoding"]
+
+    def _wait(self, attempt, reason, retry_after=None):
+        delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, min(MAX_BACKOFF, int(retry_after)))
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] {reason}, retrying in {delay:.1f}s ({attempt + 1}/{self.retries})", flush=True)
+        time.sleep(delay)
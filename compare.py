@@ -4,19 +4,19 @@ on validation data. Produces console metrics and figures for FYP reporting.
 """
 
 import torch
-from torch.utils.data import TensorDataset, DataLoader
-import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+import shared.dataset as ds
 import shared.preprocessing as pp
+import shared.store as st
 import shared.training as tr
 
 
 # ── Config ────────────────────────────────────────────────────────────────────
 
 MODEL_FOLDER    = "models/rounds"
-NUM_ROUNDS      = 5
+NUM_ROUNDS      = 5  # most recent rounds present for both models
 VAL_INPUTS_PATH = "shared/val_data/inputs.csv"
 VAL_LABELS_PATH = "shared/val_data/labels.csv"
 
@@ -32,47 +32,31 @@ plt.rcParams.update({"figure.dpi": 120, "font.size": 11})
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 
-def load_model(path):
+STORE = st.ModelStore(MODEL_FOLDER)
+
+
+def load_model(kind, round_number):
     model = pp.generate_base_model()
-    bundle = torch.load(path, map_location="cpu", weights_only=True)
+    bundle = STORE.load(kind, round_number)
     if "state_dict" in bundle:
         model.load_state_dict(bundle["state_dict"])
         norm_stats = bundle["norm_stats"]
     else:
         model.load_state_dict(bundle)
         norm_stats = None
-        print(f"Warning: {path} has no embedded norm stats")
+        print(f"Warning: {kind} round {round_number} has no embedded norm stats")
     return model, norm_stats
 
 
 def make_tensors(inputs, labels, norm_stats):
-    if norm_stats is not None:
-        input_mean = pd.Series(norm_stats["input_mean"], index=inputs.columns)
-        input_std  = pd.Series(norm_stats["input_std"],  index=inputs.columns)
-        inputs_norm = pp.normalise_inputs(inputs, mean=input_mean, std=input_std)
-        labels_norm = pp.normalise_labels(labels, tilt_mean=norm_stats["tilt_mean"], tilt_std=norm_stats["tilt_std"])
-    else:
-        inputs_norm = pp.normalise_inputs(inputs)
-        labels_norm = pp.normalise_labels(labels)
+    if norm_stats is None:
+        norm_stats = tr.compute_norm_stats(inputs, labels)
     return (
-        torch.tensor(inputs_norm.values, dtype=torch.float32),
-        torch.tensor(labels_norm.values, dtype=torch.float32),
+        pp.normalise_input_tensor(inputs, norm_stats["input_mean"], norm_stats["input_std"]),
+        pp.normalise_label_tensor(labels, norm_stats["tilt_mean"], norm_stats["tilt_std"]),
     )
 
 
-def evaluate_model(model, inputs_t, labels_t):
-    model.eval()
-    loader = DataLoader(TensorDataset(inputs_t, labels_t), shuffle=False)
-    totals = {"loss": 0.0, "binary_acc": 0.0, "steer_mae": 0.0}
-    with torch.no_grad():
-        for x, y in loader:
-            m = tr.compute_metrics(model(x), y, binary_cols_count=BINARY_OUTPUTS)
-            for k in totals:
-                totals[k] += m[k]
-    n = len(loader)
-    return {k: v / n for k, v in totals.items()}
-
-
 def get_predictions(model, inputs_t, norm_stats):
     model.eval()
     with torch.no_grad():
@@ -97,27 +81,31 @@ def print_summary(round_idx, fed_res, cen_res, fed_mae_raw, cen_mae_raw):
 
 # ── Load val data ─────────────────────────────────────────────────────────────
 
-inputs_raw  = pd.read_csv(VAL_INPUTS_PATH)
-labels_raw  = pd.read_csv(VAL_LABELS_PATH)
-true_steer  = labels_raw[labels_raw.columns[BINARY_OUTPUTS]].values
-true_binary = labels_raw.iloc[:, :BINARY_OUTPUTS].values.astype(int)
+val_data    = ds.load_csv_dataset(VAL_INPUTS_PATH, VAL_LABELS_PATH)
+inputs_raw  = val_data.inputs
+labels_raw  = val_data.labels()
+true_steer  = val_data.tilt.numpy()
+true_binary = labels_raw[:, :BINARY_OUTPUTS].int().numpy()
 
 # ── Evaluate all rounds ───────────────────────────────────────────────────────
 
-rounds = list(range(1, NUM_ROUNDS + 1))
+rounds = sorted(set(STORE.rounds("federated")) & set(STORE.rounds("centralised")))[-NUM_ROUNDS:]
+if not rounds:
+    raise SystemExit(f"No rounds with both federated and centralised snapshots in {MODEL_FOLDER}")
+final_round = rounds[-1]
 
 fed_history = {"loss": [], "binary_acc": [], "steer_mae_raw": []}
 cen_history = {"loss": [], "binary_acc": [], "steer_mae_raw": []}
 
 for r in rounds:
-    fed_model, fed_stats = load_model(f"{MODEL_FOLDER}/federated_model_round{r}.pt")
-    cen_model, cen_stats = load_model(f"{MODEL_FOLDER}/centralised_model_round{r}.pt")
+    fed_model, fed_stats = load_model("federated", r)
+    cen_model, cen_stats = load_model("centralised", r)
 
     fed_inputs_t, fed_labels_t = make_tensors(inputs_raw, labels_raw, fed_stats)
     cen_inputs_t, cen_labels_t = make_tensors(inputs_raw, labels_raw, cen_stats)
 
-    fed_res = evaluate_model(fed_model, fed_inputs_t, fed_labels_t)
-    cen_res = evaluate_model(cen_model, cen_inputs_t, cen_labels_t)
+    fed_res = tr.evaluate_model(fed_model, fed_inputs_t, fed_labels_t)
+    cen_res = tr.evaluate_model(cen_model, cen_inputs_t, cen_labels_t)
 
     _, fed_steer_r = get_predictions(fed_model, fed_inputs_t, fed_stats)
     _, cen_steer_r = get_predictions(cen_model, cen_inputs_t, cen_stats)
@@ -146,7 +134,7 @@ fed_final_mae = fed_history["steer_mae_raw"][-1]
 cen_final_mae = cen_history["steer_mae_raw"][-1]
 
 fig, axes = plt.subplots(1, 3, figsize=(13, 4))
-fig.suptitle(f"Overall Validation Metrics (Round {NUM_ROUNDS})", fontweight="bold")
+fig.suptitle(f"Overall Validation Metrics (Round {final_round})", fontweight="bold")
 
 for ax, (title, fv, cv, fmt) in zip(axes, [
     ("Loss",            fed_final_res["loss"],       cen_final_res["loss"],       ".4f"),
@@ -195,7 +183,7 @@ smooth  = lambda x: np.convolve(x, np.ones(window) / window, mode="same")
 
 fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(13, 7), sharex=True,
                                 gridspec_kw={"height_ratios": [2, 1]})
-fig.suptitle(f"Steering: Prediction vs Ground Truth (Round {NUM_ROUNDS})", fontweight="bold")
+fig.suptitle(f"Steering: Prediction vs Ground Truth (Round {final_round})", fontweight="bold")
 
 ax1.plot(frames, true_steer, label="Ground Truth", color=GT_COLOR,  alpha=0.85, linewidth=1.3)
 ax1.plot(frames, fed_steer,  label="Federated",    color=FED_COLOR, alpha=0.75, linewidth=1.0)
@@ -217,7 +205,7 @@ plt.show()
 
 # ── Figure 4 (old Fig 5): Steering distribution (final round) ────────────────
 fig, ax = plt.subplots(figsize=(9, 5))
-fig.suptitle(f"Steering Prediction Distribution (Round {NUM_ROUNDS})", fontweight="bold")
+fig.suptitle(f"Steering Prediction Distribution (Round {final_round})", fontweight="bold")
 bins = 35
 ax.hist(true_steer, bins=bins, alpha=0.55, label="Ground Truth", color=GT_COLOR,  density=True)
 ax.hist(fed_steer,  bins=bins, alpha=0.55, label="Federated",    color=FED_COLOR, density=True)
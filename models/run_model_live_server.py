@@ -11,6 +11,7 @@ import threading
 import socket
 import torch
 
+import shared.export as ex
 import shared.preprocessing as pp
 
 MODEL_NAME = "centralised_model"
@@ -20,20 +21,8 @@ HOST = "127.0.0.1"
 PORT = 5000
 
 
-model = pp.generate_base_model()
-_bundle = torch.load(MODEL_PATH, map_location="cpu", weights_only=True)
-if "state_dict" in _bundle:
-    model.load_state_dict(_bundle["state_dict"])
-    _ns = _bundle["norm_stats"]
-    input_mean = torch.tensor(_ns["input_mean"], dtype=torch.float32)
-    input_std  = torch.tensor(_ns["input_std"],  dtype=torch.float32)
-    tilt_mean  = _ns["tilt_mean"]
-    tilt_std   = _ns["tilt_std"]
-    has_norm_stats = True
-else:
-    model.load_state_dict(_bundle)
-    has_norm_stats = False
-    print("Warning: model has no embedded norm stats — normalization will be inaccurate")
+# Frozen TorchScript with normalisation folded in, exported when the model was written (or now, if missing)
+model = ex.load_inference_model(MODEL_PATH)
 
 
 class WiimoteGUI:
@@ -190,19 +179,15 @@ def socket_loop(gui):
         gui.update_data(telemetry)
 
         telemetry_tensor = torch.tensor(telemetry, dtype=torch.float32).unsqueeze(0)
-        normalised_telemetry = (telemetry_tensor - input_mean) / (input_std + 1e-8)
 
         with torch.no_grad():
-            outputs = model(normalised_telemetry)
+            final = model(telemetry_tensor)
 
-        binary = (torch.sigmoid(outputs[:, :7]) > 0.5).float()
-        gui.update_buttons(binary.tolist()[0])
+        outputs = final.tolist()[0]
+        gui.update_buttons(outputs[:pp.BINARY_OUTPUTS])
+        gui.update_steer(outputs[pp.BINARY_OUTPUTS])
 
-        steer = outputs[:, 7:] * tilt_std + tilt_mean
-        gui.update_steer(steer.item())
-
-        final = torch.cat([binary, steer], dim=1)
-        reply = " ".join(map(str, final.tolist()[0])) + "\n"
+        reply = " ".join(map(str, outputs)) + "\n"
         conn.sendall(reply.encode())
 
     conn.close()
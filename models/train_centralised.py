@@ -2,25 +2,122 @@ import os
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import argparse
+import numpy as np
+import pandas as pd
 import torch
+import shared.export as ex
 import shared.preprocessing as pp
+import shared.stats as ns
+import shared.store as st
 import shared.training as tr
 
 MODEL_PATH   = "models/centralised_model.pt"
+REPLAY_PATH  = "models/centralised_replay.pt"
+ROUNDS_PATH  = "models/rounds"
 INPUTS_PATH  = "server/data/inputs.csv"
 LABELS_PATH  = "server/data/labels.csv"
+REPLAY_SIZE  = int(os.environ.get("REPLAY_SIZE", 0))  # older rows mixed into each run, 0 disables replay
+
+
+def load_replay():
+    """
+    Reservoir of older rows kept next to the checkpoint, so replay never re-reads the full CSVs.
+    """
+    if REPLAY_SIZE == 0 or not os.path.exists(REPLAY_PATH):
+        return None
+    return torch.load(REPLAY_PATH, map_location="cpu", weights_only=True)
+
+
+def update_replay(replay, inputs, labels):
+    """
+    Reservoir-sample the new rows into the replay buffer, keeping a uniform sample of all rows seen.
+    """
+    new_rows = torch.tensor(np.c_[inputs.values, labels.values], dtype=torch.float32)
+    if replay is None:
+        replay = {"rows": new_rows[:0], "seen": 0}
+
+    rows, seen = replay["rows"], replay["seen"]
+    free = REPLAY_SIZE - len(rows)
+    rows = torch.cat([rows, new_rows[:free]]) if free > 0 else rows
+
+    rest = new_rows[max(free, 0):]
+    if len(rest):
+        positions = seen + max(free, 0) + torch.arange(len(rest))
+        slots = (torch.rand(len(rest)) * (positions + 1)).long()
+        keep = slots < REPLAY_SIZE
+        rows[slots[keep]] = rest[keep]
+
+    torch.save({"rows": rows, "seen": seen + len(new_rows)}, REPLAY_PATH)
+
+
+parser = argparse.ArgumentParser(description="Train the centralised model on rows recorded since the last run.")
+parser.add_argument("round", nargs="?", type=int, help="round to snapshot as (defaults to the latest federated round)")
+parser.add_argument("--full", action="store_true", help="ignore the watermark and retrain on the whole dataset")
+parser.add_argument("--accelerate", action="store_true", help="compile the training step with torch.compile")
+parser.add_argument("--bf16", action="store_true", help="bf16 autocast where the CPU/GPU supports it")
+parser.add_argument("--validation-split", type=float, default=tr.VALIDATION_SPLIT,
+                    help="newest fraction of rows held out to pick the best epoch (e.g. 0.1), 0 trains on everything")
+parser.add_argument("--patience", type=int, default=tr.PATIENCE,
+                    help="stop after this many epochs without a validation improvement, 0 runs every epoch")
+args = parser.parse_args()
+
+store = st.ModelStore(ROUNDS_PATH, retention=int(os.environ.get("MODEL_RETENTION_ROUNDS", 0)))
+round_number = args.round or store.latest_round("federated") or 1
 
 model = pp.generate_base_model()
+watermark = None
+old_norm_stats = None
 
 if os.path.exists(MODEL_PATH):
     bundle = torch.load(MODEL_PATH, map_location="cpu", weights_only=True)
     weights = bundle["state_dict"] if "state_dict" in bundle else bundle
     model.load_state_dict(weights)
+    if "state_dict" in bundle and not args.full:
+        watermark = bundle.get("watermark")
+        old_norm_stats = bundle.get("norm_stats") if watermark else None
+        if not ns.mergeable(old_norm_stats):
+            old_norm_stats = None
     print("Loaded existing model.")
 else:
     print("No existing model found, training from scratch.")
 
-model, norm_stats = tr.update_model(model, INPUTS_PATH, LABELS_PATH)
+inputs, labels, watermark, reset = tr.read_appended_rows(INPUTS_PATH, LABELS_PATH, watermark)
+if reset:
+    # The CSVs were rewritten since the last run, so the checkpoint's stats describe data that is gone
+    old_norm_stats = None
+    print("Training data was reset since the last run, reading it from the start.")
+print(f"{len(inputs)} new rows since last run ({watermark['rows']} total).")
+
+if len(inputs) > 0:
+    # Norm stats are merged with the checkpoint's by sample count instead of recomputed over all data
+    norm_stats = ns.merge_norm_stats([old_norm_stats, tr.compute_norm_stats(inputs, labels)])
+
+    # Reading from the start already covers every row, so the replay buffer is rebuilt from them instead
+    replay = None if args.full or reset else load_replay()
+    train_inputs, train_labels = inputs, labels
+    if replay is not None and len(replay["rows"]):
+        replay_rows = replay["rows"].numpy()
+        width = inputs.shape[1]
+        # Replayed rows go first so the validation split still holds out the newest frames
+        train_inputs = pd.concat([pd.DataFrame(replay_rows[:, :width], columns=inputs.columns), inputs], ignore_index=True)
+        train_labels = pd.concat([pd.DataFrame(replay_rows[:, width:], columns=labels.columns), labels], ignore_index=True)
+        print(f"Replaying {len(replay_rows)} older rows.")
 
-torch.save({"state_dict": model.state_dict(), "norm_stats": norm_stats}, MODEL_PATH)
-print(f"Saved to {MODEL_PATH}")
+    model, report = tr.train_model(
+        model, train_inputs, train_labels, norm_stats, validation_split=args.validation_split, patience=args.patience,
+        accelerate=args.accelerate, bf16=args.bf16,
+    )
+    print(f"Trained at {tr.describe_throughput(report)}.")
+    if report["val_metrics"] is not None:
+        print(f"Ran {report['epochs_run']} epochs, kept epoch {report['best_epoch']} (val loss {report['val_metrics']['loss']:.4f}).")
+    if REPLAY_SIZE:
+        update_replay(replay, inputs, labels)
+
+    torch.save({"state_dict": model.state_dict(), "norm_stats": norm_stats, "watermark": watermark}, MODEL_PATH)
+    print(f"Saved to {MODEL_PATH}")
+    print(f"Exported inference model to {ex.export_inference_model(MODEL_PATH)}")
+
+if os.path.exists(MODEL_PATH):
+    store.put("centralised", round_number, MODEL_PATH)
+    print(f"Snapshot saved as round {round_number} in {ROUNDS_PATH}")
@@ -0,0 +1,212 @@
+"""
+Runs federated rounds locally without Docker: starts server.app in this process, splits the pooled
+dataset into one shard per client, and runs the clients' client.main() in a process pool whose
+workers each pin their torch thread count. Every round waits for the server to aggregate
+and reports wall-clock timings as JSON.
+
+    python run_local.py --clients 8 --rounds 5 --output rounds.json
+"""
+
+import os
+import sys
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(ROOT, "server")
+CLIENT_DIR = os.path.join(ROOT, "client")
+sys.path.append(ROOT)
+
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import multiprocessing
+from datetime import datetime
+
+import pandas as pd
+import requests
+import torch
+
+import shared.dataset as ds
+import shared.simulation as sm
+
+
+INPUTS_PATH = "server/data/inputs.csv"
+LABELS_PATH = "server/data/labels.csv"
+ROUND_TIMEOUT = 600
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, model_folder, min_models):
+    """
+    Import server.app in this process and serve it from a background thread.
+    """
+    os.environ["MODEL_FOLDER"] = model_folder
+    os.environ["MIN_MODELS_PER_ROUND"] = str(min_models)
+    os.chdir(SERVER_DIR)
+    sys.path.insert(0, SERVER_DIR)
+    from werkzeug.serving import make_server
+    import server
+
+    httpd = make_server("127.0.0.1", port, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd.shutdown
+
+
+def wait_healthy(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("Server did not become healthy")
+
+
+def wait_for_round(url, round_number, timeout=ROUND_TIMEOUT):
+    """
+    Block until the server has moved past round_number, returning the new status.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = requests.get(f"{url}/round_status").json()
+        if status["round"] > round_number:
+            return status
+        time.sleep(0.1)
+    raise TimeoutError(f"Round {round_number} was not aggregated within {timeout}s (last error: {status.get('last_error')})")
+
+
+def write_shards(dataset, shards, folder):
+    """
+    Write each client's rows as its own inputs/labels CSV pair, returning their paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    labels = dataset.labels()
+    paths = []
+    for i, rows in enumerate(shards):
+        inputs_path = os.path.join(folder, f"client_{i}_inputs.csv")
+        labels_path = os.path.join(folder, f"client_{i}_labels.csv")
+        pd.DataFrame(dataset.inputs[rows].numpy(), columns=dataset.input_columns).to_csv(inputs_path, index=False)
+        pd.DataFrame(labels[rows].numpy(), columns=dataset.label_columns).to_csv(labels_path, index=False)
+        paths.append((inputs_path, labels_path))
+    return paths
+
+
+def init_worker(server_url, threads):
+    """
+    Process pool initializer: point the client module at the local server and pin torch's threads.
+    """
+    os.environ["SERVER_URL"] = server_url
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    sys.path.insert(0, CLIENT_DIR)
+    import client  # noqa: F401, imported once per worker so torch and the client are warm for every round
+
+
+def run_client(task):
+    """
+    One client's round: stage its shard where client.py expects it and run client.main().
+    client.main() removes the CSVs only after a successful upload, so leftovers mean it failed.
+    """
+    import client
+
+    client_id, client_dir, inputs_path, labels_path = task
+    data_dir = os.path.join(client_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(client_dir)
+    shutil.copyfile(inputs_path, client.INPUTS_PATH)
+    shutil.copyfile(labels_path, client.LABELS_PATH)
+    client.CLIENT_ID = client_id
+
+    start = time.perf_counter()
+    with open(os.path.join(client_dir, "client.log"), "a") as log, contextlib.redirect_stdout(log):
+        client.main()
+    seconds = time.perf_counter() - start
+    return {"client_id": client_id, "seconds": seconds, "ok": not os.path.exists(client.INPUTS_PATH)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run federated rounds locally with a process pool of clients.")
+    parser.add_argument("--inputs", default=INPUTS_PATH)
+    parser.add_argument("--labels", default=LABELS_PATH)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--processes", type=int, default=None, help="pool size, defaults to min(clients, cores)")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per client, defaults to cores / processes")
+    parser.add_argument("--partition", choices=sm.PARTITIONS, default="contiguous")
+    parser.add_argument("--workdir", help="server models, shards and client logs go here (defaults to a temp folder)")
+    parser.add_argument("--output", help="write the JSON report here as well as printing it")
+    args = parser.parse_args()
+
+    inputs_path, labels_path = os.path.abspath(args.inputs), os.path.abspath(args.labels)
+    output_path = os.path.abspath(args.output) if args.output else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="fir-local-"))
+    cores = os.cpu_count() or 1
+    processes = args.processes or min(args.clients, cores)
+    threads = args.threads or max(1, cores // processes)
+
+    dataset = ds.load_csv_dataset(inputs_path, labels_path)
+    shards = sm.partition_rows(dataset.rows, args.clients, args.partition, torch.Generator().manual_seed(0))
+    shard_paths = write_shards(dataset, shards, os.path.join(workdir, "shards"))
+    tasks = [
+        (f"local-{i}", os.path.join(workdir, f"client_{i}"), *paths)
+        for i, paths in enumerate(shard_paths)
+    ]
+
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    shutdown = start_server(port, os.path.join(workdir, "models"), args.clients)
+    wait_healthy(url)
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Server on {url}, {args.clients} clients on {processes} processes x {threads} threads, logs in {workdir}", flush=True)
+
+    history = []
+    context = multiprocessing.get_context("spawn")  # the server's threads live in this process, so never fork it
+    try:
+        with context.Pool(processes, initializer=init_worker, initargs=(url, threads)) as pool:
+            for _ in range(args.rounds):
+                round_number = requests.get(f"{url}/round_status").json()["round"]
+                start = time.perf_counter()
+                results = pool.map(run_client, tasks, chunksize=1)
+                clients_done = time.perf_counter()
+
+                failed = [r["client_id"] for r in results if not r["ok"]]
+                if failed:
+                    raise RuntimeError(f"Round {round_number}: clients {failed} failed, see their client.log in {workdir}")
+                status = wait_for_round(url, round_number)
+                aggregated = time.perf_counter()
+
+                entry = {
+                    "round": round_number,
+                    "model_version": status["model_version"],
+                    "wall_seconds": aggregated - start,
+                    "clients_seconds": clients_done - start,
+                    "aggregate_wait_seconds": aggregated - clients_done,
+                    "client_seconds_max": max(r["seconds"] for r in results),
+                    "client_seconds_mean": sum(r["seconds"] for r in results) / len(results),
+                }
+                history.append(entry)
+                print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Round {round_number}: {json.dumps(entry)}", flush=True)
+    finally:
+        shutdown()
+
+    report = {
+        "config": {**vars(args), "processes": processes, "threads": threads, "workdir": workdir},
+        "rounds": history,
+    }
+    print(json.dumps(report, indent=2))
+    if output_path:
+        with open(output_path, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
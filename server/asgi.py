@@ -0,0 +1,181 @@
+"""
+Asyncio entry point serving the same contract as server.py, for many concurrent clients in one process:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Request bodies are streamed to disk as they arrive, so a slow upload only holds a coroutine,
+and blocking work (torch.load, hashing, SQLite) runs in the thread pool.
+Round state, the model cache and the aggregation worker are the ones server.py sets up.
+"""
+
+import os
+import tempfile
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import lib.metrics as me
+import server as sv
+
+import shared.encryption as en
+
+
+async def health(request):
+    try:
+        await run_in_threadpool(sv.ensure_global_model)
+        return JSONResponse({"status": "ready"}, status_code=200)
+    except Exception as e:
+        return JSONResponse({"status": "loading", "error": str(e)}, status_code=503)
+
+
+async def download_model(request):
+    """
+    Send the cached global model, or a 304 if the client's ETag is still current.
+    """
+    try:
+        await run_in_threadpool(sv.ensure_global_model)
+        fmt = "binary" if request.query_params.get("format") == "binary" else "base64"
+        encoding = en.negotiate(request.headers.get("accept-encoding"))
+        etag, encoded = await run_in_threadpool(sv.MODEL_CACHE.get, fmt, encoding)
+
+        headers = {"ETag": f'"{etag}"', **sv.transport_headers()}
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        me.BYTES_SENT.inc(len(encoded), format=fmt)
+        return Response(encoded, media_type=en.BINARY_MIMETYPE, headers=headers)
+
+    except Exception as e:
+        print(e, flush=True)
+        return PlainTextResponse(str(e), status_code=500)
+
+
+async def upload_model(request):
+    """
+    Stream a binary upload to disk, or read a multipart base64 upload, then validate and queue it off the event loop.
+    Binary bodies may be compressed (Content-Encoding) and carry an X-Upload-Id, so retries are answered without re-queuing.
+    """
+    try:
+        name, path = sv.new_upload_path()
+        client_id = request.headers.get("x-client-id")
+        upload_id = request.headers.get("x-upload-id")
+        content_type = request.headers.get("content-type", "")
+
+        reply = await run_in_threadpool(sv.known_upload, upload_id)
+        if reply is not None:
+            message, status = reply
+            return PlainTextResponse(message, status_code=status)
+
+        if content_type.split(";")[0].strip() == en.BINARY_MIMETYPE:
+            encoding = request.headers.get("content-encoding")
+            if encoding not in (None, "identity", *en.CONTENT_ENCODINGS):
+                return PlainTextResponse(f"Unsupported content encoding: {encoding}", status_code=415)
+            fd, tmp_path = tempfile.mkstemp(suffix=".pt", dir=sv.UPLOAD_TMP_FOLDER)
+            try:
+                with os.fdopen(fd, "wb") as file, me.STAGE_DURATION.time(stage="persist"):
+                    received = await stream_model_to_file(request, file, encoding)
+                me.BYTES_RECEIVED.inc(received, format="binary")
+                error = await run_in_threadpool(sv.accept_binary_upload, tmp_path, path)
+            except ValueError as e:
+                me.UPLOADS.inc(result="invalid")
+                error = f"Invalid model payload: {e}", 400
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        elif content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                return PlainTextResponse("No file uploaded", status_code=415)
+            encoded = await upload.read()
+            upload_id = None  # base64 uploads are re-serialised, so they can't match a payload checksum
+            error = await run_in_threadpool(sv.accept_base64_upload, encoded, path)
+        else:
+            return PlainTextResponse("No file uploaded", status_code=415)
+
+        if error is None:
+            error = await run_in_threadpool(sv.queue_upload, path, name, client_id, upload_id)
+        message, status = error
+        return PlainTextResponse(message, status_code=status)
+
+    except Exception as e:
+        print(e, flush=True)
+        return PlainTextResponse(str(e), status_code=500)
+
+
+async def round_status(request):
+    return JSONResponse(await run_in_threadpool(sv.build_round_status), status_code=200)
+
+
+async def metrics(request):
+    return Response(await run_in_threadpool(sv.render_metrics), media_type=me.CONTENT_TYPE)
+
+
+async def secure_advertise(request):
+    reply, status = await run_in_threadpool(sv.secure_advertise, await request.json())
+    return JSONResponse(reply, status_code=status)
+
+
+async def secure_roster(request):
+    reply, status = await run_in_threadpool(sv.secure_roster)
+    return JSONResponse(reply, status_code=status)
+
+
+async def secure_status(request):
+    round_number = request.query_params.get("round")
+    if round_number is None:
+        round_number = await run_in_threadpool(sv.COORDINATOR.current_round)
+    reply, status = await run_in_threadpool(sv.secure_round_state, int(round_number))
+    return JSONResponse(reply, status_code=status)
+
+
+async def secure_unmask(request):
+    reply, status = await run_in_threadpool(sv.secure_unmask, await request.json())
+    return JSONResponse(reply, status_code=status)
+
+
+async def stream_model_to_file(request, file, encoding=None):
+    """
+    Async counterpart of en.stream_model_to_file: decompress the body if it has a
+    Content-Encoding, validate the header and copy the payload to file as chunks arrive.
+    Chunks are gathered into en.CHUNK_SIZE blocks whose decompression and disk writes run in
+    the threadpool, so the event loop only ever receives. Returns the payload length.
+    """
+    writer = en.PayloadWriter(file)
+    sink = en.decoding_writer(writer, encoding)
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer += chunk
+        if len(buffer) >= en.CHUNK_SIZE:
+            await run_in_threadpool(sink.write, bytes(buffer))
+            buffer.clear()
+
+    def finish():
+        sink.write(bytes(buffer))
+        sink.flush()
+        return writer.finish()
+
+    return await run_in_threadpool(finish)
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")}
+    return etag in candidates or "*" in candidates
+
+
+app = Starlette(routes=[
+    Route("/health", health, methods=["GET"]),
+    Route("/download_model", download_model, methods=["GET"]),
+    Route("/upload_model", upload_model, methods=["POST"]),
+    Route("/round_status", round_status, methods=["GET"]),
+    Route("/metrics", metrics, methods=["GET"]),
+    Route("/secure/advertise", secure_advertise, methods=["POST"]),
+    Route("/secure/roster", secure_roster, methods=["GET"]),
+    Route("/secure/status", secure_status, methods=["GET"]),
+    Route("/secure/unmask", secure_unmask, methods=["POST"]),
+])
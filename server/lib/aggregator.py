@@ -0,0 +1,285 @@
+import os
+import shutil
+import time
+import socket
+import threading
+import traceback
+from datetime import datetime
+
+import torch
+
+import lib.coordinator as co
+import lib.federated as fe
+import lib.metrics as me
+
+
+class AggregationWorker(threading.Thread):
+    """
+    Background thread started in every server process.
+    Only the process holding the aggregator lease in the round coordinator folds
+    uploads, so round state has a single owner however many workers gunicorn runs.
+    Each upload is folded into a running aggregate as it arrives and the round is
+    finished once enough models have been folded, so no request pays the aggregation latency.
+    The current global model is kept in memory so delta uploads can be applied to it.
+
+    The mean is folded as uploads arrive; robust methods (median, trimmed mean, Krum) buffer the round's models.
+    In secure mode only pairwise-masked uploads are accepted and just their sum is unmasked.
+
+    Every aggregated global model is snapshotted by round in the model store, when one is given.
+
+    With an upstream client the worker acts as an edge aggregator: the global model is
+    synced from upstream, and each finished round is forwarded there as one weighted update.
+    """
+
+    def __init__(self, coordinator, output_path, min_models=3, weighting="norm", retain_folder=None,
+                 on_aggregate=None, poll_interval=0.5, lease_ttl=30, upstream=None, sync_interval=5, store=None,
+                 method="mean", trim_ratio=0.1, byzantine=1, secure=False, secure_timeout=120):
+        super().__init__(name="aggregation-worker", daemon=True)
+        self.coordinator = coordinator
+        self.output_path = output_path
+        self.min_models = min_models
+        self.weighting = weighting
+        self.method = method
+        self.trim_ratio = trim_ratio
+        self.byzantine = byzantine
+        self.secure = secure
+        self.secure_timeout = secure_timeout
+        self.retain_folder = retain_folder
+        self.on_aggregate = on_aggregate
+        self.poll_interval = poll_interval
+        self.lease_ttl = lease_ttl
+        self.upstream = upstream
+        self.sync_interval = sync_interval
+        self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._wake = threading.Event()
+        self._running = None
+        self._running_round = None
+        self._global_state = None
+        self._global_mtime = None
+        self._version = 0
+        self._last_sync = 0.0
+        self.last_error = None
+
+    def notify(self):
+        """
+        Wake the worker after an upload was registered, instead of waiting for the next poll.
+        """
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self._step()
+            except Exception as e:
+                traceback.print_exc()
+                self.last_error = str(e)
+
+    def _still_leader(self, round_number):
+        """
+        Renew the lease before each long stage (a fold, finalising, writing the model), so a step that runs
+        past lease_ttl never overlaps with a new leader. Returns False, dropping the running round, if the
+        lease was lost or another leader already moved past round_number.
+        """
+        if self.coordinator.acquire_lease(co.AGGREGATOR_LEASE, self.owner, self.lease_ttl) \
+                and self.coordinator.current_round() == round_number:
+            return True
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] No longer leading round {round_number}, dropping its running aggregate", flush=True)
+        self._running = None
+        return False
+
+    def _step(self):
+        if not self.coordinator.acquire_lease(co.AGGREGATOR_LEASE, self.owner, self.lease_ttl):
+            # Another process leads; drop local state so it is rebuilt if leadership comes back
+            self._running = None
+            return
+
+        if self.upstream is not None and time.monotonic() - self._last_sync > self.sync_interval:
+            self._last_sync = time.monotonic()
+            if self.upstream.sync(self.output_path) and self.on_aggregate is not None:
+                self.on_aggregate()
+
+        # A new global model (from upstream, or written by a previous leader) invalidates the running round
+        if os.path.getmtime(self.output_path) != self._global_mtime:
+            self._running = None
+
+        round_number = self.coordinator.current_round()
+        if self._running is None or self._running_round != round_number:
+            if not self._start_round(round_number):
+                return
+
+        if self.secure:
+            self._step_secure(round_number)
+            return
+
+        for upload_id, path in self.coordinator.pending_uploads(round_number):
+            if self._running.count >= self.min_models:
+                break
+            if not self._still_leader(round_number):
+                return
+            self._fold(upload_id, path)
+
+        if self._running.count >= self.min_models:
+            self._aggregate(round_number)
+
+    def _fold(self, upload_id, path):
+        try:
+            with me.STAGE_DURATION.time(stage="fold"):
+                self._running.add_file(path, self._global_state, self._version)
+        except fe.StaleUpdateError as e:
+            print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Rejected {os.path.basename(path)}: {e}", flush=True)
+            self.coordinator.mark_upload(upload_id, "rejected")
+            os.remove(path)
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.last_error = f"{os.path.basename(path)}: {e}"
+            self.coordinator.mark_upload(upload_id, "failed")
+            return
+
+        self.coordinator.mark_upload(upload_id, "folded")
+
+    def _step_secure(self, round_number):
+        """
+        A secure round waits for min_models clients to advertise keys, then sums their masked uploads.
+        Roster members still missing after secure_timeout are marked as dropped, and the round is
+        unmasked once every survivor has revealed its seeds with them.
+        A round that can't be unmasked is aborted, so the roster frees up for the next one: fewer than
+        two survivors after secure_timeout, or survivors still missing seeds another secure_timeout later.
+        """
+        roster = self.coordinator.secure_roster(round_number, self.min_models)
+        if roster is None:
+            return
+        self._running.roster, closed_at = roster
+        self._running.dropped = self.coordinator.dropouts(round_number)
+
+        for upload_id, path in self.coordinator.pending_uploads(round_number):
+            if not self._still_leader(round_number):
+                return
+            self._fold(upload_id, path)
+
+        survivors = self._running.clients
+        waited = time.time() - closed_at
+        if not self._running.dropped:
+            if len(survivors) == len(self._running.roster):
+                self._aggregate(round_number)
+            elif waited > self.secure_timeout:
+                if len(survivors) < 2:
+                    # A single survivor's sum would be its own update, so at least two are needed to unmask
+                    self._abort(round_number, f"only {len(survivors)} of {len(self._running.roster)} clients uploaded")
+                    return
+                missing = set(self._running.roster) - survivors
+                self.coordinator.mark_dropouts(round_number, missing)
+                print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Round {round_number}: {len(missing)} clients dropped, waiting for seeds", flush=True)
+            return
+
+        revealed = self.coordinator.revealed_seeds(round_number)
+        needed = {(survivor, dropped) for survivor in survivors for dropped in self._running.dropped}
+        if needed <= revealed.keys():
+            self._aggregate(round_number, {pair: revealed[pair] for pair in needed})
+        elif waited > 2 * self.secure_timeout:
+            silent = {survivor for survivor, _ in needed - revealed.keys()}
+            self._abort(round_number, f"{len(silent)} survivors never revealed their seeds")
+
+    def _abort(self, round_number, reason):
+        """
+        Give up on a round that can't be aggregated and move on to the next one.
+        """
+        if not self._still_leader(round_number):
+            return
+        next_round = self.coordinator.abort_round(round_number)
+        for path in self.coordinator.round_uploads(round_number, "rejected"):
+            if os.path.exists(path):
+                os.remove(path)
+        self._cleanup(round_number)
+        self._running = self._new_aggregate(next_round)
+        self._running_round = next_round
+        self.last_error = f"Round {round_number} aborted: {reason}"
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Round {round_number} aborted: {reason}", flush=True)
+
+    def _start_round(self, round_number):
+        """
+        Rebuild the running aggregate for a round, e.g. after taking over leadership.
+        Returns False if the round turned out to be already aggregated.
+        """
+        self._global_mtime = os.path.getmtime(self.output_path)
+        self._global_state, self._version = self._load_global()
+        if self.upstream is None and self._version >= round_number:
+            # The previous leader wrote this round's model but didn't get to close the round
+            self.coordinator.complete_round(round_number)
+            self._cleanup(round_number)
+            self._running = None
+            return False
+
+        self.coordinator.requeue_folded(round_number)
+        self._running = self._new_aggregate(round_number)
+        self._running_round = round_number
+        return True
+
+    def _new_aggregate(self, round_number):
+        if self.secure:
+            return fe.SecureAggregate(round_number)
+        return fe.make_aggregate(self.method, self.weighting, trim_ratio=self.trim_ratio, byzantine=self.byzantine)
+
+    def _load_global(self):
+        if not os.path.exists(self.output_path):
+            return None, 0
+        bundle = torch.load(self.output_path, map_location="cpu", weights_only=True)
+        state_dict = bundle["state_dict"] if "state_dict" in bundle else bundle
+        return state_dict, fe.bundle_version(bundle)
+
+    def _aggregate(self, round_number, revealed_seeds=None):
+        if not self._still_leader(round_number):
+            return
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Enough models to aggregate!", flush=True)
+
+        started = time.perf_counter()
+        if self.secure:
+            agg_state_dict, avg_norm_stats = self._running.finalize(self._global_state, revealed_seeds)
+        else:
+            agg_state_dict, avg_norm_stats = self._running.finalize()
+        if not self._still_leader(round_number):
+            return
+        if self.upstream is not None:
+            reply = self.upstream.forward(
+                agg_state_dict, avg_norm_stats, self._running.contribution(), self._global_state, self._version
+            )
+            print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Forwarded round {round_number} upstream: {reply}", flush=True)
+        else:
+            fe.save_aggregate(agg_state_dict, avg_norm_stats, self.output_path, version=round_number)
+            if self.store is not None:
+                self.store.put("federated", round_number, self.output_path)
+            self._global_state = agg_state_dict
+            self._version = round_number
+            self._global_mtime = os.path.getmtime(self.output_path)
+            if self.on_aggregate is not None:
+                self.on_aggregate()
+
+        me.STAGE_DURATION.observe(time.perf_counter() - started, stage="aggregate")
+        me.ROUND_UPLOADS.observe(self._running.count)
+
+        next_round = self.coordinator.complete_round(round_number)
+        self._cleanup(round_number)
+        self._running = self._new_aggregate(next_round)
+        self._running_round = next_round
+        self.last_error = None
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Round {round_number} aggregated", flush=True)
+
+    def _cleanup(self, round_number):
+        """
+        Folded uploads are kept until their round closes so a new leader can re-fold them;
+        afterwards they are deleted, or moved aside when retention is on.
+        """
+        for state in ("folded", "failed"):
+            for path in self.coordinator.round_uploads(round_number, state):
+                if not os.path.exists(path):
+                    continue
+                if self.retain_folder is not None:
+                    round_folder = os.path.join(self.retain_folder, f"round{round_number}")
+                    os.makedirs(round_folder, exist_ok=True)
+                    shutil.move(path, os.path.join(round_folder, os.path.basename(path)))
+                else:
+                    os.remove(path)
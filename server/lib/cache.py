@@ -0,0 +1,73 @@
+import io
+import os
+import hashlib
+import threading
+
+import lib.federated as fe
+import lib.metrics as me
+import shared.encryption as en
+
+
+class ModelCache:
+    """
+    In-process cache of the encoded global model.
+    Entries are keyed by the model file's mtime and size, so a model written by
+    another worker process is picked up without explicit invalidation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._key = None
+        self._raw = None
+        self._digest = None
+        self._version = 0
+        self._encoded = {}
+
+    def invalidate(self):
+        """
+        Drop cached bytes, forcing the next request to re-read the model file.
+        """
+        with self._lock:
+            self._key = None
+            self._raw = None
+            self._digest = None
+            self._encoded = {}
+
+    def _refresh(self):
+        stat = os.stat(self.path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key != self._key:
+            with open(self.path, "rb") as file:
+                self._raw = file.read()
+            self._key = key
+            self._digest = hashlib.sha256(self._raw).hexdigest()[:32]
+            self._version = fe.bundle_version(en.load_model_file(io.BytesIO(self._raw)))
+            self._encoded = {}
+
+    def version(self):
+        """
+        Version of the current global model, read once per model file.
+        """
+        with self._lock:
+            self._refresh()
+            return self._version
+
+    def get(self, fmt="base64", encoding=None):
+        """
+        Return (etag, encoded bytes) of the current global model in the given format,
+        compressed with encoding (one of en.CONTENT_ENCODINGS) if given.
+        """
+        with self._lock:
+            self._refresh()
+            if fmt not in self._encoded:
+                with me.STAGE_DURATION.time(stage="encode"):
+                    self._encoded[fmt] = en.encode_saved_model(self._raw, binary=(fmt == "binary"))
+            if encoding is None:
+                return f"{self._digest}-{fmt}", self._encoded[fmt]
+
+            key = f"{fmt}-{encoding}"
+            if key not in self._encoded:
+                with me.STAGE_DURATION.time(stage="encode"):
+                    self._encoded[key] = en.compress(self._encoded[fmt], encoding)
+            return f"{self._digest}-{key}", self._encoded[key]
@@ -0,0 +1,344 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+
+AGGREGATOR_LEASE = "aggregator"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rounds (
+    round         INTEGER PRIMARY KEY,
+    state         TEXT NOT NULL DEFAULT 'open',
+    opened_at     REAL NOT NULL,
+    aggregated_at REAL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    round      INTEGER NOT NULL,
+    client_id  TEXT,
+    checksum   TEXT NOT NULL,
+    path       TEXT NOT NULL,
+    state      TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    UNIQUE (round, checksum)
+);
+CREATE INDEX IF NOT EXISTS uploads_round_state ON uploads (round, state);
+CREATE INDEX IF NOT EXISTS uploads_checksum ON uploads (checksum);
+CREATE TABLE IF NOT EXISTS leases (
+    name       TEXT PRIMARY KEY,
+    owner      TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS secure_keys (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    round         INTEGER NOT NULL,
+    client_id     TEXT NOT NULL,
+    public_key    TEXT NOT NULL,
+    advertised_at REAL NOT NULL,
+    UNIQUE (round, client_id)
+);
+CREATE TABLE IF NOT EXISTS secure_dropouts (
+    round     INTEGER NOT NULL,
+    client_id TEXT NOT NULL,
+    PRIMARY KEY (round, client_id)
+);
+CREATE TABLE IF NOT EXISTS secure_seeds (
+    round     INTEGER NOT NULL,
+    client_id TEXT NOT NULL,
+    peer_id   TEXT NOT NULL,
+    seed      TEXT NOT NULL,
+    PRIMARY KEY (round, client_id, peer_id)
+);
+"""
+
+
+class RoundCoordinator:
+    """
+    Round state shared by every server worker process through a local SQLite index.
+    Tracks rounds, pending uploads (client id, checksum, path) and the aggregation lease,
+    with every transition done in a single transaction.
+    """
+
+    def __init__(self, db_path, initial_round=1):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+        with self._transaction() as conn:
+            if conn.execute("SELECT COUNT(*) FROM rounds").fetchone()[0] == 0:
+                conn.execute("INSERT INTO rounds (round, opened_at) VALUES (?, ?)", (initial_round, time.time()))
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    def current_round(self) -> int:
+        """
+        Number of the round currently collecting uploads.
+        """
+        conn = self._connection()
+        return conn.execute("SELECT MAX(round) FROM rounds WHERE state = 'open'").fetchone()[0]
+
+    def register_upload(self, path, checksum, client_id=None):
+        """
+        Record an upload against the open round.
+        Returns (upload_id, round, duplicate); a checksum already pending or folded in any round is a duplicate,
+        so a retried upload whose first attempt made it in is never counted again in a later round.
+        A checksum that was rejected or failed before is queued again in place of the old record.
+        """
+        with self._transaction() as conn:
+            round_number = conn.execute("SELECT MAX(round) FROM rounds WHERE state = 'open'").fetchone()[0]
+            existing = conn.execute(
+                "SELECT id, round FROM uploads WHERE checksum = ? AND state IN ('pending', 'folded')", (checksum,)
+            ).fetchone()
+            if existing is not None:
+                return existing[0], existing[1], True
+
+            # Only the open round's row would collide with UNIQUE (round, checksum); older rounds keep their history
+            superseded = [row[0] for row in conn.execute(
+                "SELECT path FROM uploads WHERE round = ? AND checksum = ? AND state IN ('rejected', 'failed')",
+                (round_number, checksum),
+            )]
+            conn.execute(
+                "DELETE FROM uploads WHERE round = ? AND checksum = ? AND state IN ('rejected', 'failed')",
+                (round_number, checksum),
+            )
+            for old_path in superseded:
+                if old_path != path and os.path.exists(old_path):
+                    os.remove(old_path)
+            cursor = conn.execute(
+                "INSERT INTO uploads (round, client_id, checksum, path, created_at) VALUES (?, ?, ?, ?, ?)",
+                (round_number, client_id, checksum, path, time.time()),
+            )
+            return cursor.lastrowid, round_number, False
+
+    def find_upload(self, checksum):
+        """
+        Round an upload with this checksum is pending or folded in, or None.
+        Rejected and failed uploads don't count, so they can be sent again.
+        """
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT round FROM uploads WHERE checksum = ? AND state IN ('pending', 'folded')", (checksum,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def pending_uploads(self, round_number):
+        """
+        Uploads of a round that still need folding, oldest first, as (id, path) rows.
+        """
+        conn = self._connection()
+        return conn.execute(
+            "SELECT id, path FROM uploads WHERE round = ? AND state = 'pending' ORDER BY id", (round_number,)
+        ).fetchall()
+
+    def round_uploads(self, round_number, state):
+        """
+        Paths of a round's uploads in the given state.
+        """
+        conn = self._connection()
+        return [row[0] for row in conn.execute(
+            "SELECT path FROM uploads WHERE round = ? AND state = ? ORDER BY id", (round_number, state)
+        )]
+
+    def mark_upload(self, upload_id, state):
+        """
+        Move an upload to 'folded', 'rejected' or 'failed'.
+        """
+        with self._transaction() as conn:
+            conn.execute("UPDATE uploads SET state = ? WHERE id = ?", (state, upload_id))
+
+    def requeue_folded(self, round_number):
+        """
+        Put a round's folded uploads back to pending, used when a new leader rebuilds the running aggregate.
+        """
+        with self._transaction() as conn:
+            conn.execute("UPDATE uploads SET state = 'pending' WHERE round = ? AND state = 'folded'", (round_number,))
+
+    def complete_round(self, round_number):
+        """
+        Close a round and open the next one, carrying over uploads that were never folded.
+        Returns the new round number.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE rounds SET state = 'aggregated', aggregated_at = ? WHERE round = ? AND state = 'open'",
+                (now, round_number),
+            ).rowcount
+            if updated != 1:
+                raise RuntimeError(f"Round {round_number} is not open")
+            conn.execute("INSERT INTO rounds (round, opened_at) VALUES (?, ?)", (round_number + 1, now))
+            conn.execute(
+                "UPDATE uploads SET round = ? WHERE round = ? AND state = 'pending'", (round_number + 1, round_number)
+            )
+            return round_number + 1
+
+    def abort_round(self, round_number):
+        """
+        Give up on a round without aggregating it: its uploads are rejected instead of carried over,
+        its secure-aggregation roster, dropouts and seeds are cleared, and the next round is opened.
+        Returns the new round number.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE rounds SET state = 'aborted', aggregated_at = ? WHERE round = ? AND state = 'open'",
+                (now, round_number),
+            ).rowcount
+            if updated != 1:
+                raise RuntimeError(f"Round {round_number} is not open")
+            conn.execute("INSERT INTO rounds (round, opened_at) VALUES (?, ?)", (round_number + 1, now))
+            conn.execute(
+                "UPDATE uploads SET state = 'rejected' WHERE round = ? AND state IN ('pending', 'folded')", (round_number,)
+            )
+            for table in ("secure_keys", "secure_dropouts", "secure_seeds"):
+                conn.execute(f"DELETE FROM {table} WHERE round = ?", (round_number,))
+            return round_number + 1
+
+    def round_state(self, round_number):
+        """
+        'open', 'aggregated' or 'aborted', or None for a round that was never opened.
+        """
+        conn = self._connection()
+        row = conn.execute("SELECT state FROM rounds WHERE round = ?", (round_number,)).fetchone()
+        return None if row is None else row[0]
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Take or renew a named lease. Returns True if owner holds it afterwards.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now),
+            )
+            row = conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+            return row is not None and row[0] == owner
+
+    def advertise_key(self, client_id, public_key, roster_size):
+        """
+        Add a client's public key to the open round's secure-aggregation roster.
+        The roster closes once it holds roster_size keys. Returns (round, accepted).
+        """
+        with self._transaction() as conn:
+            round_number = conn.execute("SELECT MAX(round) FROM rounds WHERE state = 'open'").fetchone()[0]
+            existing = conn.execute(
+                "SELECT 1 FROM secure_keys WHERE round = ? AND client_id = ?", (round_number, client_id)
+            ).fetchone()
+            if existing is not None:
+                return round_number, True
+
+            count = conn.execute("SELECT COUNT(*) FROM secure_keys WHERE round = ?", (round_number,)).fetchone()[0]
+            if count >= roster_size:
+                return round_number, False
+            conn.execute(
+                "INSERT INTO secure_keys (round, client_id, public_key, advertised_at) VALUES (?, ?, ?, ?)",
+                (round_number, client_id, public_key, time.time()),
+            )
+            return round_number, True
+
+    def secure_roster(self, round_number, roster_size):
+        """
+        The closed roster of a round as ({client_id: public_key}, closed_at), or None while keys are still coming in.
+        """
+        conn = self._connection()
+        rows = conn.execute(
+            "SELECT client_id, public_key, advertised_at FROM secure_keys WHERE round = ? ORDER BY id LIMIT ?",
+            (round_number, roster_size),
+        ).fetchall()
+        if len(rows) < roster_size:
+            return None
+        return {client_id: public_key for client_id, public_key, _ in rows}, rows[-1][2]
+
+    def mark_dropouts(self, round_number, client_ids):
+        """
+        Record roster members that never uploaded, so survivors reveal their seeds with them.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO secure_dropouts (round, client_id) VALUES (?, ?)",
+                [(round_number, client_id) for client_id in client_ids],
+            )
+
+    def dropouts(self, round_number):
+        """
+        Roster members of a round marked as dropped out.
+        """
+        conn = self._connection()
+        return {row[0] for row in conn.execute("SELECT client_id FROM secure_dropouts WHERE round = ?", (round_number,))}
+
+    def submit_seeds(self, round_number, client_id, seeds):
+        """
+        Store the pairwise seeds a survivor revealed for its dropped peers, as {peer_id: hex seed}.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO secure_seeds (round, client_id, peer_id, seed) VALUES (?, ?, ?, ?)",
+                [(round_number, client_id, peer_id, seed) for peer_id, seed in seeds.items()],
+            )
+
+    def revealed_seeds(self, round_number):
+        """
+        Seeds revealed for a round, as {(survivor id, dropped id): seed bytes}.
+        """
+        conn = self._connection()
+        return {
+            (client_id, peer_id): bytes.fromhex(seed)
+            for client_id, peer_id, seed in conn.execute(
+                "SELECT client_id, peer_id, seed FROM secure_seeds WHERE round = ?", (round_number,)
+            )
+        }
+
+    def status(self) -> dict:
+        """
+        Round state as recorded in the index.
+        """
+        conn = self._connection()
+        round_number = self.current_round()
+        counts = dict(conn.execute(
+            "SELECT state, COUNT(*) FROM uploads WHERE round = ? GROUP BY state", (round_number,)
+        ).fetchall())
+        last_aggregated_at = conn.execute("SELECT MAX(aggregated_at) FROM rounds").fetchone()[0]
+        leader = conn.execute(
+            "SELECT owner FROM leases WHERE name = ? AND expires_at > ?", (AGGREGATOR_LEASE, time.time())
+        ).fetchone()
+        return {
+            "round": round_number,
+            "model_version": round_number - 1,
+            "pending": counts.get("pending", 0),
+            "folded": counts.get("folded", 0),
+            "rejected_stale": counts.get("rejected", 0),
+            "failed": counts.get("failed", 0),
+            "last_aggregated_at": datetime.fromtimestamp(last_aggregated_at).isoformat(timespec="seconds") if last_aggregated_at else None,
+            "aggregator": leader[0] if leader else None,
+        }
+
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE ... COMMIT, so concurrent writers from other processes serialise on the database lock.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
@@ -0,0 +1,55 @@
+import socket
+import requests
+
+import lib.federated as fe
+import shared.delta as dl
+import shared.encryption as en
+
+
+class UpstreamClient:
+    """
+    Link from an edge aggregator to the server above it, using the same
+    /download_model and /upload_model API as regular clients.
+    """
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.edge_id = f"edge-{socket.gethostname()}"
+        self.session = requests.Session()
+        self._etag = None
+
+    def sync(self, output_path) -> bool:
+        """
+        Fetch the upstream global model if it changed since the last sync.
+        Returns True if a new model was written to output_path.
+        """
+        headers = {"If-None-Match": self._etag} if self._etag else {}
+        response = self.session.get(
+            f"{self.url}/download_model", params={"format": "binary"}, headers=headers, timeout=self.timeout
+        )
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+
+        fe.save_atomic(en.decode_model(response.content), output_path)
+        self._etag = response.headers.get("ETag")
+        return True
+
+    def forward(self, agg_state_dict, avg_norm_stats, contribution, base_state_dict, base_version):
+        """
+        Send the edge's pre-aggregated model upstream as one weighted delta update.
+        """
+        bundle = {
+            "delta": dl.encode_delta(agg_state_dict, base_state_dict, base_version, quantize="fp32"),
+            "norm_stats": avg_norm_stats,
+            "aggregate": contribution,
+        }
+        response = self.session.post(
+            f"{self.url}/upload_model",
+            data=en.encode_model_binary(bundle),
+            headers={"Content-Type": en.BINARY_MIMETYPE, "X-Client-Id": self.edge_id},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.text
@@ -1,49 +1,528 @@
 import os
 import torch
-from collections import OrderedDict
+
+import shared.delta as dl
+import shared.secure as sc
+import shared.stats as ns
 
 
 MODEL_FOLDER = "models"
 os.makedirs(MODEL_FOLDER, exist_ok=True)
 FEDERATED_MODEL_PATH = os.path.join(MODEL_FOLDER, "federated_model.pkl")
-    
 
-def aggregate_models(input_model_paths, output_path, epsilon=0.01):
+WEIGHTINGS = ("norm", "samples")
+METHODS = ("mean", "median", "trimmed_mean", "krum", "multi_krum")
+NORM_STAT_KEYS = ns.NORM_STAT_KEYS
+
+
+def save_atomic(obj, output_path):
     """
-    Aggregate given models and save new model to given path.
-    Norm stats are averaged across clients and embedded in the output bundle.
+    Save to a temp file then rename, so readers never see a half-written model.
     """
-    models = []
-    all_norm_stats = []
-    for path in input_model_paths:
-        loaded = torch.load(path, map_location="cpu", weights_only=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+class StaleUpdateError(ValueError):
+    """
+    Raised when a delta update was computed against an older global model version.
+    """
+
+
+def load_bundle(path):
+    """
+    Load a saved model, returning (state_dict, norm_stats). norm_stats is None for bare state_dicts.
+    """
+    loaded = torch.load(path, map_location="cpu", weights_only=True)
+    if "state_dict" in loaded:
+        return loaded["state_dict"], loaded.get("norm_stats")
+    return loaded, None
+
+
+def bundle_version(bundle):
+    """
+    Global model version stored in a bundle. Bare state_dicts are the initial version 0.
+    """
+    return int(bundle.get("version", 0)) if "state_dict" in bundle else 0
+
+
+def load_update(path, base_state_dict, base_version):
+    """
+    Load a client or edge upload, returning (state_dict, norm_stats, contribution).
+    Delta uploads are applied to the given global model and rejected if computed against another version.
+    contribution is only set for pre-aggregated updates forwarded by an edge aggregator.
+    """
+    loaded = torch.load(path, map_location="cpu", weights_only=True)
+    if "delta" not in loaded:
         if "state_dict" in loaded:
-            models.append(loaded["state_dict"])
-            all_norm_stats.append(loaded["norm_stats"])
+            return loaded["state_dict"], loaded.get("norm_stats"), loaded.get("aggregate")
+        return loaded, None, None
+
+    delta = loaded["delta"]
+    if delta["base_version"] != base_version:
+        raise StaleUpdateError(f"Delta computed against version {delta['base_version']}, current is {base_version}")
+    return dl.apply_delta(delta, base_state_dict), loaded.get("norm_stats"), loaded.get("aggregate")
+
+
+def stack_state_dicts(state_dicts):
+    """
+    Stack client state_dicts into a (clients, parameters) matrix sharing one layout.
+    """
+    flats = []
+    layout = None
+    for state_dict in state_dicts:
+        flat, model_layout = dl.flatten_state_dict(state_dict)
+        if layout is None:
+            layout = model_layout
+        elif model_layout != layout:
+            raise ValueError("Client models do not share the same architecture")
+        flats.append(flat)
+    return torch.stack(flats), layout
+
+
+def client_weights(stacked, norm_stats_list, weighting="norm", epsilon=0.01):
+    """
+    Per-client aggregation weights:
+      - norm: L2 norm of each client's parameters (plus epsilon to avoid zero)
+      - samples: number of local training samples reported in the norm stats
+    """
+    if weighting == "norm":
+        return torch.linalg.vector_norm(stacked, dim=1) + epsilon
+    if weighting == "samples":
+        counts = [float((stats or {}).get("num_samples", 1)) for stats in norm_stats_list]
+        return torch.tensor(counts, dtype=stacked.dtype)
+    raise ValueError(f"Unknown weighting: {weighting}, expected one of {WEIGHTINGS}")
+
+
+def weighted_average(stacked, weights):
+    """
+    Reduce stacked client vectors into one weighted average with a single matmul.
+    """
+    return (weights @ stacked) / weights.sum()
+
+
+def coordinate_median(stacked):
+    """
+    Coordinate-wise median of stacked client vectors, averaging the two middle values for even cohorts.
+    torch.median returns the lower middle value, so the upper one is the negated median of the negation.
+    """
+    columns = stacked.T.contiguous()
+    lower = columns.median(dim=1).values
+    if stacked.shape[0] % 2:
+        return lower
+    upper = -(-columns).median(dim=1).values
+    return (lower + upper) / 2
+
+
+def trimmed_mean(stacked, trim_ratio=0.1):
+    """
+    Coordinate-wise mean after dropping the trim_ratio largest and smallest values of every coordinate.
+    Only the trimmed tails are selected with topk, so the cohort is never fully sorted.
+    """
+    n = stacked.shape[0]
+    k = min(int(trim_ratio * n), (n - 1) // 2)
+    total = stacked.sum(dim=0)
+    if k:
+        total -= stacked.topk(k, dim=0).values.sum(dim=0) + stacked.topk(k, dim=0, largest=False).values.sum(dim=0)
+    return total / (n - 2 * k)
+
+
+def krum_select(stacked, byzantine=1, num_selected=1):
+    """
+    Indices of the num_selected clients with the lowest Krum scores, i.e. the smallest summed squared
+    distance to their n - byzantine - 2 nearest neighbours. Distances come from one Gram matrix.
+    byzantine is clamped so that n > 2 * byzantine + 2 holds for small cohorts.
+    """
+    n = stacked.shape[0]
+    if n == 1:
+        return torch.zeros(1, dtype=torch.long)
+
+    byzantine = max(0, min(byzantine, (n - 3) // 2))
+    neighbours = max(n - byzantine - 2, 1)
+
+    stacked = stacked - stacked.mean(dim=0)  # centring keeps the Gram expansion accurate in float32
+    sq_norms = (stacked * stacked).sum(dim=1)
+    distances = (sq_norms[:, None] + sq_norms[None, :] - 2 * stacked @ stacked.T).clamp_(min=0)
+    distances.fill_diagonal_(float("inf"))
+    scores = distances.topk(neighbours, dim=1, largest=False).values.sum(dim=1)
+    return scores.topk(min(num_selected, n), largest=False).indices
+
+
+def robust_reduce(stacked, weights, method="mean", trim_ratio=0.1, byzantine=1):
+    """
+    Reduce stacked client vectors with the given method.
+    Returns (vector, selected): selected holds the client indices Krum kept, or None for the other methods.
+    mean and (multi-)Krum use the client weights, median and trimmed mean treat clients equally.
+    """
+    if method == "mean":
+        return weighted_average(stacked, weights), None
+    if method == "median":
+        return coordinate_median(stacked), None
+    if method == "trimmed_mean":
+        return trimmed_mean(stacked, trim_ratio), None
+    if method in ("krum", "multi_krum"):
+        num_selected = 1 if method == "krum" else stacked.shape[0] - max(byzantine, 0)
+        selected = krum_select(stacked, byzantine, max(num_selected, 1))
+        return weighted_average(stacked[selected], weights[selected]), selected
+    raise ValueError(f"Unknown aggregation method: {method}, expected one of {METHODS}")
+
+
+def average_norm_stats(all_norm_stats, weights=None):
+    """
+    Average norm stats across clients, optionally weighted.
+    Only used for stats without a sample count, which can't be merged exactly (see merge_or_average_norm_stats).
+    """
+    n = len(all_norm_stats)
+    if weights is None:
+        weights = torch.ones(n, dtype=torch.float64)
+    weights = weights.to(torch.float64) / weights.sum()
+
+    avg_norm_stats = {}
+    for key in NORM_STAT_KEYS:
+        values = torch.tensor([s[key] for s in all_norm_stats], dtype=torch.float64)
+        avg = weights @ values
+        avg_norm_stats[key] = avg.tolist() if avg.dim() else avg.item()
+
+    if all("num_samples" in s for s in all_norm_stats):
+        avg_norm_stats["num_samples"] = int(sum(s["num_samples"] for s in all_norm_stats))
+    return avg_norm_stats
+
+
+def merge_or_average_norm_stats(all_norm_stats, weights=None):
+    """
+    Pooled norm stats of every client's data when they all carry sample counts (exact Chan merge),
+    otherwise the previous (weighted) average.
+    """
+    if all(ns.mergeable(s) for s in all_norm_stats):
+        return ns.merge_norm_stats(all_norm_stats)
+    return average_norm_stats(all_norm_stats, weights)
+
+
+def robust_norm_stats(norm_stats_list, method="median", trim_ratio=0.1):
+    """
+    Combine norm stats with the same coordinate-wise rule used for the weights, so one bad session can't skew them.
+    """
+    combined = {}
+    for key in NORM_STAT_KEYS:
+        values = torch.tensor([s[key] for s in norm_stats_list], dtype=torch.float64)
+        values = values if values.dim() > 1 else values.unsqueeze(1)
+        reduced = coordinate_median(values) if method == "median" else trimmed_mean(values, trim_ratio)
+        combined[key] = reduced.tolist() if isinstance(norm_stats_list[0][key], (list, tuple)) else reduced.item()
+
+    if all("num_samples" in s for s in norm_stats_list):
+        combined["num_samples"] = int(sum(s["num_samples"] for s in norm_stats_list))
+    return combined
+
+
+def aggregate_state_dicts(state_dicts, norm_stats_list=None, weighting="norm", epsilon=0.01,
+                          method="mean", trim_ratio=0.1, byzantine=1):
+    """
+    Aggregate in-memory client state_dicts, returning (state_dict, norm_stats).
+    method picks the reduction: weighted mean, or a robust median, trimmed_mean, krum or multi_krum.
+    """
+    if norm_stats_list is None:
+        norm_stats_list = [None] * len(state_dicts)
+
+    stacked, layout = stack_state_dicts(state_dicts)
+    weights = client_weights(stacked, norm_stats_list, weighting=weighting, epsilon=epsilon)
+    reduced, selected = robust_reduce(stacked, weights, method, trim_ratio, byzantine)
+    agg_state_dict = dl.unflatten_state_dict(reduced, layout)
+
+    if selected is not None:
+        # Krum drops the rejected clients' stats along with their weights
+        keep = set(selected.tolist())
+        norm_stats_list = [s if i in keep else None for i, s in enumerate(norm_stats_list)]
+
+    present = [i for i, s in enumerate(norm_stats_list) if s is not None]
+    if not present:
+        return agg_state_dict, None
+
+    if method in ("median", "trimmed_mean"):
+        return agg_state_dict, robust_norm_stats([norm_stats_list[i] for i in present], method, trim_ratio)
+
+    # Without sample counts, norm weighting falls back to a plain mean and sample weighting to a weighted one
+    stats_weights = weights[present] if weighting == "samples" else None
+    return agg_state_dict, merge_or_average_norm_stats([norm_stats_list[i] for i in present], stats_weights)
+
+
+class RunningAggregate:
+    """
+    Streaming aggregator that folds each client model into a running weighted sum
+    as it arrives. Memory stays O(model size) no matter how many clients take part.
+    """
+
+    def __init__(self, weighting="norm", epsilon=0.01):
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f"Unknown weighting: {weighting}, expected one of {WEIGHTINGS}")
+        self.weighting = weighting
+        self.epsilon = epsilon
+        self.count = 0
+        self.layout = None
+        self.weighted_sum = None
+        self.total_weight = 0.0
+
+        self._stats_sums = {}
+        self._stats_weight = 0.0
+        self._num_samples = 0
+        self._input_stats = ns.RunningStats()
+        self._tilt_stats = ns.RunningStats()
+        self._mergeable = True
+
+    def add(self, state_dict, norm_stats=None, contribution=None):
+        """
+        Fold one client model (and its norm stats, if any) into the running sums.
+        A contribution from an edge aggregator folds in a pre-averaged model with the
+        edge's total weight, so the result matches folding its clients one by one.
+        """
+        flat, layout = dl.flatten_state_dict(state_dict)
+        if self.layout is None:
+            self.layout = layout
+            self.weighted_sum = torch.zeros_like(flat, dtype=torch.float64)
+        elif layout != self.layout:
+            raise ValueError("Client models do not share the same architecture")
+
+        if contribution is not None:
+            if contribution["weighting"] != self.weighting:
+                raise ValueError(f"Edge aggregated with {contribution['weighting']} weighting, expected {self.weighting}")
+            weight = float(contribution["weight"])
+            stats_weight = float(contribution["stats_weight"])
+            clients = int(contribution["clients"])
         else:
-            models.append(loaded)
-
-    # Compute norms
-    norms = []
-    for model in models:
-        norm = torch.sqrt(sum(torch.sum(param ** 2) for param in model.values()))
-        norms.append(norm + epsilon)  # avoid zero
-
-    # Aggregate model weights weighted by their norms
-    agg_state_dict = OrderedDict()
-    for key in models[0].keys():
-        weighted_sum = sum(norm * model[key] for norm, model in zip(norms, models))
-        agg_state_dict[key] = weighted_sum / sum(norms)
-
-    # Average norm stats across clients if available
-    if all_norm_stats:
-        n = len(all_norm_stats)
-        avg_norm_stats = {
-            "input_mean": [sum(s["input_mean"][i] for s in all_norm_stats) / n for i in range(len(all_norm_stats[0]["input_mean"]))],
-            "input_std":  [sum(s["input_std"][i]  for s in all_norm_stats) / n for i in range(len(all_norm_stats[0]["input_std"]))],
-            "tilt_mean":  sum(s["tilt_mean"] for s in all_norm_stats) / n,
-            "tilt_std":   sum(s["tilt_std"]  for s in all_norm_stats) / n,
+            weight = client_weights(flat.unsqueeze(0), [norm_stats], self.weighting, self.epsilon)[0].item()
+            stats_weight = weight if self.weighting == "samples" else 1.0
+            clients = 1
+
+        self.weighted_sum.add_(flat.to(torch.float64), alpha=weight)
+        self.total_weight += weight
+        self.count += clients
+
+        if norm_stats is not None:
+            for key in NORM_STAT_KEYS:
+                value = torch.tensor(norm_stats[key], dtype=torch.float64) * stats_weight
+                self._stats_sums[key] = self._stats_sums[key] + value if key in self._stats_sums else value
+            self._stats_weight += stats_weight
+            if ns.mergeable(norm_stats):
+                input_stats, tilt_stats = ns.from_norm_stats(norm_stats)
+                self._input_stats = self._input_stats.merge(input_stats)
+                self._tilt_stats = self._tilt_stats.merge(tilt_stats)
+                self._num_samples += int(norm_stats["num_samples"])
+            else:
+                self._mergeable = False
+
+    def add_file(self, path, base_state_dict=None, base_version=0):
+        """
+        Load a saved client model or delta update and fold it in.
+        """
+        state_dict, norm_stats, contribution = load_update(path, base_state_dict, base_version)
+        self.add(state_dict, norm_stats, contribution)
+
+    def finalize(self):
+        """
+        Return the aggregated (state_dict, norm_stats). norm_stats is None if no client sent any.
+        """
+        if self.count == 0:
+            raise ValueError("No client models to aggregate")
+
+        agg_state_dict = dl.unflatten_state_dict((self.weighted_sum / self.total_weight).to(torch.float32), self.layout)
+        if not self._stats_sums:
+            return agg_state_dict, None
+        if self._mergeable:
+            return agg_state_dict, ns.to_norm_stats(self._input_stats, self._tilt_stats, self._num_samples)
+
+        avg_norm_stats = {}
+        for key in NORM_STAT_KEYS:
+            avg = self._stats_sums[key] / self._stats_weight
+            avg_norm_stats[key] = avg.tolist() if avg.dim() else avg.item()
+        return agg_state_dict, avg_norm_stats
+
+    def contribution(self):
+        """
+        Weights an edge aggregator forwards alongside its averaged model, so the
+        upstream server can fold it in as a single weighted contribution.
+        """
+        return {
+            "weighting": self.weighting,
+            "weight": self.total_weight,
+            "stats_weight": self._stats_weight,
+            "clients": self.count,
+        }
+
+
+class BufferedAggregate:
+    """
+    Aggregator for the robust methods, which need every client model at once.
+    Keeps the flat vectors of a round and reduces them in a few tensor ops on finalize,
+    with the same add/add_file/finalize interface as RunningAggregate.
+    An edge's pre-averaged contribution is buffered as one vector.
+    """
+
+    def __init__(self, method="median", weighting="norm", epsilon=0.01, trim_ratio=0.1, byzantine=1):
+        if method not in METHODS:
+            raise ValueError(f"Unknown aggregation method: {method}, expected one of {METHODS}")
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f"Unknown weighting: {weighting}, expected one of {WEIGHTINGS}")
+        self.method = method
+        self.weighting = weighting
+        self.epsilon = epsilon
+        self.trim_ratio = trim_ratio
+        self.byzantine = byzantine
+        self.count = 0
+        self.layout = None
+        self._flats = []
+        self._norm_stats = []
+
+    def add(self, state_dict, norm_stats=None, contribution=None):
+        """
+        Buffer one client model (and its norm stats, if any).
+        """
+        flat, layout = dl.flatten_state_dict(state_dict)
+        if self.layout is None:
+            self.layout = layout
+        elif layout != self.layout:
+            raise ValueError("Client models do not share the same architecture")
+
+        self._flats.append(flat)
+        self._norm_stats.append(norm_stats)
+        self.count += int(contribution["clients"]) if contribution is not None else 1
+
+    def add_file(self, path, base_state_dict=None, base_version=0):
+        """
+        Load a saved client model or delta update and buffer it.
+        """
+        state_dict, norm_stats, contribution = load_update(path, base_state_dict, base_version)
+        self.add(state_dict, norm_stats, contribution)
+
+    def finalize(self):
+        """
+        Return the aggregated (state_dict, norm_stats). norm_stats is None if no client sent any.
+        """
+        if not self._flats:
+            raise ValueError("No client models to aggregate")
+
+        state_dicts = [dl.unflatten_state_dict(flat, self.layout) for flat in self._flats]
+        return aggregate_state_dicts(
+            state_dicts, self._norm_stats, weighting=self.weighting, epsilon=self.epsilon,
+            method=self.method, trim_ratio=self.trim_ratio, byzantine=self.byzantine,
+        )
+
+    def contribution(self):
+        """
+        Robust results have no exact weight, so an edge forwards the summed client weights of its round.
+        """
+        stacked = torch.stack(self._flats)
+        weights = client_weights(stacked, self._norm_stats, self.weighting, self.epsilon)
+        stats_weight = weights.sum().item() if self.weighting == "samples" else float(len(self._flats))
+        return {
+            "weighting": self.weighting,
+            "weight": weights.sum().item(),
+            "stats_weight": stats_weight,
+            "clients": self.count,
         }
-        torch.save({"state_dict": agg_state_dict, "norm_stats": avg_norm_stats}, output_path)
-    else:
-        torch.save(agg_state_dict, output_path)
\ No newline at end of file
+
+
+class SecureAggregate:
+    """
+    Aggregator for secure rounds: uploads are pairwise-masked fixed-point vectors
+    (see shared/secure.py) and only their modular sum is ever unmasked.
+    roster and dropped are kept up to date by the aggregation worker from the round coordinator.
+    """
+
+    def __init__(self, round_number):
+        self.round = round_number
+        self.roster = {}
+        self.dropped = set()
+        self.clients = set()
+        self.count = 0
+        self.stats_layout = None
+        self._total = None
+        self._samples = None
+
+    def add(self, masked):
+        """
+        Fold one masked upload into the modular sum.
+        """
+        client_id = masked["client_id"]
+        if masked["round"] != self.round:
+            raise StaleUpdateError(f"Masked for round {masked['round']}, current is {self.round}")
+        if client_id not in self.roster or client_id in self.dropped:
+            raise StaleUpdateError(f"Client {client_id} is not in the round's roster or was marked as dropped")
+        if client_id in self.clients:
+            raise ValueError(f"Client {client_id} already uploaded this round")
+
+        self._total = sc.add_masked(self._total, masked["values"])
+        self.stats_layout = [tuple(entry) for entry in masked["stats_layout"]]
+        self.clients.add(client_id)
+        self.count += 1
+
+    def add_file(self, path, base_state_dict=None, base_version=0):
+        """
+        Load a saved masked upload and fold it in.
+        """
+        loaded = torch.load(path, map_location="cpu", weights_only=True)
+        if "masked" not in loaded:
+            raise ValueError("Secure rounds only accept masked uploads")
+        self.add(loaded["masked"])
+
+    def finalize(self, template_state_dict, revealed_seeds=None):
+        """
+        Unmask the sum, removing the masks of dropped clients from the seeds survivors revealed.
+        Returns the sample-weighted (state_dict, norm_stats); template_state_dict gives the layout.
+        """
+        if self.count == 0:
+            raise ValueError("No client models to aggregate")
+
+        total = sc.remove_dropout_masks(self._total, revealed_seeds or {})
+        template, layout = dl.flatten_state_dict(template_state_dict)
+        flat, norm_stats = sc.unpack_sum(sc.decode_fixed(total), template.numel(), self.stats_layout)
+        self._samples = float(norm_stats["num_samples"])
+        return dl.unflatten_state_dict(flat, layout), norm_stats
+
+    def contribution(self):
+        """
+        Secure sums are sample-weighted, so an edge forwards its round's sample count (known once finalized) as the weight.
+        """
+        return {"weighting": "samples", "weight": self._samples, "stats_weight": self._samples, "clients": self.count}
+
+
+def make_aggregate(method="mean", weighting="norm", epsilon=0.01, trim_ratio=0.1, byzantine=1):
+    """
+    Streaming RunningAggregate for the weighted mean, BufferedAggregate for the robust methods.
+    """
+    if method == "mean":
+        return RunningAggregate(weighting=weighting, epsilon=epsilon)
+    return BufferedAggregate(method, weighting, epsilon, trim_ratio, byzantine)
+
+
+def save_aggregate(agg_state_dict, avg_norm_stats, output_path, version=None):
+    """
+    Save an aggregated model, embedding norm stats and the model version in a bundle when available.
+    """
+    if avg_norm_stats is None and version is None:
+        save_atomic(agg_state_dict, output_path)
+        return
+
+    bundle = {"state_dict": agg_state_dict, "norm_stats": avg_norm_stats}
+    if version is not None:
+        bundle["version"] = version
+    save_atomic(bundle, output_path)
+
+
+def aggregate_models(input_model_paths, output_path, epsilon=0.01, weighting="norm",
+                     method="mean", trim_ratio=0.1, byzantine=1):
+    """
+    Aggregate given models and save new model to given path.
+    Norm stats are combined across clients and embedded in the output bundle.
+    """
+    state_dicts = []
+    norm_stats_list = []
+    for path in input_model_paths:
+        state_dict, norm_stats = load_bundle(path)
+        state_dicts.append(state_dict)
+        norm_stats_list.append(norm_stats)
+
+    agg_state_dict, avg_norm_stats = aggregate_state_dicts(
+        state_dicts, norm_stats_list, weighting=weighting, epsilon=epsilon,
+        method=method, trim_ratio=trim_ratio, byzantine=byzantine,
+    )
+    save_aggregate(agg_state_dict, avg_norm_stats, output_path)
@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import socket
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the development server runs a single process anyway
+    fcntl = None
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+ARCHIVE_FILE_NAME = "dead.json"
+LOCK_FILE_NAME = "metrics.lock"
+
+
+class _Metric:
+    """
+    A named metric holding one value per label set. Updates only take a lock, so they are cheap on hot paths.
+    """
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {_label_key(labels): _copy(value) for labels, value in self._values.items()}
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Set by the scraping process right before rendering, so it is never shared between processes.
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # per-bucket counts (last one is +Inf), then sum
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+class Registry:
+    """
+    Metrics of this process, rendered in the Prometheus text format.
+    Gunicorn runs several worker processes, so counters and histograms are also flushed to a shared
+    folder every few seconds and summed over every process's file when scraped.
+    Every live process rewrites its file each interval, so a file that has not been touched for a few
+    intervals belongs to a dead process (a recycled worker, or a previous container run). Its values are
+    folded into an archive file that is part of every later sum, and only the per-process file is deleted,
+    so totals never go down. Processes archive their own file the same way on exit.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.folder = None
+        self.stale_after = None
+        self._flush_lock = threading.Lock()
+        self._file_name = f"{socket.gethostname()}-{os.getpid()}.json"
+        # local totals already counted in the archive, and the totals behind the last file written
+        self._archived = {}
+        self._written = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def enable_multiprocess(self, folder, interval=5):
+        """
+        Share counters and histograms with the other server processes through files in folder.
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.stale_after = 3 * interval
+        atexit.register(self._archive_own_file)
+
+        def flush_forever():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        threading.Thread(target=flush_forever, name="metrics-flusher", daemon=True).start()
+
+    def flush(self):
+        if self.folder is None:
+            return
+        path = os.path.join(self.folder, self._file_name)
+        with self._flush_lock, self._folder_lock():
+            self._notice_archived(path)
+            local = self._local_snapshot()
+            _write_json(path, _subtract(local, self._archived))
+            self._written = local
+
+    def render(self):
+        """
+        Prometheus text exposition of every registered metric, merged across processes.
+        """
+        if self.folder is None:
+            merged = self._local_snapshot()
+        else:
+            # this process is summed from its file like every other, so each scrape reads one source
+            self.flush()
+            with self._folder_lock():
+                self._archive_stale_files()
+                merged = {}
+                for snapshot in self._folder_snapshots():
+                    _merge(merged, snapshot)
+
+        lines = []
+        for metric in self.metrics:
+            values = merged.get(metric.name) if metric.kind != "gauge" else metric.snapshot()
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for key, value in sorted((values or {}).items()):
+                labels = dict(json.loads(key))
+                if metric.kind == "histogram":
+                    lines.extend(_histogram_lines(metric, labels, value))
+                else:
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _local_snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics if metric.kind != "gauge"}
+
+    @contextmanager
+    def _folder_lock(self):
+        """
+        Serialise writers of the shared folder across processes, so a file is never archived twice
+        or while its owner rewrites it.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.folder, LOCK_FILE_NAME), "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    def _folder_snapshots(self):
+        for name in os.listdir(self.folder):
+            if name.endswith(".json"):
+                snapshot = _read_json(os.path.join(self.folder, name))
+                if snapshot is not None:
+                    yield snapshot
+
+    def _archive_stale_files(self):
+        now = time.time()
+        stale = []
+        for name in os.listdir(self.folder):
+            if name in (self._file_name, ARCHIVE_FILE_NAME) or not name.endswith(".json"):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.stale_after:
+                    stale.append(path)
+            except OSError:
+                continue
+        if stale:
+            self._archive(stale)
+
+    def _archive(self, paths, snapshot=None):
+        """
+        Fold the files at paths (and snapshot, if given) into the archive, then delete the files.
+        """
+        archive_path = os.path.join(self.folder, ARCHIVE_FILE_NAME)
+        archive = _read_json(archive_path) or {}
+        for path in paths:
+            _merge(archive, _read_json(path) or {})
+        if snapshot is not None:
+            _merge(archive, snapshot)
+        _write_json(archive_path, archive)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _archive_own_file(self):
+        path = os.path.join(self.folder, self._file_name)
+        try:
+            with self._flush_lock, self._folder_lock():
+                # the final values supersede the last flush, which may be a few seconds old
+                self._notice_archived(path)
+                self._archive([], _subtract(self._local_snapshot(), self._archived))
+                if os.path.exists(path):
+                    os.remove(path)
+        except OSError:
+            pass
+
+    def _notice_archived(self, path):
+        if self._written is not None and not os.path.exists(path):
+            # another process took this file for a dead one (e.g. after a long pause) and archived it
+            self._archived = self._written
+
+
+def _histogram_lines(metric, labels, value):
+    cumulative = 0
+    for bound, count in zip(metric.buckets + (float("inf"),), value[:-1]):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else _format_value(bound)
+        yield f"{metric.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}"
+    yield f"{metric.name}_sum{_format_labels(labels)} {_format_value(value[-1])}"
+    yield f"{metric.name}_count{_format_labels(labels)} {cumulative}"
+
+
+def _label_key(labels):
+    return json.dumps(labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else value
+
+
+def _add(a, b):
+    if isinstance(a, list):
+        return [x + y for x, y in zip(a, b)]
+    return a + b
+
+
+def _subtract(snapshot, base):
+    result = {}
+    for name, values in snapshot.items():
+        base_values = base.get(name, {})
+        result[name] = {
+            key: _add(value, _negate(base_values[key])) if key in base_values else value
+            for key, value in values.items()
+        }
+    return result
+
+
+def _negate(value):
+    return [-x for x in value] if isinstance(value, list) else -value
+
+
+def _merge(target, snapshot):
+    for name, values in snapshot.items():
+        merged = target.setdefault(name, {})
+        for key, value in values.items():
+            merged[key] = _add(merged[key], value) if key in merged else value
+
+
+def _read_json(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "fir_stage_duration_seconds", "Time spent per server stage (decode, persist, fold, aggregate, encode)."
+))
+BYTES_RECEIVED = REGISTRY.register(Counter("fir_bytes_received_total", "Model upload bytes received."))
+BYTES_SENT = REGISTRY.register(Counter("fir_bytes_sent_total", "Global model bytes sent to clients."))
+UPLOADS = REGISTRY.register(Counter("fir_uploads_total", "Model uploads by outcome."))
+ROUND_UPLOADS = REGISTRY.register(Histogram(
+    "fir_round_uploads", "Uploads folded into each aggregated round.", buckets=COUNT_BUCKETS
+))
+ROUND = REGISTRY.register(Gauge("fir_round", "Round currently collecting uploads."))
+MODEL_VERSION = REGISTRY.register(Gauge("fir_model_version", "Version of the global model being served."))
+CURRENT_ROUND_UPLOADS = REGISTRY.register(Gauge("fir_current_round_uploads", "Uploads in the current round by state."))
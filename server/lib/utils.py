@@ -1,3 +1,4 @@
+import hashlib
 import random
 
 
@@ -8,4 +9,15 @@ ADJECTIVES  = ["moist", "dank", "fluffy", "discombulated", "foreign",
 
 
 def generate_random_name():
-    return ''.join([random.choice(ADJECTIVES), random.choice(NOUNS), str(random.randint(100, 999))])
\ No newline at end of file
+    return ''.join([random.choice(ADJECTIVES), random.choice(NOUNS), str(random.randint(100, 999))])
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,29 +1,128 @@
 from flask import Flask, request, Response, jsonify
 import os
+import tempfile
 import threading
+import uuid
 import torch
 import traceback
 from datetime import datetime
 
+import lib.aggregator as ag
+import lib.cache as ca
+import lib.coordinator as co
+import lib.edge as ed
 import lib.federated as fe
+import lib.metrics as me
 import lib.utils as ut
 
 import shared.encryption as en
+import shared.export as ex
 import shared.preprocessing as pp
+import shared.store as st
 import shared.training as tr
 
 
-MODEL_FOLDER = "/app/models"
+MODEL_FOLDER = os.environ.get("MODEL_FOLDER", "/app/models")
 FED_MODEL_PATH = f"{MODEL_FOLDER}/federated_model.pt"
 CENTRAL_MODEL_PATH = f"{MODEL_FOLDER}/centralised_model.pt"
 CENTRAL_INPUTS_PATH = f"data/inputs.csv"
 CENTRAL_LABELS_PATH = f"data/labels.csv"
+UPLOAD_TMP_FOLDER = f"{MODEL_FOLDER}/tmp"
+PENDING_FOLDER = f"{MODEL_FOLDER}/to_be_federated"
+MIN_MODELS_PER_ROUND = int(os.environ.get("MIN_MODELS_PER_ROUND", 3))
+UPSTREAM_URL = os.environ.get("UPSTREAM_URL")  # set to run as an edge aggregator
+AGGREGATION_WEIGHTING = os.environ.get("AGGREGATION_WEIGHTING", "norm")  # "norm" or "samples"
+AGGREGATION_METHOD = os.environ.get("AGGREGATION_METHOD", "mean")  # "mean", "median", "trimmed_mean", "krum" or "multi_krum"
+AGGREGATION_TRIM_RATIO = float(os.environ.get("AGGREGATION_TRIM_RATIO", 0.1))  # share trimmed from each end by trimmed_mean
+AGGREGATION_BYZANTINE = int(os.environ.get("AGGREGATION_BYZANTINE", 1))  # faulty clients tolerated by krum/multi_krum
+RETAIN_UPLOADS = os.environ.get("RETAIN_UPLOADS", "0") == "1"  # keep raw uploads for auditing
+RETAIN_FOLDER = f"{MODEL_FOLDER}/uploads"
+COORDINATOR_DB_PATH = f"{MODEL_FOLDER}/coordinator.db"
+ROUNDS_FOLDER = f"{MODEL_FOLDER}/rounds"
+MODEL_RETENTION_ROUNDS = int(os.environ.get("MODEL_RETENTION_ROUNDS", 0))  # 0 keeps every round
+METRICS_FOLDER = f"{MODEL_FOLDER}/metrics"
+SECURE_AGGREGATION = os.environ.get("SECURE_AGGREGATION", "0") == "1"  # only accept pairwise-masked uploads
+SECURE_DROPOUT_TIMEOUT = float(os.environ.get("SECURE_DROPOUT_TIMEOUT", 120))  # seconds before missing roster members count as dropped
 
 app = Flask(__name__)
 os.makedirs(MODEL_FOLDER, exist_ok=True)
-os.makedirs(f"{MODEL_FOLDER}/to_be_federated", exist_ok=True)
+os.makedirs(PENDING_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_TMP_FOLDER, exist_ok=True)
 os.makedirs("data", exist_ok=True)
 
+MODEL_CACHE = ca.ModelCache(FED_MODEL_PATH)
+me.REGISTRY.enable_multiprocess(METRICS_FOLDER)
+
+
+def ensure_global_model():
+    """
+    Generate and save a base model if the global model doesn't exist yet.
+    """
+    if not os.path.exists(FED_MODEL_PATH) or os.path.getsize(FED_MODEL_PATH) == 0:
+        model = pp.generate_base_model()
+        fe.save_atomic(model.state_dict(), FED_MODEL_PATH)
+        MODEL_CACHE.invalidate()
+
+
+def on_global_model():
+    """
+    Called by the aggregation worker whenever it writes a new global model:
+    drop the cached encodings and export the folded TorchScript inference artifact.
+    """
+    MODEL_CACHE.invalidate()
+    try:
+        ex.export_inference_model(FED_MODEL_PATH)
+    except Exception as e:
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Could not export inference model: {e}", flush=True)
+
+
+ensure_global_model()
+COORDINATOR = co.RoundCoordinator(
+    COORDINATOR_DB_PATH,
+    initial_round=fe.bundle_version(en.load_model_file(FED_MODEL_PATH)) + 1,
+)
+AGGREGATOR = ag.AggregationWorker(
+    COORDINATOR,
+    FED_MODEL_PATH,
+    min_models=MIN_MODELS_PER_ROUND,
+    weighting=AGGREGATION_WEIGHTING,
+    method=AGGREGATION_METHOD,
+    trim_ratio=AGGREGATION_TRIM_RATIO,
+    byzantine=AGGREGATION_BYZANTINE,
+    secure=SECURE_AGGREGATION,
+    secure_timeout=SECURE_DROPOUT_TIMEOUT,
+    retain_folder=RETAIN_FOLDER if RETAIN_UPLOADS else None,
+    on_aggregate=on_global_model,
+    upstream=ed.UpstreamClient(UPSTREAM_URL) if UPSTREAM_URL else None,
+    store=None if UPSTREAM_URL else st.ModelStore(ROUNDS_FOLDER, retention=MODEL_RETENTION_ROUNDS),
+)
+AGGREGATOR.start()
+
+
+def is_stale(bundle):
+    """
+    True if the upload is a delta computed against an older global model version.
+    """
+    return "delta" in bundle and bundle["delta"]["base_version"] != current_version()
+
+
+def wrong_mode(bundle):
+    """
+    Error message if an upload doesn't match the server's secure-aggregation mode, else None.
+    """
+    if SECURE_AGGREGATION and "masked" not in bundle:
+        return "Secure aggregation is enabled, only masked uploads are accepted"
+    if not SECURE_AGGREGATION and "masked" in bundle:
+        return "Secure aggregation is disabled"
+    return None
+
+
+def current_version():
+    """
+    Version of the global model that delta uploads must be computed against.
+    """
+    return MODEL_CACHE.version()
+
 
 @app.route("/health", methods=["GET"])
 def health():
@@ -32,9 +131,7 @@ def health():
     If the global model file doesn't exist, generate it on the fly.
     """
     try:
-        if not os.path.exists(FED_MODEL_PATH) or os.path.getsize(FED_MODEL_PATH) == 0:
-            model = pp.generate_base_model()
-            torch.save(model.state_dict(), FED_MODEL_PATH)
+        ensure_global_model()
         return jsonify({"status": "ready"}), 200
     except Exception as e:
         return jsonify({"status": "loading", "error": str(e)}), 503
@@ -44,60 +141,328 @@ def health():
 def download_model():
     """
     Send global model to client and generate basic model if needed.
+    Clients asking for ?format=binary get the raw header-prefixed payload instead of base64.
+    Encoded bytes are cached per model version and If-None-Match gets a 304.
+    The body is compressed when the client accepts one of en.CONTENT_ENCODINGS.
     """
     try:
-        if not os.path.exists(FED_MODEL_PATH) or os.path.getsize(FED_MODEL_PATH) == 0:
-            model = pp.generate_base_model()
-            torch.save(model.state_dict(), FED_MODEL_PATH)
-        
-        sd = torch.load(FED_MODEL_PATH, map_location="cpu", weights_only=True)
-        
-        encoded = en.encode_model(sd)
-        return Response(encoded, mimetype="application/octet-stream")
+        ensure_global_model()
+
+        fmt = "binary" if request.args.get("format") == "binary" else "base64"
+        encoding = en.negotiate(request.headers.get("Accept-Encoding"))
+        etag, encoded = MODEL_CACHE.get(fmt, encoding)
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(encoded, mimetype="application/octet-stream")
+            if encoding is not None:
+                response.headers["Content-Encoding"] = encoding
+            me.BYTES_SENT.inc(len(encoded), format=fmt)
+        response.set_etag(etag)
+        response.headers.update(transport_headers())
+        return response
 
     except Exception as e:
         traceback.print_tb(f"[+][{datetime.now().strftime('%H:%M:%S')}] [ERROR]: {e.__traceback__}")
         return str(e), 500
 
 
+def transport_headers():
+    """
+    Headers sent with every model download: the download depends on Accept-Encoding, and
+    Accept-Encoding in a response tells clients which encodings uploads may use (RFC 7694).
+    """
+    return {"Vary": "Accept-Encoding", "Accept-Encoding": ", ".join(en.CONTENT_ENCODINGS)}
+
+
+def known_upload(upload_id):
+    """
+    Reply for a retried upload whose first attempt was already registered, or None.
+    X-Upload-Id is the SHA-256 of the binary payload, i.e. the checksum the coordinator keys uploads by.
+    """
+    if not upload_id:
+        return None
+    round_number = COORDINATOR.find_upload(upload_id)
+    if round_number is None:
+        return None
+    me.UPLOADS.inc(result="duplicate")
+    return f"Model was already uploaded for round {round_number}", 200
+
+
+def decode_upload(decode, data):
+    """
+    Decode an uploaded payload. Whatever torch.load raises on corrupt bytes (UnpicklingError, EOFError,
+    zip errors...) is the client's fault, so it becomes a ValueError and a 400 rather than a retryable 500.
+    """
+    try:
+        return decode(data)
+    except Exception as e:
+        raise ValueError(f"{type(e).__name__}: {e}") from e
+
+
+def accept_binary_upload(tmp_path, path):
+    """
+    Validate a streamed binary upload and move it into the pending folder.
+    Returns an error (message, status) or None once the file is at path.
+    """
+    try:
+        with me.STAGE_DURATION.time(stage="decode"):
+            bundle = decode_upload(en.load_model_file, tmp_path)  # reject corrupt payloads before they reach aggregation
+        if wrong_mode(bundle):
+            me.UPLOADS.inc(result="invalid")
+            return wrong_mode(bundle), 400
+        if is_stale(bundle):
+            me.UPLOADS.inc(result="stale")
+            return f"Stale update, current model version is {current_version()}", 409
+        os.replace(tmp_path, path)
+    except (ValueError, RuntimeError) as e:
+        me.UPLOADS.inc(result="invalid")
+        return f"Invalid model payload: {e}", 400
+    return None
+
+
+def accept_base64_upload(encoded, path):
+    """
+    Decode a multipart base64 upload and save it into the pending folder.
+    Returns an error (message, status) or None once the file is at path.
+    """
+    me.BYTES_RECEIVED.inc(len(encoded), format="base64")
+    try:
+        with me.STAGE_DURATION.time(stage="decode"):
+            sd = decode_upload(en.decode_model, encoded)
+    except ValueError as e:
+        me.UPLOADS.inc(result="invalid")
+        return f"Invalid model payload: {e}", 400
+    if wrong_mode(sd):
+        me.UPLOADS.inc(result="invalid")
+        return wrong_mode(sd), 400
+    if is_stale(sd):
+        me.UPLOADS.inc(result="stale")
+        return f"Stale update, current model version is {current_version()}", 409
+    with me.STAGE_DURATION.time(stage="persist"):
+        torch.save(sd, path)
+    return None
+
+
+def queue_upload(path, name, client_id, upload_id=None):
+    """
+    Register a saved upload with the round coordinator and wake the aggregation worker.
+    An upload id that doesn't match the payload's checksum means it was corrupted on the way.
+    Returns the (message, status) reply.
+    """
+    checksum = ut.file_checksum(path)
+    if upload_id and upload_id != checksum:
+        os.remove(path)
+        me.UPLOADS.inc(result="invalid")
+        return "Upload id does not match the payload checksum", 400
+
+    _, round_number, duplicate = COORDINATOR.register_upload(path, checksum, client_id=client_id)
+    if duplicate:
+        os.remove(path)
+        me.UPLOADS.inc(result="duplicate")
+        return f"Model was already uploaded for round {round_number}", 200
+
+    me.UPLOADS.inc(result="queued")
+    AGGREGATOR.notify()
+    return f"Model: {name} is uploaded, queued for round {round_number}", 200
+
+
+def new_upload_path():
+    """
+    Unique name and pending path for an incoming upload.
+    """
+    name = f"{ut.generate_random_name()}-{uuid.uuid4().hex[:8]}"
+    return name, os.path.join(PENDING_FOLDER, f"{name}.pt")
+
+
 @app.route("/upload_model", methods=["POST"])
 def upload_model():
     """
     Receives model from client and saves it to to_be_federated to be used later.
-    If there is 3 or more, aggregate them.
+    Binary octet-stream bodies are streamed to disk, multipart base64 is kept as a fallback.
+    The saved model is registered with the round coordinator and folded in by the aggregation worker.
+    Binary bodies may be compressed (Content-Encoding) and carry an X-Upload-Id, so retries are answered without re-queuing.
     """
     try:
-        if "file" not in request.files:
-            return "No file uploaded", 400
-
-        encoded = request.files["file"].read()
-        sd = en.decode_model(encoded)
-        while True:
-            name = ut.generate_random_name()
-            path = os.path.join(MODEL_FOLDER, f"to_be_federated/{name}.pt")
-            if not os.path.exists(path):
-                break
-
-        torch.save(sd, F"{MODEL_FOLDER}/to_be_federated/{name}.pt")
-
-        model_files = [f for f in os.listdir(f"{MODEL_FOLDER}/to_be_federated") if f.endswith(".pt")]
-        if len(model_files) >= 3:
-            print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Enough models to aggregate!", flush=True)
-
-            # Federated aggregation — fast, do it immediately
-            to_aggregate = [os.path.join(f"{MODEL_FOLDER}/to_be_federated", f) for f in model_files]
-            fe.aggregate_models(to_aggregate, os.path.join(MODEL_FOLDER, "federated_model.pt"))
-            for p in to_aggregate:
-                os.remove(p)
-
-            return f"Model: {name} was uploaded, enough models found to aggregate", 200
+        name, path = new_upload_path()
+        upload_id = request.headers.get("X-Upload-Id")
+        reply = known_upload(upload_id)
+        if reply is not None:
+            return reply
+
+        if request.mimetype == en.BINARY_MIMETYPE:
+            encoding = request.headers.get("Content-Encoding")
+            if encoding not in (None, "identity", *en.CONTENT_ENCODINGS):
+                return f"Unsupported content encoding: {encoding}", 415
+            fd, tmp_path = tempfile.mkstemp(suffix=".pt", dir=UPLOAD_TMP_FOLDER)
+            os.close(fd)
+            try:
+                with me.STAGE_DURATION.time(stage="persist"):
+                    en.stream_model_to_file(request.stream, tmp_path, encoding=encoding)
+                me.BYTES_RECEIVED.inc(os.path.getsize(tmp_path), format="binary")
+                error = accept_binary_upload(tmp_path, path)
+            except ValueError as e:
+                me.UPLOADS.inc(result="invalid")
+                error = f"Invalid model payload: {e}", 400
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        elif "file" in request.files:
+            upload_id = None  # base64 uploads are re-serialised, so they can't match a payload checksum
+            error = accept_base64_upload(request.files["file"].read(), path)
         else:
-            return f"Model: {name} is uploaded", 200
-        
+            return "No file uploaded", 415
+
+        if error is not None:
+            return error
+        return queue_upload(path, name, request.headers.get("X-Client-Id"), upload_id)
+
     except Exception as e:
         print(e)
         return str(e), 500
 
 
+def secure_advertise(payload):
+    """
+    Add a client's public key to the open round's roster. Returns the (reply, status).
+    """
+    if not SECURE_AGGREGATION:
+        return {"error": "Secure aggregation is disabled"}, 404
+    round_number, accepted = COORDINATOR.advertise_key(
+        str(payload["client_id"]), str(payload["public_key"]), MIN_MODELS_PER_ROUND
+    )
+    return {"round": round_number, "accepted": accepted}, 200
+
+
+def secure_roster():
+    """
+    Public keys of the open round's roster, once it has closed. Returns the (reply, status).
+    """
+    if not SECURE_AGGREGATION:
+        return {"error": "Secure aggregation is disabled"}, 404
+    round_number = COORDINATOR.current_round()
+    roster = COORDINATOR.secure_roster(round_number, MIN_MODELS_PER_ROUND)
+    if roster is None:
+        return {"round": round_number, "closed": False}, 200
+    return {"round": round_number, "closed": True, "clients": roster[0]}, 200
+
+
+def secure_round_state(round_number):
+    """
+    Where a secure round stands: collecting, unmasking (with the dropped clients), done or aborted.
+    """
+    if not SECURE_AGGREGATION:
+        return {"error": "Secure aggregation is disabled"}, 404
+    if round_number < COORDINATOR.current_round():
+        aborted = COORDINATOR.round_state(round_number) == "aborted"
+        return {"round": round_number, "state": "aborted" if aborted else "done"}, 200
+    dropouts = COORDINATOR.dropouts(round_number)
+    if dropouts:
+        return {"round": round_number, "state": "unmasking", "dropouts": sorted(dropouts)}, 200
+    return {"round": round_number, "state": "collecting"}, 200
+
+
+def secure_unmask(payload):
+    """
+    Store the seeds a surviving client revealed for its dropped peers. Returns the (reply, status).
+    """
+    if not SECURE_AGGREGATION:
+        return {"error": "Secure aggregation is disabled"}, 404
+    round_number = int(payload["round"])
+    client_id = str(payload["client_id"])
+    seeds = {str(peer): str(seed) for peer, seed in payload["seeds"].items()}
+
+    roster = COORDINATOR.secure_roster(round_number, MIN_MODELS_PER_ROUND)
+    dropouts = COORDINATOR.dropouts(round_number)
+    if roster is None or client_id not in roster[0] or client_id in dropouts:
+        return {"error": "Client is not a surviving member of the round's roster"}, 403
+    if not set(seeds) <= dropouts:
+        # Seeds with surviving peers would let the server unmask them
+        return {"error": "Seeds may only be revealed for dropped clients"}, 400
+
+    COORDINATOR.submit_seeds(round_number, client_id, seeds)
+    AGGREGATOR.notify()
+    return {"round": round_number, "accepted": len(seeds)}, 200
+
+
+def build_round_status():
+    """
+    Round state recorded by the coordinator, plus this server's settings.
+    """
+    status = COORDINATOR.status()
+    status["model_version"] = current_version()
+    status["role"] = "edge" if UPSTREAM_URL else "server"
+    status["min_models"] = MIN_MODELS_PER_ROUND
+    status["aggregation_method"] = AGGREGATION_METHOD
+    status["secure"] = SECURE_AGGREGATION
+    status["last_error"] = AGGREGATOR.last_error
+    return status
+
+
+def render_metrics():
+    """
+    Refresh the round gauges and render every metric in the Prometheus text format.
+    """
+    status = COORDINATOR.status()
+    me.ROUND.set(status["round"])
+    me.MODEL_VERSION.set(current_version())
+    for state in ("pending", "folded", "rejected_stale", "failed"):
+        me.CURRENT_ROUND_UPLOADS.set(status[state], state=state)
+    return me.REGISTRY.render()
+
+
+@app.route("/round_status", methods=["GET"])
+def round_status():
+    """
+    Report the round state recorded by the coordinator.
+    """
+    return jsonify(build_round_status()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Prometheus metrics: per-stage timings, byte counters, upload outcomes and round state.
+    """
+    return Response(render_metrics(), content_type=me.CONTENT_TYPE), 200
+
+
+@app.route("/secure/advertise", methods=["POST"])
+def secure_advertise_route():
+    """
+    Secure aggregation: a client joins the round's roster with its Diffie-Hellman public key.
+    """
+    reply, status = secure_advertise(request.get_json())
+    return jsonify(reply), status
+
+
+@app.route("/secure/roster", methods=["GET"])
+def secure_roster_route():
+    """
+    Secure aggregation: public keys of the round's roster, once closed.
+    """
+    reply, status = secure_roster()
+    return jsonify(reply), status
+
+
+@app.route("/secure/status", methods=["GET"])
+def secure_status_route():
+    """
+    Secure aggregation: whether a round is collecting, waiting for dropout seeds, or done.
+    """
+    reply, status = secure_round_state(int(request.args.get("round", COORDINATOR.current_round())))
+    return jsonify(reply), status
+
+
+@app.route("/secure/unmask", methods=["POST"])
+def secure_unmask_route():
+    """
+    Secure aggregation: a surviving client reveals its seeds with dropped peers.
+    """
+    reply, status = secure_unmask(request.get_json())
+    return jsonify(reply), status
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,185 @@
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+import pandas as pd
+import torch
+
+import shared.preprocessing as pp
+
+
+DATASET_MAGIC = b"FIRDS"
+DATASET_VERSION = 1
+DATASET_HEADER = struct.Struct("<5sBxxQ")  # magic, format version, schema length
+DATASET_EXT = ".firds"
+ALIGNMENT = 64
+
+
+class Dataset:
+    """
+    Telemetry dataset memory-mapped from the binary columnar format:
+      - inputs: float32 (rows, inputs) view over column-major storage
+      - buttons: uint8 (rows,) with bit i set when button i is pressed
+      - tilt: float32 (rows,)
+    Nothing is copied until a tensor is written to or labels() expands the button bits.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.schema = read_schema(path)
+
+        self.rows = self.schema["rows"]
+        self.input_columns = self.schema["input_columns"]
+        self.label_columns = self.schema["label_columns"]
+
+        # copy-on-write map: tensors can wrap it without torch warning about read-only memory
+        self._mmap = np.memmap(path, mode="c") if self.rows else None
+        self.inputs = self._block("inputs").T
+        self.buttons = self._block("buttons")
+        self.tilt = self._block("tilt")
+
+    def _block(self, name):
+        block = self.schema["blocks"][name]
+        shape = tuple(block["shape"])
+        if self._mmap is None:
+            return torch.zeros(shape, dtype=getattr(torch, block["dtype"]))
+        count = int(np.prod(shape))
+        array = np.frombuffer(self._mmap, dtype=block["dtype"], count=count, offset=block["offset"])
+        return torch.from_numpy(array.reshape(shape))
+
+    def labels(self):
+        """
+        Float32 (rows, labels) matrix in the CSV's column order: button bits expanded to 0/1, then tilt.
+        """
+        bits = torch.arange(pp.BINARY_OUTPUTS, dtype=torch.uint8)
+        buttons = (self.buttons.unsqueeze(1) >> bits) & 1
+        return torch.cat([buttons.to(torch.float32), self.tilt.unsqueeze(1)], dim=1)
+
+    def __len__(self):
+        return self.rows
+
+
+def read_schema(path):
+    """
+    The JSON schema from a binary dataset's header.
+    """
+    with open(path, "rb") as file:
+        magic, version, schema_length = DATASET_HEADER.unpack(file.read(DATASET_HEADER.size))
+        if magic != DATASET_MAGIC:
+            raise ValueError(f"{path} is not a telemetry dataset")
+        if version > DATASET_VERSION:
+            raise ValueError(f"Unsupported dataset version: {version}")
+        return json.loads(file.read(schema_length))
+
+
+def dataset_path(inputs_path):
+    """
+    Where the binary copy of an inputs/labels CSV pair is kept, e.g. data/inputs.csv -> data/inputs.firds.
+    """
+    return os.path.splitext(inputs_path)[0] + DATASET_EXT
+
+
+def source_fingerprint(inputs_path, labels_path):
+    """
+    Hash of the absolute paths, sizes and modification times of a CSV pair, stored in the binary
+    copy's header to tell whether it still matches its sources.
+    """
+    digest = hashlib.sha256()
+    for path in (inputs_path, labels_path):
+        stat = os.stat(path)
+        digest.update(f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+def write_dataset(inputs, labels, output_path, source=None):
+    """
+    Write input/label DataFrames in the binary columnar format.
+    source is recorded in the header, e.g. the source_fingerprint() of the CSVs they were read from.
+    """
+    if len(inputs) != len(labels):
+        raise ValueError(f"{len(inputs)} input rows but {len(labels)} label rows")
+
+    rows = len(inputs)
+    buttons = labels.iloc[:, :pp.BINARY_OUTPUTS].fillna(0).to_numpy(dtype=np.float32).round().clip(0, 1).astype(np.uint8)
+    arrays = {
+        "inputs": np.ascontiguousarray(inputs.to_numpy(dtype=np.float32).T),
+        "buttons": (buttons << np.arange(pp.BINARY_OUTPUTS, dtype=np.uint8)).sum(axis=1, dtype=np.uint8),
+        "tilt": labels.iloc[:, pp.BINARY_OUTPUTS].to_numpy(dtype=np.float32),
+    }
+
+    # Offsets depend on the schema length, so lay the blocks out against a generous fixed header size
+    schema = {
+        "rows": rows,
+        "input_columns": list(map(str, inputs.columns)),
+        "label_columns": list(map(str, labels.columns)),
+        "source": source,
+        "blocks": {},
+    }
+    header_size = _align(DATASET_HEADER.size + len(json.dumps(schema)) + 256 * len(arrays))
+    offset = header_size
+    for name, array in arrays.items():
+        schema["blocks"][name] = {"offset": offset, "dtype": str(array.dtype), "shape": list(array.shape)}
+        offset = _align(offset + array.nbytes)
+
+    encoded_schema = json.dumps(schema).encode()
+    if DATASET_HEADER.size + len(encoded_schema) > header_size:
+        raise ValueError("Dataset schema does not fit its header")
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(DATASET_HEADER.pack(DATASET_MAGIC, DATASET_VERSION, len(encoded_schema)))
+        file.write(encoded_schema)
+        for name, array in arrays.items():
+            file.seek(schema["blocks"][name]["offset"])
+            file.write(array.tobytes())
+        file.truncate(offset)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def convert_csv(inputs_path, labels_path, output_path=None):
+    """
+    Convert a recorded inputs/labels CSV pair to the binary columnar format.
+    """
+    output_path = output_path or dataset_path(inputs_path)
+    # taken before reading, so CSVs that change mid-conversion are converted again next time
+    source = source_fingerprint(inputs_path, labels_path)
+    return write_dataset(pd.read_csv(inputs_path), pd.read_csv(labels_path), output_path, source)
+
+
+def load_dataset(path):
+    """
+    Memory-map a binary dataset.
+    """
+    return Dataset(path)
+
+
+def load_csv_dataset(inputs_path, labels_path):
+    """
+    Memory-map the binary copy of a CSV pair, converting first if it is missing or was built from
+    different files (any other path, size or modification time).
+    """
+    path = dataset_path(inputs_path)
+    try:
+        current = read_schema(path).get("source") == source_fingerprint(inputs_path, labels_path)
+    except (OSError, ValueError):
+        current = False
+    if not current:
+        convert_csv(inputs_path, labels_path, path)
+    return Dataset(path)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Convert recorded inputs/labels CSVs to the binary dataset format.")
+    parser.add_argument("inputs")
+    parser.add_argument("labels")
+    parser.add_argument("-o", "--output", help="defaults to the inputs CSV's path with a .firds extension")
+    args = parser.parse_args()
+    print(f"Wrote {convert_csv(args.inputs, args.labels, args.output)}")
@@ -0,0 +1,90 @@
+import math
+import torch
+from collections import OrderedDict
+
+
+QUANTIZATIONS = ("fp32", "fp16", "int8")
+
+
+def encode_delta(state_dict: dict, base_state_dict: dict, base_version: int, quantize="fp16", topk_ratio=None) -> dict:
+    """
+    Encode the difference between a trained state_dict and the global model it started from.
+      - quantize: fp32, fp16 or int8 (symmetric, one scale for the whole vector)
+      - topk_ratio: keep only this fraction of the largest-magnitude entries
+    """
+    if quantize not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization: {quantize}, expected one of {QUANTIZATIONS}")
+
+    delta = flatten_state_dict(state_dict)[0] - flatten_state_dict(base_state_dict)[0]
+    numel = delta.numel()
+
+    indices = None
+    if topk_ratio is not None and topk_ratio < 1.0:
+        k = max(1, int(numel * topk_ratio))
+        indices = torch.topk(delta.abs(), k, sorted=False).indices.sort().values
+        delta = delta[indices]
+        indices = indices.to(torch.int32)
+
+    scale = 1.0
+    if quantize == "fp16":
+        values = delta.to(torch.float16)
+    elif quantize == "int8":
+        scale = delta.abs().max().item() / 127 or 1.0
+        values = torch.round(delta / scale).clamp(-127, 127).to(torch.int8)
+    else:
+        values = delta
+
+    return {
+        "base_version": int(base_version),
+        "numel": numel,
+        "quantize": quantize,
+        "scale": scale,
+        "indices": indices,
+        "values": values,
+    }
+
+
+def decode_delta(payload: dict) -> torch.Tensor:
+    """
+    Expand a delta payload back into a dense float32 vector.
+    """
+    values = payload["values"].to(torch.float32) * payload["scale"]
+    if payload["indices"] is None:
+        return values
+
+    dense = torch.zeros(payload["numel"], dtype=torch.float32)
+    dense[payload["indices"].to(torch.int64)] = values
+    return dense
+
+
+def apply_delta(payload: dict, base_state_dict: dict) -> OrderedDict:
+    """
+    Rebuild a full state_dict by adding a decoded delta to the base it was computed against.
+    """
+    base, layout = flatten_state_dict(base_state_dict)
+    if payload["numel"] != base.numel():
+        raise ValueError("Delta does not match the base model architecture")
+    return unflatten_state_dict(base + decode_delta(payload), layout)
+
+
+def flatten_state_dict(state_dict: dict):
+    """
+    Flatten a state_dict into one contiguous float32 vector.
+    Returns the vector and the layout needed to rebuild the state_dict.
+    """
+    layout = [(key, tuple(tensor.shape), tensor.dtype) for key, tensor in state_dict.items()]
+    flat = torch.cat([tensor.detach().reshape(-1).to(torch.float32) for tensor in state_dict.values()])
+    return flat, layout
+
+
+def unflatten_state_dict(flat: torch.Tensor, layout) -> OrderedDict:
+    """
+    Rebuild a state_dict from a flat vector and the layout from flatten_state_dict.
+    """
+    state_dict = OrderedDict()
+    offset = 0
+    for key, shape, dtype in layout:
+        numel = math.prod(shape)
+        state_dict[key] = flat[offset:offset + numel].view(shape).to(dtype)
+        offset += numel
+    return state_dict
@@ -1,7 +1,24 @@
 import io
+import zlib
+import gzip
 import base64
+import struct
 import torch
 
+try:
+    import zstandard
+except ImportError:  # optional, gzip is always available
+    zstandard = None
+
+
+BINARY_MIMETYPE = "application/octet-stream"
+BINARY_MAGIC = b"\x89FIR"  # leading 0x89 can never appear in base64 output
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sBxxxQ")  # magic, format version, payload length
+CHUNK_SIZE = 1 << 20
+CONTENT_ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)  # in order of preference
+
+
 def encode_model(state_dict: dict) -> bytes:
     """
     Encode a PyTorch state_dict into base64 bytes.
@@ -13,8 +30,218 @@ def encode_model(state_dict: dict) -> bytes:
 
 def decode_model(encoded_bytes: bytes) -> dict:
     """
-    Decode base64 bytes back into a PyTorch state_dict.
+    Decode base64 or binary bytes back into a PyTorch state_dict.
     """
+    if encoded_bytes[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return decode_model_binary(encoded_bytes)
+
     raw = base64.b64decode(encoded_bytes)
     buffer = io.BytesIO(raw)
     return torch.load(buffer, map_location="cpu", weights_only=True)
+
+
+def pack_header(payload_length: int) -> bytes:
+    """
+    Build the versioned header that prefixes every binary model payload.
+    """
+    return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, payload_length)
+
+def read_header(stream) -> int:
+    """
+    Read and validate a binary header from a stream, returning the payload length.
+    """
+    header = _read_exact(stream, BINARY_HEADER.size)
+    magic, version, payload_length = BINARY_HEADER.unpack(header)
+    if magic != BINARY_MAGIC:
+        raise ValueError("Not a binary model payload")
+    if version > BINARY_VERSION:
+        raise ValueError(f"Unsupported binary model version: {version}")
+    return payload_length
+
+def encode_model_binary(state_dict: dict) -> bytes:
+    """
+    Encode a PyTorch state_dict into raw bytes prefixed with a binary header.
+    """
+    buffer = io.BytesIO()
+    write_model_binary(state_dict, buffer)
+    return buffer.getvalue()
+
+def write_model_binary(state_dict: dict, fileobj) -> int:
+    """
+    Write header and torch.save payload straight into a seekable file object.
+    Returns the payload length.
+    """
+    start = fileobj.tell()
+    fileobj.write(pack_header(0))
+    torch.save(state_dict, fileobj)
+    end = fileobj.tell()
+
+    payload_length = end - start - BINARY_HEADER.size
+    fileobj.seek(start)
+    fileobj.write(pack_header(payload_length))
+    fileobj.seek(end)
+    return payload_length
+
+def decode_model_binary(data: bytes) -> dict:
+    """
+    Decode header-prefixed raw bytes back into a PyTorch state_dict.
+    """
+    view = memoryview(data)
+    payload_length = read_header(io.BytesIO(view[:BINARY_HEADER.size]))
+    payload = view[BINARY_HEADER.size:]
+    if len(payload) != payload_length:
+        raise ValueError("Truncated model payload")
+    return torch.load(io.BytesIO(payload), map_location="cpu", weights_only=True)
+
+def stream_model_to_file(stream, path: str, chunk_size: int = CHUNK_SIZE, encoding: str = None) -> int:
+    """
+    Copy a binary model payload from a stream to disk chunk by chunk,
+    so the full body is never held in memory. Returns the payload length.
+    A body sent with a Content-Encoding is decompressed on the way.
+    """
+    if encoding is not None:
+        with open(path, "wb") as file:
+            writer = PayloadWriter(file)
+            sink = decoding_writer(writer, encoding)
+            for chunk in iter(lambda: stream.read(chunk_size), b""):
+                sink.write(chunk)
+            sink.flush()
+            return writer.finish()
+
+    remaining = read_header(stream)
+    payload_length = remaining
+    with open(path, "wb") as file:
+        while remaining:
+            chunk = stream.read(min(chunk_size, remaining))
+            if not chunk:
+                raise ValueError("Truncated model payload")
+            file.write(chunk)
+            remaining -= len(chunk)
+    return payload_length
+
+def load_model_file(path) -> dict:
+    """
+    Load a state_dict or bundle previously written to disk (path or file object).
+    """
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+def encode_saved_model(raw: bytes, binary: bool = False) -> bytes:
+    """
+    Encode bytes already produced by torch.save without loading them back into tensors.
+    """
+    if binary:
+        return pack_header(len(raw)) + raw
+    return base64.b64encode(raw)
+
+
+class PayloadWriter:
+    """
+    Write a binary model body to a file as it arrives in arbitrary pieces: the header is
+    validated first and the payload can never grow past the length it declares, which also
+    bounds how much a compressed body can expand to.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.payload_length = None
+        self._header = b""
+        self._remaining = None
+
+    def write(self, data) -> int:
+        size = len(data)
+        if self._remaining is None:
+            self._header += data
+            if len(self._header) < BINARY_HEADER.size:
+                return size
+            self._remaining = self.payload_length = read_header(io.BytesIO(self._header))
+            data = self._header[BINARY_HEADER.size:]
+        if len(data) > self._remaining:
+            raise ValueError("Model payload longer than its header")
+        self.file.write(data)
+        self._remaining -= len(data)
+        return size
+
+    def flush(self):
+        self.file.flush()
+
+    def finish(self) -> int:
+        """
+        Check the whole payload arrived and return its length.
+        """
+        if self._remaining is None:
+            raise ValueError("Truncated model header")
+        if self._remaining:
+            raise ValueError("Truncated model payload")
+        return self.payload_length
+
+
+class _GzipWriter:
+    """
+    Decompress gzip written to it into sink, at most CHUNK_SIZE bytes at a time.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+
+    def write(self, data) -> int:
+        size = len(data)
+        while data:
+            self.sink.write(self._decompressor.decompress(data, CHUNK_SIZE))
+            data = self._decompressor.unconsumed_tail
+        return size
+
+    def flush(self):
+        self.sink.write(self._decompressor.flush())
+        if not self._decompressor.eof:
+            raise ValueError("Truncated gzip body")
+
+
+def decoding_writer(sink, encoding: str = None):
+    """
+    Writer that decompresses a request body with the given Content-Encoding into sink.
+    """
+    if encoding in (None, "identity"):
+        return sink
+    if encoding == "gzip":
+        return _GzipWriter(sink)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_writer(sink, write_size=CHUNK_SIZE, closefd=False)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compress a body with one of CONTENT_ENCODINGS.
+    """
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def negotiate(accept_encoding: str, supported=CONTENT_ENCODINGS):
+    """
+    Pick our most preferred encoding the other side lists in an Accept-Encoding header, or None.
+    """
+    offered = set()
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        offered.add(name.strip().lower())
+    for encoding in supported:
+        if encoding in offered or "*" in offered:
+            return encoding
+    return None
+
+
+def _read_exact(stream, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise ValueError("Truncated model header")
+        data += chunk
+    return data
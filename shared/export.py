@@ -0,0 +1,90 @@
+import os
+import torch
+import torch.nn as nn
+
+import shared.preprocessing as pp
+
+
+EPSILON = 1e-8  # matches the live path's (x - mean) / (std + 1e-8)
+
+
+class InferenceModel(nn.Module):
+    """
+    Deployable model: normalisation is folded into the first Linear layer and tilt
+    de-normalisation into the last, so one forward maps raw telemetry to controller outputs.
+    Returns the 7 buttons as 0/1 (logit > 0 is sigmoid > 0.5) followed by the tilt.
+    """
+
+    def __init__(self, network: nn.Sequential, binary_outputs: int = pp.BINARY_OUTPUTS):
+        super().__init__()
+        self.network = network
+        self.binary_outputs = binary_outputs
+
+    def forward(self, telemetry: torch.Tensor) -> torch.Tensor:
+        outputs = self.network(telemetry)
+        buttons = (outputs[:, :self.binary_outputs] > 0).to(outputs.dtype)
+        return torch.cat([buttons, outputs[:, self.binary_outputs:]], dim=1)
+
+
+def inference_path(model_path):
+    """
+    Where the exported artifact of a saved model lives, e.g. models/federated_model_scripted.pt.
+    """
+    root, ext = os.path.splitext(model_path)
+    return f"{root}_scripted{ext or '.pt'}"
+
+
+def fold_normalisation(state_dict, norm_stats):
+    """
+    Build the base network with input and tilt normalisation folded into its weights:
+      first layer: W' = W / std, b' = b - W' @ mean
+      last layer (tilt row): w' = w * tilt_std, b' = b * tilt_std + tilt_mean
+    """
+    network = pp.generate_base_model()
+    network.load_state_dict(state_dict)
+    linears = [layer for layer in network if isinstance(layer, nn.Linear)]
+    first, last = linears[0], linears[-1]
+
+    input_mean = torch.tensor(norm_stats["input_mean"], dtype=torch.float64)
+    input_std = torch.tensor(norm_stats["input_std"], dtype=torch.float64) + EPSILON
+    tilt_mean, tilt_std = float(norm_stats["tilt_mean"]), float(norm_stats["tilt_std"])
+
+    with torch.no_grad():
+        weight = first.weight.double() / input_std
+        first.bias.copy_(first.bias.double() - weight @ input_mean)
+        first.weight.copy_(weight)
+
+        tilt = slice(pp.BINARY_OUTPUTS, None)
+        last.weight[tilt] *= tilt_std
+        last.bias[tilt] = last.bias[tilt] * tilt_std + tilt_mean
+    return network
+
+
+def export_inference_model(model_path, output_path=None):
+    """
+    Export a saved model bundle as a frozen TorchScript artifact with normalisation folded in.
+    Returns the artifact path, or None for bare state_dicts that carry no norm stats.
+    """
+    bundle = torch.load(model_path, map_location="cpu", weights_only=True)
+    if "state_dict" not in bundle or bundle.get("norm_stats") is None:
+        return None
+
+    model = InferenceModel(fold_normalisation(bundle["state_dict"], bundle["norm_stats"])).eval()
+    frozen = torch.jit.freeze(torch.jit.script(model))
+
+    output_path = output_path or inference_path(model_path)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    torch.jit.save(frozen, tmp_path)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def load_inference_model(model_path):
+    """
+    Load the exported artifact of a saved model, exporting it first if it is missing or older than the model.
+    """
+    path = inference_path(model_path)
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(model_path):
+        if export_inference_model(model_path, path) is None:
+            raise ValueError(f"{model_path} has no embedded norm stats to fold into an inference model")
+    return torch.jit.load(path, map_location="cpu")
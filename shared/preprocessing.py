@@ -1,4 +1,5 @@
 import pandas as pd
+import torch
 import torch.nn as nn
 
 INPUT_DIM = 8
@@ -55,3 +56,20 @@ def normalise_labels(df: pd.DataFrame, binary_cols_count=7, tilt_mean=None, tilt
     df_norm[tilt_col] = (df[tilt_col] - tilt_mean) / tilt_std
     
     return df_norm.fillna(0)
+
+
+def normalise_input_tensor(inputs: torch.Tensor, mean, std) -> torch.Tensor:
+    """
+    Tensor counterpart of normalise_inputs, for stats that are already known.
+    """
+    mean = torch.as_tensor(mean, dtype=inputs.dtype)
+    std = torch.as_tensor(std, dtype=inputs.dtype)
+    return ((inputs - mean) / std).nan_to_num(0)
+
+
+def normalise_label_tensor(labels: torch.Tensor, tilt_mean, tilt_std, binary_cols_count=BINARY_OUTPUTS) -> torch.Tensor:
+    """
+    Tensor counterpart of normalise_labels: binary outputs stay 0/1, tilt is z-scored.
+    """
+    tilt = (labels[:, binary_cols_count:] - tilt_mean) / tilt_std
+    return torch.cat([labels[:, :binary_cols_count], tilt], dim=1).nan_to_num(0)
@@ -0,0 +1,156 @@
+"""
+Pairwise-masking secure aggregation.
+
+Every client in a round's roster agrees a seed with every other client (Diffie-Hellman),
+expands each seed into a mask with a SHAKE-256 PRG, and adds the masks to its fixed-point
+update with opposite signs on either side of each pair. The masks cancel in the server's
+modular sum, so the server only ever sees the sum of the roster's updates.
+If a client drops out after the roster closed, the survivors reveal their seeds with it
+and the server removes the masks that no longer cancel.
+
+This is the honest-but-curious variant without self-masks: a server that lies about a
+dropout could unmask that client, so it protects uploads on the wire and on disk
+(to_be_federated/) rather than against a malicious server.
+"""
+
+import hashlib
+import secrets
+import numpy as np
+import torch
+
+
+# RFC 3526 group 14 (2048-bit MODP), generator 2
+DH_PRIME = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DD"
+    "EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F"
+    "83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA0510"
+    "15728E5A8AACAA68FFFFFFFFFFFFFFFF", 16
+)
+DH_GENERATOR = 2
+
+RING_BITS = 62  # masked values live in Z_2^62, reduced after every addition so int64 never overflows
+RING_MASK = (1 << RING_BITS) - 1
+FRAC_BITS = 16  # fixed-point precision of the encoded update
+
+
+def generate_keypair():
+    """
+    Fresh (private, public) Diffie-Hellman key pair for one round.
+    """
+    private_key = secrets.randbits(256)
+    return private_key, pow(DH_GENERATOR, private_key, DH_PRIME)
+
+
+def pair_seed(private_key, peer_public_key, round_number, client_id, peer_id):
+    """
+    Seed shared by two roster members for one round, derived from their Diffie-Hellman secret.
+    """
+    if not 1 < peer_public_key < DH_PRIME - 1:
+        raise ValueError("Invalid peer public key")
+    secret = pow(peer_public_key, private_key, DH_PRIME)
+    low, high = sorted((client_id, peer_id))
+    digest = hashlib.sha256()
+    digest.update(secret.to_bytes(256, "big"))
+    digest.update(f"{round_number}:{low}:{high}".encode())
+    return digest.digest()
+
+
+def prg_mask(seed, numel):
+    """
+    Expand a seed into a mask vector over Z_2^62 with SHAKE-256.
+    """
+    stream = hashlib.shake_256(seed).digest(numel * 8)
+    values = np.frombuffer(stream, dtype="<u8") & np.uint64(RING_MASK)
+    return torch.from_numpy(values.astype(np.int64))
+
+
+def pair_sign(client_id, peer_id):
+    """
+    +1 for the lower id of a pair and -1 for the higher one, so the pair's masks cancel.
+    """
+    return 1 if client_id < peer_id else -1
+
+
+def encode_fixed(vector):
+    """
+    Encode a float vector as fixed-point values in Z_2^62.
+    """
+    scaled = torch.round(vector.to(torch.float64) * (1 << FRAC_BITS)).to(torch.int64)
+    return scaled & RING_MASK
+
+
+def decode_fixed(values):
+    """
+    Decode a sum in Z_2^62 back to floats, reading the top half of the ring as negative.
+    """
+    values = values & RING_MASK
+    values = torch.where(values >= 1 << (RING_BITS - 1), values - (1 << RING_BITS), values)
+    return values.to(torch.float64) / (1 << FRAC_BITS)
+
+
+def pack_update(flat, norm_stats, norm_stat_keys):
+    """
+    Sample-weighted vector a client masks: [n * weights, n * norm stats, n].
+    Summing these lets the server recover sample-weighted averages without seeing any single client.
+    Returns the vector and the (key, size, is_list) layout of its norm stats, which is sent in clear.
+    """
+    num_samples = float(norm_stats.get("num_samples", 1))
+    stats, stats_layout = [], []
+    for key in norm_stat_keys:
+        value = norm_stats[key]
+        stats.append(torch.as_tensor(value, dtype=torch.float64).reshape(-1))
+        stats_layout.append((key, stats[-1].numel(), isinstance(value, (list, tuple))))
+    packed = torch.cat([flat.to(torch.float64), *stats, torch.ones(1, dtype=torch.float64)]) * num_samples
+    return packed, stats_layout
+
+
+def unpack_sum(vector, numel, stats_layout):
+    """
+    Turn the unmasked sum back into (averaged flat weights, averaged norm stats).
+    """
+    total = vector[-1].item()
+    if total <= 0:
+        raise ValueError("Secure sum has no samples")
+
+    average = vector / total
+    norm_stats, offset = {}, numel
+    for key, size, is_list in stats_layout:
+        values = average[offset:offset + size]
+        norm_stats[key] = values.tolist() if is_list else values.item()
+        offset += size
+    norm_stats["num_samples"] = int(round(total))
+    return average[:numel].to(torch.float32), norm_stats
+
+
+def mask_update(packed, client_id, round_number, private_key, peer_public_keys):
+    """
+    Fixed-point encode a packed update and add one pairwise mask per roster peer.
+    peer_public_keys maps every other roster member's id to its public key.
+    """
+    masked = encode_fixed(packed)
+    for peer_id, public_key in peer_public_keys.items():
+        if peer_id == client_id:
+            continue
+        seed = pair_seed(private_key, public_key, round_number, client_id, peer_id)
+        masked += pair_sign(client_id, peer_id) * prg_mask(seed, masked.numel())
+        masked &= RING_MASK
+    return masked
+
+
+def add_masked(total, masked):
+    """
+    Fold one masked upload into the server's running sum.
+    """
+    return masked.clone() if total is None else (total + masked) & RING_MASK
+
+
+def remove_dropout_masks(total, revealed_seeds):
+    """
+    Cancel the masks survivors added for clients that dropped out.
+    revealed_seeds maps (survivor id, dropped id) to the pair's seed.
+    """
+    for (survivor_id, dropped_id), seed in revealed_seeds.items():
+        total = (total - pair_sign(survivor_id, dropped_id) * prg_mask(seed, total.numel())) & RING_MASK
+    return total
@@ -0,0 +1,153 @@
+"""
+Batched simulation of many federated clients in one process.
+
+Every client's copy of the base model is a slice of one stacked set of parameters,
+and a training step for all of them is a single vmapped forward/backward
+(torch.func.functional_call + grad) followed by a vectorised Adam update.
+Each client still sees only its own shard, normalised with its own stats, and takes
+as many steps per epoch as its shard has batches, like separate client.py runs.
+"""
+
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, grad, vmap
+
+import shared.preprocessing as pp
+import shared.training as tr
+
+
+PARTITIONS = ("contiguous", "iid")
+ADAM_BETAS = (0.9, 0.999)  # torch.optim.Adam defaults, matching tr.OPTIMISER
+ADAM_EPS = 1e-8
+MAX_GRAD_NORM = 1.0
+LOSS_WEIGHTS = (1.0, 0.5)
+
+
+def partition_rows(num_rows, num_clients, partition="contiguous", generator=None):
+    """
+    Split row indices into one shard per client.
+    contiguous gives each client a consecutive stretch of frames, like its own recording session;
+    iid deals shuffled rows out evenly.
+    """
+    if partition not in PARTITIONS:
+        raise ValueError(f"Unknown partition: {partition}")
+    if num_clients < 1 or num_clients > num_rows:
+        raise ValueError(f"Cannot split {num_rows} rows between {num_clients} clients")
+    order = torch.arange(num_rows) if partition == "contiguous" else torch.randperm(num_rows, generator=generator)
+    return list(torch.tensor_split(order, num_clients))
+
+
+def normalise_shards(inputs, labels, shards):
+    """
+    Normalise every shard with its own norm stats, as each client does locally.
+    Returns the normalised rows concatenated shard by shard, each shard's (start, length) in them, and the stats.
+    """
+    inputs, labels = tr.as_tensor(inputs), tr.as_tensor(labels)
+    shard_inputs, shard_labels, spans, norm_stats_list = [], [], [], []
+    start = 0
+    for rows in shards:
+        x, y = inputs[rows], labels[rows]
+        norm_stats = tr.compute_norm_stats(x, y)
+        shard_inputs.append(pp.normalise_input_tensor(x, norm_stats["input_mean"], norm_stats["input_std"]))
+        shard_labels.append(pp.normalise_label_tensor(y, norm_stats["tilt_mean"], norm_stats["tilt_std"]))
+        spans.append((start, len(rows)))
+        norm_stats_list.append(norm_stats)
+        start += len(rows)
+    return torch.cat(shard_inputs), torch.cat(shard_labels), spans, norm_stats_list
+
+
+def stack_params(state_dict, num_clients):
+    """
+    One leading client dimension on every tensor of a state_dict.
+    """
+    return {k: v.detach().to(torch.float32).unsqueeze(0).repeat(num_clients, *[1] * v.dim()).contiguous()
+            for k, v in state_dict.items()}
+
+
+def unstack_params(params):
+    """
+    Per-client state_dicts from stacked parameters.
+    """
+    num_clients = next(iter(params.values())).shape[0]
+    return [{k: v[i].clone() for k, v in params.items()} for i in range(num_clients)]
+
+
+def epoch_batches(spans, batch_size, generator=None):
+    """
+    Row indices and sample weights of one epoch for every client: (clients, steps, batch_size) each.
+    Every client shuffles its own shard; short shards and final partial batches are padded with zero weight.
+    """
+    steps = max((length + batch_size - 1) // batch_size for _, length in spans)
+    index = torch.zeros(len(spans), steps * batch_size, dtype=torch.long)
+    weight = torch.zeros(len(spans), steps * batch_size)
+    for i, (start, length) in enumerate(spans):
+        index[i, :length] = start + torch.randperm(length, generator=generator)
+        weight[i, :length] = 1
+    return index.view(len(spans), steps, batch_size), weight.view(len(spans), steps, batch_size)
+
+
+class BatchedClients:
+    """
+    N copies of the base model trained side by side from a shared starting state_dict.
+    Matches tr.train_model's optimisation: Adam, per-client gradient clipping and the compute_metrics loss.
+    """
+
+    def __init__(self, state_dict, num_clients, learning_rate=tr.LEARNING_RATE, device="cpu"):
+        self.device = torch.device(device)
+        self.model = pp.generate_base_model().to("meta")
+        self.params = {k: v.to(self.device) for k, v in stack_params(state_dict, num_clients).items()}
+        self.learning_rate = learning_rate
+        self.num_clients = num_clients
+        self._exp_avg = {k: torch.zeros_like(v) for k, v in self.params.items()}
+        self._exp_avg_sq = {k: torch.zeros_like(v) for k, v in self.params.items()}
+        self._steps = torch.zeros(num_clients, device=self.device)
+        self._grad_fn = vmap(grad(self._loss))
+
+    def _loss(self, params, inputs, labels, weight):
+        preds = functional_call(self.model, params, (inputs,))
+        binary = pp.BINARY_OUTPUTS
+        bce = F.binary_cross_entropy_with_logits(preds[:, :binary], labels[:, :binary], reduction="none").mean(dim=1)
+        mse = ((preds[:, binary:] - labels[:, binary:]) ** 2).mean(dim=1)
+        per_sample = LOSS_WEIGHTS[0] * bce + LOSS_WEIGHTS[1] * mse
+        return (per_sample * weight).sum() / weight.sum().clamp(min=1)
+
+    def step(self, inputs, labels, weight):
+        """
+        One optimiser step for every client on (clients, batch, ...) tensors.
+        Clients whose batch is all padding are left untouched, optimiser state included.
+        """
+        grads = self._grad_fn(self.params, inputs, labels, weight)
+        active = (weight.sum(dim=1) > 0).to(torch.float32)
+
+        with torch.no_grad():
+            norms = torch.stack([g.flatten(1).pow(2).sum(dim=1) for g in grads.values()]).sum(dim=0).sqrt()
+            clip = (MAX_GRAD_NORM / (norms + 1e-6)).clamp(max=1.0)
+
+            self._steps += active
+            beta1, beta2 = ADAM_BETAS
+            bias1 = 1 - beta1 ** self._steps.clamp(min=1)
+            bias2 = 1 - beta2 ** self._steps.clamp(min=1)
+            decay1 = torch.where(active > 0, beta1, 1.0)
+            decay2 = torch.where(active > 0, beta2, 1.0)
+            for key, param in self.params.items():
+                shape = (-1,) + (1,) * (param.dim() - 1)
+                g = grads[key] * (clip * active).view(shape)
+                exp_avg = self._exp_avg[key].mul_(decay1.view(shape)).add_(g, alpha=1 - beta1)
+                exp_avg_sq = self._exp_avg_sq[key].mul_(decay2.view(shape)).addcmul_(g, g, value=1 - beta2)
+                denom = (exp_avg_sq / bias2.view(shape)).sqrt_().add_(ADAM_EPS)
+                param.sub_(self.learning_rate * active.view(shape) * exp_avg / bias1.view(shape) / denom)
+
+    def train(self, inputs, labels, spans, epochs=tr.EPOCHS, batch_size=tr.BATCH_SIZE, generator=None):
+        """
+        Run every client for the given epochs over its span of the normalised rows.
+        """
+        inputs, labels = inputs.to(self.device), labels.to(self.device)
+        for _ in range(epochs):
+            index, weight = epoch_batches(spans, batch_size, generator)
+            index, weight = index.to(self.device), weight.to(self.device)
+            for s in range(index.shape[1]):
+                rows = index[:, s]
+                self.step(inputs[rows], labels[rows], weight[:, s])
+
+    def state_dicts(self):
+        return [{k: v.cpu() for k, v in sd.items()} for sd in unstack_params(self.params)]
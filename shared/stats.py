@@ -0,0 +1,154 @@
+"""
+Mergeable normalisation statistics.
+
+Norm stats carry, next to the means and standard deviations the models use, the per-column
+count and M2 (sum of squared deviations from the mean) they were computed from.
+Those three numbers merge exactly (Chan et al.), so stats can be accumulated chunk by chunk
+over a recording, across runs, across clients and across edge aggregators, and always
+equal the stats of all the underlying rows pooled together.
+"""
+
+import torch
+
+
+CHUNK_ROWS = 1 << 16  # rows converted to float64 at a time
+NORM_STAT_KEYS = ("input_mean", "input_std", "tilt_mean", "tilt_std")
+MOMENT_KEYS = ("input_count", "input_m2", "tilt_count", "tilt_m2")
+
+
+class RunningStats:
+    """
+    Per-column count, mean and M2 of a stream of rows, ignoring NaNs like pandas' mean()/std().
+    Works on (rows, columns) tensors or on (rows,) tensors for a single column.
+    """
+
+    def __init__(self, count=None, mean=None, m2=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def of(cls, values: torch.Tensor):
+        """
+        Stats of one chunk, with a two-pass mean/M2 for precision.
+        """
+        values = values.to(torch.float64)
+        present = ~values.isnan()
+        count = present.sum(dim=0).to(torch.float64)
+        mean = values.nansum(dim=0) / count.clamp(min=1)
+        deviations = torch.where(present, values - mean, torch.zeros_like(values))
+        return cls(count, mean, (deviations ** 2).sum(dim=0))
+
+    @classmethod
+    def of_chunks(cls, values: torch.Tensor, chunk_rows=CHUNK_ROWS):
+        """
+        Stats of a tensor too large to copy to float64 at once, e.g. a memory-mapped dataset column.
+        """
+        stats = cls()
+        for start in range(0, len(values), chunk_rows):
+            stats.update(values[start:start + chunk_rows])
+        return stats if stats.count is not None else cls.of(values)
+
+    def update(self, values: torch.Tensor):
+        """
+        Fold a chunk of rows in.
+        """
+        merged = self.merge(RunningStats.of(values))
+        self.count, self.mean, self.m2 = merged.count, merged.mean, merged.m2
+        return self
+
+    def merge(self, other):
+        """
+        Exact stats of the union of two disjoint sets of rows.
+        """
+        if self.count is None:
+            return other
+        if other.count is None:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        share = torch.where(count > 0, other.count / count.clamp(min=1), torch.zeros_like(count))
+        mean = self.mean + delta * share
+        m2 = self.m2 + other.m2 + delta ** 2 * self.count * share
+        return RunningStats(count, mean, m2)
+
+    def std(self):
+        """
+        Sample standard deviation, with 1 for constant or (near-)empty columns to avoid dividing by zero.
+        """
+        std = (self.m2 / (self.count - 1).clamp(min=1)).sqrt()
+        return torch.where((self.count < 2) | (std == 0) | std.isnan(), torch.ones_like(std), std)
+
+
+def compute_norm_stats(inputs: torch.Tensor, tilt: torch.Tensor, chunk_rows=CHUNK_ROWS) -> dict:
+    """
+    Norm stats of an input matrix and tilt column, accumulated a chunk of rows at a time.
+    """
+    input_stats = RunningStats.of_chunks(inputs, chunk_rows)
+    tilt_stats = RunningStats.of_chunks(tilt, chunk_rows)
+    return to_norm_stats(input_stats, tilt_stats, len(inputs))
+
+
+def to_norm_stats(input_stats, tilt_stats, num_samples) -> dict:
+    """
+    Bundle-ready norm stats: what the models normalise with, plus the moments they merge with.
+    """
+    return {
+        "input_mean": input_stats.mean.tolist(),
+        "input_std": input_stats.std().tolist(),
+        "tilt_mean": tilt_stats.mean.item(),
+        "tilt_std": tilt_stats.std().item(),
+        "num_samples": int(num_samples),
+        "input_count": input_stats.count.tolist(),
+        "input_m2": input_stats.m2.tolist(),
+        "tilt_count": tilt_stats.count.item(),
+        "tilt_m2": tilt_stats.m2.item(),
+    }
+
+
+def mergeable(norm_stats) -> bool:
+    """
+    Whether norm stats can be merged exactly: they carry their sample count, and either their
+    moments or the standard deviations to rebuild them from.
+    """
+    return norm_stats is not None and "num_samples" in norm_stats
+
+
+def from_norm_stats(norm_stats):
+    """
+    (input, tilt) RunningStats of a norm stats dict. Stats from before moments were shipped
+    are rebuilt from their standard deviations and sample count.
+    """
+    input_mean = torch.tensor(norm_stats["input_mean"], dtype=torch.float64)
+    tilt_mean = torch.tensor(norm_stats["tilt_mean"], dtype=torch.float64)
+    if all(key in norm_stats for key in MOMENT_KEYS):
+        return (
+            RunningStats(torch.tensor(norm_stats["input_count"], dtype=torch.float64), input_mean,
+                         torch.tensor(norm_stats["input_m2"], dtype=torch.float64)),
+            RunningStats(torch.tensor(norm_stats["tilt_count"], dtype=torch.float64), tilt_mean,
+                         torch.tensor(norm_stats["tilt_m2"], dtype=torch.float64)),
+        )
+
+    n = float(norm_stats["num_samples"])
+    input_std = torch.tensor(norm_stats["input_std"], dtype=torch.float64)
+    tilt_std = torch.tensor(norm_stats["tilt_std"], dtype=torch.float64)
+    return (
+        RunningStats(torch.full_like(input_mean, n), input_mean, input_std ** 2 * max(n - 1, 0)),
+        RunningStats(torch.tensor(n, dtype=torch.float64), tilt_mean, tilt_std ** 2 * max(n - 1, 0)),
+    )
+
+
+def merge_norm_stats(norm_stats_list) -> dict:
+    """
+    Exact norm stats of the pooled data behind several norm stats dicts. None entries are skipped.
+    """
+    input_stats, tilt_stats, num_samples = RunningStats(), RunningStats(), 0
+    for norm_stats in norm_stats_list:
+        if norm_stats is None:
+            continue
+        inputs, tilt = from_norm_stats(norm_stats)
+        input_stats, tilt_stats = input_stats.merge(inputs), tilt_stats.merge(tilt)
+        num_samples += int(norm_stats["num_samples"])
+    if input_stats.count is None:
+        return None
+    return to_norm_stats(input_stats, tilt_stats, num_samples)
@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+import torch
+
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "manifest.lock"
+
+
+class ModelStore:
+    """
+    Content-addressed store of model snapshots by round.
+    Each distinct model is kept once under objects/<sha256>.pt and every round file
+    (e.g. federated_model_round3.pt) is a hard link to its object, indexed in manifest.json.
+    """
+
+    def __init__(self, root, retention=None):
+        self.root = root
+        self.retention = retention or None  # rounds kept per kind, None keeps all
+        self.objects = os.path.join(root, "objects")
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        os.makedirs(self.objects, exist_ok=True)
+
+    def round_path(self, kind, round_number):
+        """
+        Path of a round snapshot, in the layout compare.py reads.
+        """
+        return os.path.join(self.root, f"{kind}_model_round{round_number}.pt")
+
+    def put(self, kind, round_number, source_path):
+        """
+        Snapshot a saved model as the given round. Returns its content digest.
+        """
+        digest = _file_digest(source_path)
+        object_path = os.path.join(self.objects, f"{digest}.pt")
+        if not os.path.exists(object_path):
+            tmp_path = f"{object_path}.{os.getpid()}.tmp"
+            shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, object_path)
+
+        with _ManifestLock(os.path.join(self.root, LOCK_NAME)):
+            manifest = self._read_manifest()
+            entries = manifest.setdefault(kind, {})
+            entries[str(round_number)] = {"digest": digest, "created_at": time.time()}
+            _link(object_path, self.round_path(kind, round_number))
+            self._evict(manifest)
+            self._write_manifest(manifest)
+        return digest
+
+    def rounds(self, kind):
+        """
+        Round numbers stored for a kind, oldest first.
+        """
+        return sorted(int(r) for r in self._read_manifest().get(kind, {}))
+
+    def latest_round(self, kind):
+        """
+        Most recent round stored for a kind, or None.
+        """
+        rounds = self.rounds(kind)
+        return rounds[-1] if rounds else None
+
+    def load(self, kind, round_number, mmap=True):
+        """
+        Load a round snapshot. With mmap the tensors are memory-mapped and only paged in when used.
+        """
+        return torch.load(self.round_path(kind, round_number), map_location="cpu", weights_only=True, mmap=mmap)
+
+    def restore(self, kind, round_number, dest_path):
+        """
+        Roll a live model file back to a stored round.
+        """
+        tmp_path = f"{dest_path}.{os.getpid()}.tmp"
+        shutil.copyfile(self.round_path(kind, round_number), tmp_path)
+        os.replace(tmp_path, dest_path)
+
+    def _evict(self, manifest):
+        if self.retention is None:
+            return
+
+        for kind, entries in manifest.items():
+            rounds = sorted(entries, key=int)
+            for r in rounds[:-self.retention]:
+                del entries[r]
+                path = self.round_path(kind, r)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        referenced = {entry["digest"] for entries in manifest.values() for entry in entries.values()}
+        for name in os.listdir(self.objects):
+            if name.endswith(".pt") and name[:-3] not in referenced:
+                os.remove(os.path.join(self.objects, name))
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as file:
+            return json.load(file)
+
+    def _write_manifest(self, manifest):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+
+class _ManifestLock:
+    """
+    Cross-platform exclusive lock file, so the server and the centralised trainer can both write the manifest.
+    The file records its holder's host, pid and start time, so a lock left behind by a killed process is
+    broken: at once if the holder was on this host and is gone, otherwise once it is older than stale_after.
+    """
+
+    def __init__(self, path, timeout=30, stale_after=120):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._break_if_stale():
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Timed out waiting for {self.path}")
+                time.sleep(0.05)
+                continue
+            with os.fdopen(fd, "w") as file:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}, file)
+            return self
+
+    def __exit__(self, exc_type, exc, tb):
+        os.remove(self.path)
+        return False
+
+    def _break_if_stale(self):
+        """
+        Remove the lock file if its holder is gone. Returns True if it was removed.
+        """
+        try:
+            with open(self.path) as file:
+                content = file.read()
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return True
+        try:
+            holder = json.loads(content)
+            age = time.time() - holder["time"]
+        except (ValueError, KeyError):
+            # Just created and not written yet, or left by an older version: judge by the file's age
+            holder, age = {}, time.time() - mtime
+
+        if age < self.stale_after and (holder.get("host") != socket.gethostname() or _pid_alive(holder["pid"])):
+            return False
+
+        # Move the file aside before removing it, and put it back if another waiter already replaced
+        # the stale lock with a live one in the meantime
+        stale_path = f"{self.path}.{os.getpid()}.stale"
+        try:
+            os.replace(self.path, stale_path)
+        except FileNotFoundError:
+            return True
+        with open(stale_path) as file:
+            if file.read() != content:
+                try:
+                    os.link(stale_path, self.path)
+                except FileExistsError:
+                    pass
+                os.remove(stale_path)
+                return False
+        os.remove(stale_path)
+        print(f"Broke stale lock {self.path} held by {holder or 'an unknown process'}")
+        return True
+
+
+def _pid_alive(pid):
+    if os.name != "posix":
+        return True  # os.kill(pid, 0) would terminate the process on Windows; rely on stale_after there
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link(object_path, round_path):
+    tmp_path = f"{round_path}.{os.getpid()}.tmp"
+    try:
+        os.link(object_path, tmp_path)
+    except OSError:
+        shutil.copyfile(object_path, tmp_path)
+    os.replace(tmp_path, round_path)
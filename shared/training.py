@@ -1,56 +1,215 @@
+import io
+import os
+import time
+import hashlib
+import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
-from torch.utils.data import TensorDataset, DataLoader
 
+import shared.dataset as ds
 import shared.preprocessing as pp
+import shared.stats as ns
 
 
 OPTIMISER = torch.optim.Adam
 LEARNING_RATE = 1e-4
 EPOCHS = 25
 BATCH_SIZE = 256
+EVAL_BATCH_SIZE = 4096
 
+VALIDATION_SPLIT = 0     # fraction of the most recent frames held out for early stopping (e.g. 0.1), 0 trains on everything
+PATIENCE = 0            # epochs without a validation improvement before stopping (e.g. 3), 0 always runs every epoch
+MIN_DELTA = 1e-4        # smallest drop in validation loss that counts as an improvement
 
-import torch
-import torch.nn as nn
+ACCELERATE = False      # compile the forward/loss and the clip/optimiser halves of the training step with torch.compile
+BF16 = False            # bf16 autocast for the forward pass where the hardware runs bf16 natively; only pays off for wider models
+LOSS_WEIGHTS = (1.0, 0.5)
+MAX_GRAD_NORM = 1.0
+
+IDENTITY_BYTES = 1 << 16  # leading bytes of each CSV hashed into a watermark to detect rewrites
+
+CRITERION_BINARY = nn.BCEWithLogitsLoss()
+CRITERION_CONT = nn.MSELoss()
 
-def compute_metrics(preds: torch.Tensor, labels: torch.Tensor, binary_cols_count: int, loss_weights=(1.0, 0.5)):
+
+def compute_loss(preds: torch.Tensor, labels: torch.Tensor, binary_cols_count: int, loss_weights=LOSS_WEIGHTS):
+    """
+    Weighted sum of the binary buttons' BCE and the continuous tilt's MSE, always in float32.
+    """
+    preds = preds.float()
+    loss_binary = CRITERION_BINARY(preds[:, :binary_cols_count], labels[:, :binary_cols_count])
+    loss_steer = CRITERION_CONT(preds[:, binary_cols_count:], labels[:, binary_cols_count:])
+    return loss_weights[0] * loss_binary + loss_weights[1] * loss_steer
+
+
+def compute_metrics(preds: torch.Tensor, labels: torch.Tensor, binary_cols_count: int, loss_weights=LOSS_WEIGHTS):
     """
     Compute losses and metrics for mixed outputs:
       - binary buttons
       - continuous tilt
     """
-    preds_binary = preds[:, :binary_cols_count]
-    preds_steer = preds[:, binary_cols_count:]
-    
-    labels_binary = labels[:, :binary_cols_count]
-    labels_steer = labels[:, binary_cols_count:]
-    
-    # Losses
-    criterion_binary = nn.BCEWithLogitsLoss()
-    criterion_cont = nn.MSELoss()
-    
-    loss_binary = criterion_binary(preds_binary, labels_binary)
-    loss_steer = criterion_cont(preds_steer, labels_steer)
-    
-    # Weighted sum
-    total_loss = loss_weights[0] * loss_binary + loss_weights[1] * loss_steer
+    total_loss = compute_loss(preds, labels, binary_cols_count, loss_weights)
+    binary_acc, steer_mae = _accuracy_and_mae(preds, labels, binary_cols_count)
     
+    return {
+        "loss": total_loss,
+        "binary_acc": binary_acc.item(),
+        "steer_mae": steer_mae.item()
+    }
+
+
+def _accuracy_and_mae(preds: torch.Tensor, labels: torch.Tensor, binary_cols_count: int):
+    """
+    Binary accuracy and steer MAE as tensors, so a compiled training step can compute them in-graph.
+    """
     with torch.no_grad():
         # Binary accuracy
-        preds_bin_sig = torch.sigmoid(preds_binary)
+        preds_bin_sig = torch.sigmoid(preds[:, :binary_cols_count])
         pred_labels = (preds_bin_sig > 0.5).float()
-        binary_acc = (pred_labels == labels_binary).float().mean().item()
+        binary_acc = (pred_labels == labels[:, :binary_cols_count]).float().mean()
         
         # Steer MAE
-        steer_mae = torch.mean(torch.abs(preds_steer - labels_steer)).item()
-    
-    return {
-        "loss": total_loss,
-        "binary_acc": binary_acc,
-        "steer_mae": steer_mae
-    }
+        steer_mae = torch.mean(torch.abs(preds[:, binary_cols_count:] - labels[:, binary_cols_count:]))
+    return binary_acc, steer_mae
+
+
+class BatchIterator:
+    """
+    Mini-batches over preloaded tensors, with the semantics of DataLoader(TensorDataset(...)):
+    a fresh random order each epoch (when shuffling) and a smaller final batch.
+    Each epoch does one permutation gather per tensor and then yields contiguous slices of it,
+    instead of indexing and collating sample by sample.
+    With a device, the tensors are moved there once up front when preload is set, otherwise
+    each batch is copied from pinned memory while the previous one is being used.
+    """
+
+    def __init__(self, *tensors, batch_size=BATCH_SIZE, shuffle=True, device=None, preload=True):
+        if len({len(t) for t in tensors}) > 1:
+            raise ValueError("All tensors must have the same number of rows")
+        self.device = torch.device(device) if device is not None else tensors[0].device
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.preload = preload or self.device.type == "cpu"
+        if self.preload:
+            tensors = tuple(t.to(self.device) for t in tensors)
+        elif self.device.type == "cuda":
+            tensors = tuple(t.pin_memory() for t in tensors)
+        self.tensors = tensors
+        self.num_rows = len(tensors[0])
+
+    def __len__(self):
+        return (self.num_rows + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.shuffle:
+            order = torch.randperm(self.num_rows, device=tensors[0].device)
+            tensors = tuple(t[order] for t in tensors)
+        batches = (tuple(t[start:start + self.batch_size] for t in tensors) for start in range(0, self.num_rows, self.batch_size))
+        if self.preload:
+            yield from batches
+            return
+
+        # Keep one batch in flight so the host-to-device copy overlaps with compute
+        pending = None
+        for batch in batches:
+            batch = tuple(t.to(self.device, non_blocking=True) for t in batch)
+            if pending is not None:
+                yield pending
+            pending = batch
+        if pending is not None:
+            yield pending
+
+
+def evaluate_model(model, inputs: torch.Tensor, labels: torch.Tensor, batch_size=EVAL_BATCH_SIZE):
+    """
+    Per-frame loss and metrics over normalised tensors, computed a batch at a time.
+    """
+    was_training = model.training
+    model.eval()
+    totals = {"loss": 0.0, "binary_acc": 0.0, "steer_mae": 0.0}
+    with torch.no_grad():
+        for batch_inputs, batch_labels in BatchIterator(inputs, labels, batch_size=batch_size, shuffle=False):
+            metrics = compute_metrics(model(batch_inputs), batch_labels, binary_cols_count=pp.BINARY_OUTPUTS)
+            for key in totals:
+                totals[key] += float(metrics[key]) * len(batch_inputs)
+    model.train(was_training)
+    return {key: value / max(len(inputs), 1) for key, value in totals.items()}
+
+
+def autocast_dtype(device):
+    """
+    bfloat16 if the device runs it natively (CUDA with bf16, or a CPU with AVX-512 BF16/AMX), else None.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else None
+    if torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        return torch.bfloat16
+    return None
+
+
+def make_train_step(model, optimiser, device, accelerate=ACCELERATE, bf16=BF16):
+    """
+    One optimisation step on a batch: forward pass, compute_loss(), backward, gradient clipping
+    and the optimiser update. Returns the batch's compute_metrics() dict.
+    accelerate compiles the forward/loss and the clip/update with torch.compile, falling back to eager
+    if compiling fails (e.g. no C++ compiler), in which case the returned step's accelerated attribute is
+    cleared; bf16 runs the forward pass under autocast when autocast_dtype() allows it.
+    """
+    dtype = autocast_dtype(device) if bf16 else None
+    device_type = torch.device(device).type
+
+    def forward(inputs, labels):
+        with torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
+            preds = model(inputs).float()
+        return compute_loss(preds, labels, pp.BINARY_OUTPUTS), *_accuracy_and_mae(preds, labels, pp.BINARY_OUTPUTS)
+
+    def update():
+        torch.nn.utils.clip_grad_norm_(model.parameters(), MAX_GRAD_NORM)
+        optimiser.step()
+
+    compiled = (torch.compile(forward, dynamic=False), torch.compile(update)) if accelerate else None
+    if accelerate or bf16:
+        print(f"Training step: {'compiled' if accelerate else 'eager'}, {'bf16 autocast' if dtype is not None else 'float32'}")
+
+    def run(index, *args):
+        nonlocal compiled
+        if compiled is not None:
+            try:
+                return compiled[index](*args)
+            except Exception as error:
+                # No C++ compiler (e.g. slim images) means eager, not a crash. Errors that are not the
+                # compiler's are raised again by the eager call below.
+                print(f"torch.compile failed, training eagerly: {type(error).__name__}: {str(error).strip().splitlines()[0]}")
+                compiled = None
+                train_step.accelerated = False
+        return (forward, update)[index](*args)
+
+    def train_step(inputs, labels):
+        loss, binary_acc, steer_mae = run(0, inputs, labels)
+        optimiser.zero_grad()
+        loss.backward()
+        run(1)
+        return {"loss": loss.detach(), "binary_acc": binary_acc.item(), "steer_mae": steer_mae.item()}
+
+    train_step.accelerated = accelerate
+    return train_step
+
+
+def split_validation(inputs: torch.Tensor, labels: torch.Tensor, validation_split=VALIDATION_SPLIT):
+    """
+    Hold out the last validation_split of the rows, returning (train_inputs, train_labels, val_inputs, val_labels).
+    Frames are recorded in order and neighbouring ones are near-duplicates, so the most recent stretch
+    is held out rather than a random sample. The validation tensors are None when the split is disabled
+    or the dataset is too small to leave rows on both sides.
+    """
+    num_val = int(len(inputs) * validation_split)
+    if num_val < 1 or num_val >= len(inputs):
+        return inputs, labels, None, None
+    cut = len(inputs) - num_val
+    return inputs[:cut], labels[:cut], inputs[cut:], labels[cut:]
 
 
 def scale_model_weights(model, framecount, lap_completion, target_frame=3500, target_lap=3, scale_min=0.8, scale_max=1.2):
@@ -74,51 +233,179 @@ def scale_model_weights(model, framecount, lap_completion, target_frame=3500, ta
     return model
 
 
-def update_model(model, inputs_path, labels_path, optimiser=OPTIMISER, epochs=EPOCHS, batch_size=BATCH_SIZE, learning_rate=LEARNING_RATE):
+def _file_identity(path, length):
+    """
+    (length, SHA-256 of the first length bytes) of a file, to tell an appended-to CSV from one
+    that was truncated and rewritten.
+    """
+    with open(path, "rb") as file:
+        return [length, hashlib.sha256(file.read(length)).hexdigest()]
+
+
+def _watermark_valid(path, watermark, key):
+    """
+    Whether the file still starts with what was there when the watermark was taken.
+    """
+    offset = watermark.get(f"{key}_offset", 0)
+    if offset > os.path.getsize(path):
+        return False
+    identity = watermark.get(f"{key}_identity")
+    return identity is None or _file_identity(path, identity[0]) == identity
+
+
+def read_appended_rows(inputs_path, labels_path, watermark=None):
+    """
+    Read only the input/label rows appended since the watermark (byte offsets into each CSV).
+    Partially written trailing lines are left for the next run, and both files are cut to
+    the same number of rows so they stay aligned.
+    If either CSV shrank or its start no longer matches the watermark's identity, both are
+    read from the top again.
+    Returns (inputs, labels, new_watermark, reset).
+    """
+    watermark = watermark or {}
+    paths = ((inputs_path, "inputs"), (labels_path, "labels"))
+    reset = bool(watermark) and not all(_watermark_valid(path, watermark, key) for path, key in paths)
+    if reset:
+        watermark = {}
+
+    chunks = []
+    columns = []
+    for path, key in paths:
+        with open(path, "rb") as file:
+            header = file.readline()
+            offset = max(watermark.get(f"{key}_offset", 0), len(header))
+            file.seek(offset)
+            data = file.read()
+        columns.append(header.decode().strip().split(","))
+        chunks.append((offset, data[:data.rfind(b"\n") + 1]))
+
+    num_rows = min(data.count(b"\n") for _, data in chunks)
+    frames = []
+    offsets = []
+    for (offset, data), names in zip(chunks, columns):
+        data = b"".join(data.splitlines(keepends=True)[:num_rows])
+        frames.append(pd.read_csv(io.BytesIO(data), header=None, names=names) if num_rows else pd.DataFrame(columns=names))
+        offsets.append(offset + len(data))
+
+    new_watermark = {"rows": watermark.get("rows", 0) + num_rows}
+    for (path, key), offset in zip(paths, offsets):
+        new_watermark[f"{key}_offset"] = offset
+        new_watermark[f"{key}_identity"] = _file_identity(path, min(offset, IDENTITY_BYTES))
+    return frames[0], frames[1], new_watermark, reset
+
+
+def as_tensor(data) -> torch.Tensor:
+    """
+    Float32 tensor of a DataFrame or tensor, without copying tensors that already are.
+    """
+    if isinstance(data, pd.DataFrame):
+        return torch.from_numpy(data.to_numpy(dtype=np.float32))
+    return data.to(torch.float32)
+
+
+def compute_norm_stats(inputs, labels) -> dict:
+    """
+    Compute input and tilt normalisation stats over a dataset (DataFrames or tensors).
+    The stats carry their counts and M2, so they can later be merged exactly with ns.merge_norm_stats().
+    """
+    return ns.compute_norm_stats(as_tensor(inputs), as_tensor(labels)[:, pp.BINARY_OUTPUTS])
+
+
+def update_model(model, inputs_path, labels_path, optimiser=OPTIMISER, epochs=EPOCHS, batch_size=BATCH_SIZE, learning_rate=LEARNING_RATE,
+                 validation_split=VALIDATION_SPLIT, patience=PATIENCE, min_delta=MIN_DELTA, accelerate=ACCELERATE, bf16=BF16):
+    """
+    Train the model on the given CSVs and return it with norm stats computed over them and the training report.
+    The CSVs are converted once to the binary dataset format and memory-mapped from then on.
+    """
+    dataset = ds.load_csv_dataset(inputs_path, labels_path)
+    inputs, labels = dataset.inputs, dataset.labels()
+
+    norm_stats = compute_norm_stats(inputs, labels)
+    model, report = train_model(
+        model, inputs, labels, norm_stats, optimiser, epochs, batch_size, learning_rate,
+        validation_split=validation_split, patience=patience, min_delta=min_delta, accelerate=accelerate, bf16=bf16,
+    )
+    return model, norm_stats, report
+
+
+def _record_throughput(report, epoch_seconds):
+    """
+    Fill the report's throughput figures from the duration of every epoch so far.
+    """
+    samples = report["train_samples"]
+    steady = epoch_seconds[1:] or epoch_seconds
+    steady_epoch = sum(steady) / len(steady)
+    report["samples_per_second"] = samples * len(steady) / sum(steady)
+    report["overall_samples_per_second"] = samples * len(epoch_seconds) / sum(epoch_seconds)
+    report["compile_seconds"] = max(epoch_seconds[0] - steady_epoch, 0.0) if len(epoch_seconds) > 1 else None
+
+
+def describe_throughput(report):
+    """
+    One-line summary of a train_model() report's steady-state throughput and, for compiled runs, warm-up cost.
+    """
+    text = f"{report['samples_per_second']:.0f} samples/s"
+    if report["accelerated"] and report["compile_seconds"] is not None:
+        text += f" after a {report['compile_seconds']:.1f}s warm-up ({report['overall_samples_per_second']:.0f} samples/s overall)"
+    return text
+
+
+def train_model(model, inputs, labels, norm_stats, optimiser=OPTIMISER, epochs=EPOCHS, batch_size=BATCH_SIZE, learning_rate=LEARNING_RATE,
+                validation_split=VALIDATION_SPLIT, patience=PATIENCE, min_delta=MIN_DELTA, accelerate=ACCELERATE, bf16=BF16):
     """
     Train the model on mini-batches with gradient clipping.
+    inputs and labels may be DataFrames or tensors; either way they are normalised in one tensor pass.
     Metrics are computed using compute_metrics().
+    With a validation split, the weights of the epoch with the lowest validation loss are kept and
+    training stops once it has not improved by min_delta for patience epochs.
+    accelerate and bf16 select the fast paths of make_train_step().
+    Returns (model, report) where report holds the epochs run, training throughput and the kept epoch's validation metrics.
+    The first epoch also pays for torch.compile and allocator warm-up, so samples_per_second is measured over the
+    later epochs (or the only one) and compile_seconds is how much longer the first epoch took than a steady one;
+    overall_samples_per_second includes the warm-up.
     """
     device = "cuda" if torch.cuda.is_available() else "cpu"
     model = model.to(device)
 
-    inputs = pd.read_csv(inputs_path)
-    labels = pd.read_csv(labels_path)
+    inputs_tensor = pp.normalise_input_tensor(as_tensor(inputs), norm_stats["input_mean"], norm_stats["input_std"])
+    labels_tensor = pp.normalise_label_tensor(as_tensor(labels), norm_stats["tilt_mean"], norm_stats["tilt_std"])
+    inputs_tensor, labels_tensor, val_inputs, val_labels = split_validation(inputs_tensor, labels_tensor, validation_split)
+    if val_inputs is not None:
+        val_inputs, val_labels = val_inputs.to(device), val_labels.to(device)
 
-    input_mean = inputs.mean()
-    input_std = inputs.std().replace(0, 1)
-    tilt_col = labels.columns[7]
-    tilt_mean = float(labels[tilt_col].mean())
-    tilt_std = float(labels[tilt_col].std() or 1.0)
-
-    inputs_norm = pp.normalise_inputs(inputs, mean=input_mean, std=input_std)
-    labels_norm = pp.normalise_labels(labels, tilt_mean=tilt_mean, tilt_std=tilt_std)
-
-    inputs_tensor = torch.tensor(inputs_norm.values, dtype=torch.float32)
-    labels_tensor = torch.tensor(labels_norm.values, dtype=torch.float32)
-
-    dataset = TensorDataset(inputs_tensor, labels_tensor)
-    train_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    train_loader = BatchIterator(inputs_tensor, labels_tensor, batch_size=batch_size, shuffle=True, device=device)
     num_batches = len(train_loader)
 
     instantiated_optimiser = optimiser(model.parameters(), lr=learning_rate)
+    train_step = make_train_step(model, instantiated_optimiser, device, accelerate, bf16)
+
+    report = {
+        "epochs_run": 0,
+        "best_epoch": None,
+        "stopped_early": False,
+        "train_samples": len(inputs_tensor),
+        "val_samples": 0 if val_inputs is None else len(val_inputs),
+        "val_metrics": None,
+        "accelerated": accelerate,
+        "bf16": bf16 and autocast_dtype(device) is not None,
+        "samples_per_second": None,
+        "overall_samples_per_second": None,
+        "compile_seconds": None,
+    }
+    best_state = None
+    best_loss = float("inf")
+    epochs_since_best = 0
+    epoch_seconds = []
 
     model.train()
     for epoch in range(epochs):
         epoch_loss = 0
         epoch_binary_acc = 0
         epoch_steer_mae = 0
+        epoch_start = time.perf_counter()
         
         for i, (batch_inputs, batch_labels) in enumerate(train_loader):
-            batch_inputs, batch_labels = batch_inputs.to(device), batch_labels.to(device)
-            preds = model(batch_inputs)
-            metrics = compute_metrics(preds, batch_labels, binary_cols_count=7, loss_weights=(1.0, 0.5))
-
-            instantiated_optimiser.zero_grad()
-            total_loss = metrics["loss"]
-            total_loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-            instantiated_optimiser.step()
+            metrics = train_step(batch_inputs, batch_labels)
 
             epoch_loss += metrics["loss"].item()
             epoch_binary_acc += metrics["binary_acc"]
@@ -132,12 +419,44 @@ def update_model(model, inputs_path, labels_path, optimiser=OPTIMISER, epochs=EP
                 f"Steer MAE: {metrics['steer_mae']:.4f}",
             )
 
-        print(
+        epoch_seconds.append(time.perf_counter() - epoch_start)
+        report["epochs_run"] = epoch + 1
+        _record_throughput(report, epoch_seconds)
+        summary = (
             f"Epoch {epoch+1}/{epochs} | "
             f"Loss: {epoch_loss/num_batches:.4f} | "
             f"Binary Acc: {epoch_binary_acc/num_batches:.4f} | "
-            f"Steer MAE: {epoch_steer_mae/num_batches:.4f}",
+            f"Steer MAE: {epoch_steer_mae/num_batches:.4f} | "
+            f"{report['train_samples'] / epoch_seconds[-1]:.0f} samples/s"
         )
+        if val_inputs is None:
+            print(summary)
+            continue
+
+        val_metrics = evaluate_model(model, val_inputs, val_labels)
+        print(
+            f"{summary} | "
+            f"Val Loss: {val_metrics['loss']:.4f} | "
+            f"Val Binary Acc: {val_metrics['binary_acc']:.4f} | "
+            f"Val Steer MAE: {val_metrics['steer_mae']:.4f}",
+        )
+
+        if val_metrics["loss"] < best_loss - min_delta:
+            best_loss = val_metrics["loss"]
+            best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            report["best_epoch"] = epoch + 1
+            report["val_metrics"] = val_metrics
+            epochs_since_best = 0
+        else:
+            epochs_since_best += 1
+            if patience and epochs_since_best >= patience:
+                report["stopped_early"] = epoch + 1 < epochs
+                print(f"No validation improvement for {patience} epochs, keeping epoch {report['best_epoch']}")
+                break
+
+    report["accelerated"] = train_step.accelerated
+    if best_state is not None:
+        model.load_state_dict(best_state)
 
     """model = scale_model_weights(
         model,
@@ -149,10 +468,4 @@ def update_model(model, inputs_path, labels_path, optimiser=OPTIMISER, epochs=EP
         scale_max=1.5
     )"""
 
-    norm_stats = {
-        "input_mean": input_mean.tolist(),
-        "input_std": input_std.tolist(),
-        "tilt_mean": tilt_mean,
-        "tilt_std": tilt_std,
-    }
-    return model, norm_stats
+    return model, report
@@ -0,0 +1,122 @@
+"""
+Simulates federated rounds with many clients in one process: the pooled dataset is split into
+client shards, every selected client trains its own copy of the model in one batched (vmapped)
+computation, and the results go through the server's aggregation. Reports the global model's
+validation metrics and wall time per round as JSON.
+
+    python simulate.py --clients 50 --rounds 10 --epochs 5 --method median --output sweep.json
+"""
+
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+
+import json
+import time
+import argparse
+from datetime import datetime
+
+import torch
+
+import lib.federated as fe
+
+import shared.dataset as ds
+import shared.preprocessing as pp
+import shared.simulation as sm
+import shared.training as tr
+
+
+INPUTS_PATH = "server/data/inputs.csv"
+LABELS_PATH = "server/data/labels.csv"
+
+
+def evaluate_global(state_dict, norm_stats, inputs, labels):
+    """
+    Validation metrics of an aggregated model, normalising the raw rows with its aggregated stats.
+    """
+    model = pp.generate_base_model()
+    model.load_state_dict(state_dict)
+    val_inputs = pp.normalise_input_tensor(inputs, norm_stats["input_mean"], norm_stats["input_std"])
+    val_labels = pp.normalise_label_tensor(labels, norm_stats["tilt_mean"], norm_stats["tilt_std"])
+    return tr.evaluate_model(model, val_inputs, val_labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate federated rounds with batched clients in one process.")
+    parser.add_argument("--inputs", default=INPUTS_PATH)
+    parser.add_argument("--labels", default=LABELS_PATH)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--clients-per-round", type=int, default=None, help="clients sampled each round, defaults to all")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--epochs", type=int, default=tr.EPOCHS)
+    parser.add_argument("--batch-size", type=int, default=tr.BATCH_SIZE)
+    parser.add_argument("--learning-rate", type=float, default=tr.LEARNING_RATE)
+    parser.add_argument("--partition", choices=sm.PARTITIONS, default="contiguous")
+    parser.add_argument("--method", choices=fe.METHODS, default="mean")
+    parser.add_argument("--weighting", choices=fe.WEIGHTINGS, default="norm")
+    parser.add_argument("--trim-ratio", type=float, default=0.1)
+    parser.add_argument("--byzantine", type=int, default=1)
+    parser.add_argument("--validation-split", type=float, default=0.1,
+                        help="newest fraction of frames held out to evaluate the global model")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="save the final global model bundle here")
+    parser.add_argument("--output", help="write the JSON report here as well as printing it")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    generator = torch.Generator().manual_seed(args.seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    dataset = ds.load_csv_dataset(args.inputs, args.labels)
+    inputs, labels = tr.as_tensor(dataset.inputs), dataset.labels()
+    inputs, labels, val_inputs, val_labels = tr.split_validation(inputs, labels, args.validation_split)
+
+    shards = sm.partition_rows(len(inputs), args.clients, args.partition, generator)
+    shard_inputs, shard_labels, spans, norm_stats_list = sm.normalise_shards(inputs, labels, shards)
+    per_round = args.clients_per_round or args.clients
+
+    global_state = pp.generate_base_model().state_dict()
+    global_stats = None
+    history = []
+    print(f"[+][{datetime.now().strftime('%H:%M:%S')}] {args.clients} clients over {len(inputs)} rows, {per_round} per round", flush=True)
+
+    for round_number in range(1, args.rounds + 1):
+        selected = torch.randperm(args.clients, generator=generator)[:per_round].sort().values.tolist()
+        selected_spans = [spans[i] for i in selected]
+
+        start = time.perf_counter()
+        clients = sm.BatchedClients(global_state, len(selected), learning_rate=args.learning_rate, device=device)
+        clients.train(shard_inputs, shard_labels, selected_spans, args.epochs, args.batch_size, generator)
+        train_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        global_state, global_stats = fe.aggregate_state_dicts(
+            clients.state_dicts(), [norm_stats_list[i] for i in selected],
+            weighting=args.weighting, method=args.method, trim_ratio=args.trim_ratio, byzantine=args.byzantine,
+        )
+        aggregate_seconds = time.perf_counter() - start
+
+        entry = {
+            "round": round_number,
+            "clients": len(selected),
+            "samples": sum(length for _, length in selected_spans),
+            "train_seconds": train_seconds,
+            "aggregate_seconds": aggregate_seconds,
+        }
+        if val_inputs is not None:
+            entry["val_metrics"] = evaluate_global(global_state, global_stats, val_inputs, val_labels)
+        history.append(entry)
+        print(f"[+][{datetime.now().strftime('%H:%M:%S')}] Round {round_number}: {json.dumps(entry)}", flush=True)
+
+    if args.save:
+        fe.save_aggregate(global_state, global_stats, args.save, version=args.rounds)
+
+    report = {"config": vars(args), "device": device, "rounds": history}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()